@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from prompt_builder import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Summarizer signature: (previous summary, turns to fold in, token limit) -> new summary
+Summarizer = Callable[[str, List[Dict[str, str]], int], Awaitable[Optional[str]]]
+
+ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
+
+
+class ConversationMemory:
+    """Bounded conversation context: recent turns verbatim plus a compact summary of older ones.
+
+    State lives in the caller's ``user_data`` under ``chat_history`` (list of role/content
+    turns) and ``chat_summary`` (string), so it is persisted with the rest of the session.
+    Once the recent turns exceed ``max_turns`` or ``max_tokens``, the oldest half of them is
+    folded into the summary with one ``summarize`` call; if that call fails they are
+    dropped rather than kept, so memory never grows without bound. :meth:`context` renders
+    the summary and as many recent turns as fit the token budget.
+
+    Folding runs in a background task, one per conversation at a time, so the summarizer
+    never delays a reply. The folded turns stay in the history until their summary is in
+    place, and are left alone if the conversation was reset meanwhile.
+    """
+
+    def __init__(self, summarize: Summarizer, max_tokens: int = 2000, max_turns: int = 12,
+                 summary_tokens: int = 300):
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.max_turns = max(2, max_turns)
+        self.summary_tokens = summary_tokens
+        # Running fold per conversation, keyed by id(user_data); tasks are kept out of user_data since it is pickled
+        self._folds: Dict[int, asyncio.Task] = {}
+
+    def context(self, user_data: Dict, question: str) -> str:
+        """Prompt text for ``question``, preceded by the summary and the recent turns that fit the budget."""
+        summary = user_data.get("chat_summary") or ""
+        budget = self.max_tokens - estimate_tokens(summary) - estimate_tokens(question)
+
+        # Newest turns first, so the immediate context survives when the budget runs out
+        lines: List[str] = []
+        for turn in reversed(user_data.get("chat_history") or []):
+            line = f"{ROLE_LABELS.get(turn['role'], turn['role'])}: {turn['content']}"
+            cost = estimate_tokens(line)
+            if cost > budget:
+                # Keep the start of a long turn (usually an answer) rather than losing it entirely
+                if budget >= 50:
+                    lines.append(line[:len(line) * budget // cost] + "…")
+                break
+            lines.append(line)
+            budget -= cost
+
+        parts = []
+        if summary:
+            parts.append(f"Conversation summary so far:\n{summary}")
+        if lines:
+            parts.append("Recent conversation:\n" + "\n".join(reversed(lines)))
+        parts.append(f"User Question: {question}")
+        return "\n\n".join(parts)
+
+    def remember(self, user_data: Dict, question: str, answer: str) -> None:
+        """Record one exchange and, when the window is full, start folding the oldest turns into the summary."""
+        history = user_data.setdefault("chat_history", [])
+        history.append({"role": "user", "content": question})
+        history.append({"role": "assistant", "content": answer})
+
+        key = id(user_data)
+        if self._full(history) and key not in self._folds:
+            task = asyncio.get_running_loop().create_task(self._fold(user_data))
+            self._folds[key] = task
+            task.add_done_callback(lambda _: self._folds.pop(key, None))
+
+    async def close(self) -> None:
+        """Cancel running folds; their turns are still in the history and get folded after a restart."""
+        tasks = list(self._folds.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _fold(self, user_data: Dict) -> None:
+        # Exchanges that arrive while a summary is being written are folded on the next pass
+        while self._full(user_data.get("chat_history") or []):
+            history = user_data["chat_history"]
+            # Fold whole exchanges so a question is never kept without its answer
+            fold = max(2, len(history) // 2)
+            fold -= fold % 2
+            folded = history[:fold]
+            previous = user_data.get("chat_summary") or ""
+            try:
+                summary = await self.summarize(previous, folded, self.summary_tokens)
+            except Exception as e:
+                logger.error(f"Error summarizing conversation: {str(e)}")
+                summary = None
+
+            history = user_data.get("chat_history") or []
+            if history[:fold] != folded or (user_data.get("chat_summary") or "") != previous:
+                # Reset while summarizing: neither the turns nor the summary belong to this conversation any more
+                return
+            user_data["chat_history"] = history[fold:]
+            if summary:
+                user_data["chat_summary"] = summary.strip()
+
+    @staticmethod
+    def reset(user_data: Dict) -> None:
+        user_data["chat_history"] = []
+        user_data["chat_summary"] = ""
+
+    def _full(self, history: List[Dict[str, str]]) -> bool:
+        return len(history) > self.max_turns or self._tokens(history) > self.max_tokens
+
+    @staticmethod
+    def _tokens(history: List[Dict[str, str]]) -> int:
+        return sum(estimate_tokens(turn["content"]) for turn in history)
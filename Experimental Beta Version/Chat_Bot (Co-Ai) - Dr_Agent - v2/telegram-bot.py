@@ -1,19 +1,32 @@
 import logging
 import os
+import sys
 from enum import Enum
-from typing import Dict, Optional
+from typing import Optional
 from dotenv import load_dotenv
 
-import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler
 from telegram.ext import ContextTypes, filters, ConversationHandler
 from datetime import datetime
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
-# Load and parse external configuration from .env; decouples sensitive credentials from code.
-load_dotenv()
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Load and parse external configuration from this bot's own .env; decouples sensitive credentials from code.
+# Loaded before the shared modules below, which only read the environment and never load another bot's .env.
+load_dotenv(os.path.join(BOT_DIR, '.env'))
+
+# Reuse the session persistence backend and LLM gateway of the sibling Dr_Agent bot rather than maintaining second copies.
+# DR_AGENT_DIR points at that checkout when the two bots are not deployed side by side.
+DR_AGENT_DIR = os.path.abspath(os.getenv("DR_AGENT_DIR", os.path.join(BOT_DIR, '..', 'Dr_Agent - With MistralAI')))
+if not os.path.isfile(os.path.join(DR_AGENT_DIR, 'llm_gateway.py')):
+    sys.exit(f"Shared Dr_Agent modules not found in {DR_AGENT_DIR}; set DR_AGENT_DIR")
+sys.path.append(DR_AGENT_DIR)
+from session_persistence import SESSION_DB_FILE, SessionPersistence
+from llm_gateway import create_gateway
+from llm_scheduler import PRIORITY_BULK, PRIORITY_DIAGNOSIS, LLMScheduler
+from LLMs import close_async_client
+from conversation_memory import ConversationMemory
 
 # Initialize centralized logging to capture critical runtime events for post-deployment diagnostics.
 # Logging is file-based and console output is suppressed to enhance production performance.
@@ -32,25 +45,24 @@ logger.addHandler(logging.NullHandler())  # Ensure no duplicate logging handlers
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-if not TELEGRAM_TOKEN or not GEMINI_API_KEY:
+if not TELEGRAM_TOKEN or not (GEMINI_API_KEY or os.getenv("MISTRAL_API_KEY")):
     # Fail fast if essential configuration is missing; this prevents undefined behavior.
-    raise ValueError("TELEGRAM_TOKEN or GEMINI_API_KEY environment variable is not set")
-
-# Initialize Gemini generative AI model with tuned parameters for balanced creativity and safety.
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-pro',
-    generation_config={
-        'temperature': 0.7,  # Adjust randomness to optimize creative output.
-        'top_p': 0.9,        # Use nucleus sampling to focus on quality responses.
-        'max_output_tokens': 4000,  # Ensure responses remain within Telegram limits.
-    },
-    safety_settings={
-        HarmCategory.HARASSMENT: HarmBlockThreshold.MEDIUM,
-        HarmCategory.HATE_SPEECH: HarmBlockThreshold.MEDIUM,
-        HarmCategory.SEXUALLY_EXPLICIT: HarmBlockThreshold.MEDIUM,
-        HarmCategory.DANGEROUS_CONTENT: HarmBlockThreshold.MEDIUM,
-    }
-)
+    raise ValueError("TELEGRAM_TOKEN and GEMINI_API_KEY (or MISTRAL_API_KEY) environment variables must be set")
+
+# Route every generation through the shared multi-provider gateway: Gemini first, Mistral as failover by default
+# (LLM_PROVIDERS), with pooled connections, rate limits and circuit breakers shared with Dr_Agent's code.
+llm_gateway = create_gateway(default="gemini,mistral")
+# Bounded pool for LLM calls (LLM_MAX_CONCURRENCY): medical answers go before articles and summary refreshes.
+llm_scheduler = LLMScheduler(max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 4)))
+# Generation parameters, tuned for balanced creativity; output length stays within Telegram limits.
+TEMPERATURE = 0.7
+MAX_OUTPUT_TOKENS = 4000
+
+# Medical chat memory: recent turns verbatim plus a rolling summary of older ones, capped at roughly
+# CHAT_MEMORY_TOKENS prompt tokens, so follow-up questions keep their context without the prompt growing unbounded.
+CHAT_MEMORY_TOKENS = int(os.getenv("CHAT_MEMORY_TOKENS", 2000))
+CHAT_MEMORY_TURNS = int(os.getenv("CHAT_MEMORY_TURNS", 12))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", 300))
 
 # Enumeration defining conversation states; follows the state design pattern for robust session management.
 class States(Enum):
@@ -58,8 +70,9 @@ class States(Enum):
     ARTICLE_WRITING = 1
     MEDICAL_CHAT = 2
 
-# Scoped storage for user sessions; maintains context for stateless conversations.
-user_sessions: Dict[int, Dict] = {}
+# User sessions ("current_mode", "chat_history", "chat_summary") live in context.user_data; SessionPersistence
+# reloads them lazily after a restart and flushes changes in batches every SESSION_FLUSH_INTERVAL seconds.
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", 30))
 
 # Define constant for mandatory Telegram channel membership; enforces gated access.
 CHANNEL_ID = "@DrAgent_channel"
@@ -83,8 +96,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     Validates channel membership, initializes the user session, and presents mode options.
     Follows a defensive programming stance to ensure proper session context.
     """
-    user_id = update.effective_user.id
-    
     # Validate channel membership to gate critical functionalities.
     if not await check_member(update, context):
         keyboard = [[InlineKeyboardButton("عضویت در کانال", url="https://t.me/DrAgent_channel")]]
@@ -98,10 +109,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
     
     # Initialize or reset user session to ensure stateless and non-leaky context handling.
-    user_sessions[user_id] = {
-        "current_mode": None,
-        "chat_history": []
-    }
+    context.user_data["current_mode"] = None
+    ConversationMemory.reset(context.user_data)
     
     keyboard = [
         [
@@ -129,12 +138,11 @@ async def mode_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     Updates session context and provides mode-specific UI feedback.
     """
     query = update.callback_query
-    user_id = update.effective_user.id
     
     await query.answer()
     
     if query.data == "mode_article":
-        user_sessions[user_id]["current_mode"] = "article"
+        context.user_data["current_mode"] = "article"
         await query.edit_message_text(
             "📝 حالت نوشتن مقاله فعال شد!\n\n"
             "لطفا موضوع یا کلمات کلیدی مورد نظر برای مقاله را وارد کنید. به عنوان مثال:\n"
@@ -147,7 +155,7 @@ async def mode_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return States.ARTICLE_WRITING
     
     elif query.data == "mode_medical":
-        user_sessions[user_id]["current_mode"] = "medical"
+        context.user_data["current_mode"] = "medical"
         await query.edit_message_text(
             "🩺 حالت گفتگو پزشکی فعال شد!\n\n"
             "اکنون می‌توانید سوالات پزشکی یا بهداشتی خود را مطرح کنید. به عنوان مثال:\n"
@@ -188,14 +196,10 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     Resets the user session, ensuring clean state and preventing residual context issues.
     """
-    user_id = update.effective_user.id
-    
     # Reset session to default state to avoid stale data.
-    if user_id in user_sessions:
-        user_sessions[user_id] = {
-            "current_mode": None,
-            "chat_history": []
-        }
+    if "current_mode" in context.user_data:
+        context.user_data["current_mode"] = None
+        ConversationMemory.reset(context.user_data)
     
     await update.message.reply_text(
         "✅ عملیات لغو شد. از حالت فعلی خارج شدید.\n\n"
@@ -231,7 +235,7 @@ async def save_to_markdown(user_id: int, mode: str, query: str, response: str) -
 async def handle_article_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Processes the article generation mode.
     
-    Solicits user input as a topic, triggers the Gemini API asynchronously, manages response chunking,
+    Solicits user input as a topic, triggers the LLM gateway asynchronously, manages response chunking,
     and persists the interaction with a strong focus on performance and error handling.
     """
     user_id = update.effective_user.id
@@ -245,7 +249,7 @@ async def handle_article_mode(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text("🔍 در حال تولید مقاله شما... ممکن است کمی طول بکشد.")
     
     try:
-        # Invoke Gemini API with robust asynchronous call while ensuring fact-checking.
+        # Invoke the LLM gateway with robust asynchronous call while ensuring fact-checking.
         article = await generate_article_with_deepseek(topic)
         
         if not article:
@@ -291,18 +295,15 @@ async def handle_article_mode(update: Update, context: ContextTypes.DEFAULT_TYPE
     return States.ARTICLE_WRITING
 
 async def handle_medical_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handles medical inquiries by leveraging contextual history and Gemini API for safe responses.
+    """Handles medical inquiries by leveraging contextual history and the LLM gateway for safe responses.
     
     Maintains conversation continuity and adheres to scientific safety guidelines.
     """
     user_id = update.effective_user.id
     query = update.message.text
     
-    # Retrieve existing conversation, ensuring context propagation for enhanced relevance.
-    chat_history = user_sessions.get(user_id, {}).get("chat_history", [])
-    
-    # Append the latest user query to the session history.
-    chat_history.append({"role": "user", "content": query})
+    # Summary and recent turns of this conversation, within the memory's token budget.
+    prompt = chat_memory.context(context.user_data, query)
     
     # Indicate processing to the user, managing latency expectations.
     await context.bot.send_chat_action(
@@ -312,7 +313,7 @@ async def handle_medical_mode(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         # Solicit a medical reply, integrating current context while following compliance guidelines.
-        response = await generate_medical_response(chat_history)
+        response = await generate_medical_response(prompt)
         
         if not response:
             await update.message.reply_text(
@@ -323,15 +324,11 @@ async def handle_medical_mode(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Audit the interaction prior to dispatching the reply.
         await save_to_markdown(user_id, "Medical Chat", query, response)
         
-        # Append the model response to maintain complete dialogue history.
-        chat_history.append({"role": "assistant", "content": response})
-        
-        # Update session with latest dialogue for potential iterative queries.
-        if user_id in user_sessions:
-            user_sessions[user_id]["chat_history"] = chat_history
-        
         await update.message.reply_text(response, parse_mode="Markdown")
         
+        # Remember the exchange after replying; a summary refresh runs in the background and never delays the answer.
+        chat_memory.remember(context.user_data, query, response)
+        
     except Exception as e:
         logger.error(f"Error in medical response generation: {str(e)}")
         await update.message.reply_text(
@@ -341,7 +338,7 @@ async def handle_medical_mode(update: Update, context: ContextTypes.DEFAULT_TYPE
     return States.MEDICAL_CHAT
 
 async def generate_article_with_deepseek(topic: str) -> Optional[str]:
-    """Asynchronously generate a concise academic article using Gemini API.
+    """Asynchronously generate a concise academic article through the LLM gateway.
     
     Enforces robust fact-checking, structured output, and ensures single-message delivery.
     Incorporates defensive coding practices to handle edge cases and API disconnects.
@@ -395,27 +392,30 @@ async def generate_article_with_deepseek(topic: str) -> Optional[str]:
             Output: A complete academic article demonstrating accuracy, completeness, and rigor, presented in a formal and authoritative tone, and formatted to fit within a single Telegram message.
         """
         
-        prompt = f"{system_message}\nWrite an academic article about: {topic}"
-        
-        response = await model.generate_content_async(
-            prompt,
-            stream=False
+        response = await llm_scheduler.run(
+            lambda: llm_gateway.complete(
+                f"Write an academic article about: {topic}",
+                system_prompt=system_message,
+                max_tokens=MAX_OUTPUT_TOKENS,
+                temperature=TEMPERATURE
+            ),
+            PRIORITY_BULK
         )
         
-        if response.text:
-            return response.text.strip()
+        if response:
+            return response.strip()
             
-        logger.error("Empty response from Gemini API")
+        logger.error("Empty response from LLM gateway")
         return None
             
     except Exception as e:
-        logger.error(f"Error generating article with Gemini: {str(e)}")
+        logger.error(f"Error generating article: {str(e)}")
         return None
 
-async def generate_medical_response(chat_history: list) -> Optional[str]:
-    """Compose a safe, evidence-based medical response using Gemini API.
+async def generate_medical_response(prompt: str) -> Optional[str]:
+    """Compose a safe, evidence-based medical response through the LLM gateway.
     
-    Integrates conversation context, applies risk mitigation strategies, and adheres to compliance norms.
+    ``prompt`` carries the conversation context from :class:`ConversationMemory` followed by the new question.
     """
     try:
         system_message = (
@@ -434,26 +434,51 @@ async def generate_medical_response(chat_history: list) -> Optional[str]:
             "they should consult healthcare professionals for personal medical advice."
         )
         
-        # Use only the most recent query to form the basis of the prompt.
-        last_message = chat_history[-1]["content"] if chat_history else ""
-        
-        prompt = f"{system_message}\nUser Question: {last_message}"
-        
-        response = await model.generate_content_async(
-            prompt,
-            stream=False
+        response = await llm_scheduler.run(
+            lambda: llm_gateway.complete(
+                prompt,
+                system_prompt=system_message,
+                max_tokens=MAX_OUTPUT_TOKENS,
+                temperature=TEMPERATURE
+            ),
+            PRIORITY_DIAGNOSIS
         )
         
-        if response.text:
-            return response.text.strip()
+        if response:
+            return response.strip()
             
-        logger.error("Empty response from Gemini API")
+        logger.error("Empty response from LLM gateway")
         return None
 
     except Exception as e:
         logger.error(f"Error in medical response generation: {str(e)}")
         return None
 
+async def summarize_conversation(summary: str, turns: list, max_tokens: int) -> Optional[str]:
+    """Fold older chat turns into the running conversation summary through the LLM gateway."""
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    response = await llm_scheduler.run(
+        lambda: llm_gateway.complete(
+            f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{transcript}",
+            system_prompt=(
+                "Update the summary of a medical chat between a user and an assistant with the new turns. "
+                "Keep the user's symptoms, conditions, medications, allergies and open questions, and the key advice given. "
+                f"Write at most {max_tokens // 2} words, in the language of the conversation. Reply with the summary only."
+            ),
+            max_tokens=max_tokens,
+            temperature=0.2
+        ),
+        PRIORITY_BULK
+    )
+    return response.strip() if response else None
+
+chat_memory = ConversationMemory(
+    summarize_conversation,
+    max_tokens=CHAT_MEMORY_TOKENS,
+    max_turns=CHAT_MEMORY_TURNS,
+    summary_tokens=CHAT_SUMMARY_TOKENS
+)
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Provide end-user documentation via /help command.
     
@@ -475,6 +500,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     await update.message.reply_text(help_text, parse_mode="Markdown")
 
+async def on_shutdown(application: Application) -> None:
+    """Stop background summaries and release pooled LLM connections when the bot stops."""
+    await chat_memory.close()
+    await close_async_client()
+
 def main() -> None:
     """Configure and launch the Telegram bot.
     
@@ -482,8 +512,17 @@ def main() -> None:
     Includes modular handler registration to streamline mode transitions and mitigate potential runtime issues.
     """
     try:
+        # Persist sessions and conversation states so a restart does not reset active chats.
+        persistence = SessionPersistence(SESSION_DB_FILE, update_interval=SESSION_FLUSH_INTERVAL)
+        
         # Create the Application instance using the builder pattern; ensures immutability and clarity.
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .persistence(persistence)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
         
         # Configure upstream libraries to minimize unnecessary log noise.
         logging.getLogger('httpx').setLevel(logging.WARNING)
@@ -509,7 +548,9 @@ def main() -> None:
                 ]
             },
             fallbacks=[CommandHandler("cancel", cancel)],
-            allow_reentry=True
+            allow_reentry=True,
+            name="co_ai_conversation",
+            persistent=True
         )
         
         # Register conversation and ancillary command handlers.
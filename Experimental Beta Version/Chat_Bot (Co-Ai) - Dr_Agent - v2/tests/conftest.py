@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The bot's modules, and the Dr_Agent modules it shares, are flat scripts rather than installed packages
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_DIR)
+sys.path.append(os.path.join(BOT_DIR, '..', 'Dr_Agent - With MistralAI'))
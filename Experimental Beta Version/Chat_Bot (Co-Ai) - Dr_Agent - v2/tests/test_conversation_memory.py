@@ -0,0 +1,139 @@
+import asyncio
+
+from conversation_memory import ConversationMemory
+
+
+class Summarizer:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+        self.release = asyncio.Event()
+
+    async def __call__(self, previous, turns, max_tokens):
+        self.calls.append([turn['content'] for turn in turns])
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("model error")
+        return f"{previous} +{len(turns)}".strip()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def history(user_data):
+    return [turn['content'] for turn in user_data['chat_history']]
+
+
+def test_remember_returns_before_the_summary_is_written():
+    async def main():
+        summarize = Summarizer()
+        memory = ConversationMemory(summarize, max_turns=4)
+        user_data = {}
+        for i in range(3):
+            memory.remember(user_data, f"q{i}", f"a{i}")
+        await settle()
+
+        # Folding is under way, but the turns stay in the context until the summary lands
+        # The oldest half, rounded down to whole exchanges
+        assert summarize.calls == [["q0", "a0"]]
+        assert history(user_data) == ["q0", "a0", "q1", "a1", "q2", "a2"]
+        assert "q0" in memory.context(user_data, "next")
+
+        summarize.release.set()
+        await settle()
+        return user_data
+
+    user_data = asyncio.run(main())
+    assert user_data['chat_summary'] == "+2"
+    assert history(user_data) == ["q1", "a1", "q2", "a2"]
+
+
+def test_one_fold_per_conversation_catches_up_with_new_turns():
+    async def main():
+        summarize = Summarizer()
+        memory = ConversationMemory(summarize, max_turns=4)
+        user_data = {}
+        for i in range(3):
+            memory.remember(user_data, f"q{i}", f"a{i}")
+        await settle()
+        for i in range(3, 6):
+            memory.remember(user_data, f"q{i}", f"a{i}")
+        await settle()
+        assert len(summarize.calls) == 1
+
+        summarize.release.set()
+        await settle()
+        return summarize.calls, user_data
+
+    calls, user_data = asyncio.run(main())
+    assert [len(turns) for turns in calls] == [2, 4, 2]
+    assert history(user_data) == ["q4", "a4", "q5", "a5"]
+    assert user_data['chat_summary'] == "+2 +4 +2"
+
+
+def test_a_failed_summary_drops_the_folded_turns():
+    async def main():
+        summarize = Summarizer(fail=True)
+        summarize.release.set()
+        memory = ConversationMemory(summarize, max_turns=4)
+        user_data = {'chat_summary': "earlier"}
+        for i in range(3):
+            memory.remember(user_data, f"q{i}", f"a{i}")
+        await settle()
+        return user_data
+
+    user_data = asyncio.run(main())
+    assert history(user_data) == ["q1", "a1", "q2", "a2"]
+    assert user_data['chat_summary'] == "earlier"
+
+
+def test_a_reset_during_the_summary_discards_it():
+    async def main():
+        summarize = Summarizer()
+        memory = ConversationMemory(summarize, max_turns=4)
+        user_data = {}
+        for i in range(3):
+            memory.remember(user_data, f"q{i}", f"a{i}")
+        await settle()
+        ConversationMemory.reset(user_data)
+        memory.remember(user_data, "new", "answer")
+
+        summarize.release.set()
+        await settle()
+        return user_data
+
+    user_data = asyncio.run(main())
+    assert history(user_data) == ["new", "answer"]
+    assert user_data['chat_summary'] == ""
+
+
+def test_close_cancels_running_folds_and_keeps_the_turns():
+    async def main():
+        memory = ConversationMemory(Summarizer(), max_turns=4)
+        user_data = {}
+        for i in range(3):
+            memory.remember(user_data, f"q{i}", f"a{i}")
+        await settle()
+        await memory.close()
+        return user_data
+
+    user_data = asyncio.run(main())
+    assert len(user_data['chat_history']) == 6
+    assert 'chat_summary' not in user_data
+
+
+def test_context_keeps_the_newest_turns_within_the_budget():
+    memory = ConversationMemory(Summarizer(), max_tokens=60)
+    user_data = {'chat_summary': "خلاصه", 'chat_history': [
+        {'role': 'user', 'content': "old " * 100},
+        {'role': 'assistant', 'content': "recent answer"}
+    ]}
+
+    context = memory.context(user_data, "question?")
+
+    assert context.startswith("Conversation summary so far:\nخلاصه")
+    assert "Assistant: recent answer" in context
+    assert "old old" not in context
+    assert context.endswith("User Question: question?")
@@ -1,9 +1,9 @@
 import os
 import json
 import asyncio 
+import time
 from datetime import datetime
 import uuid
-import base64
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, Update  # Add this import
 from telegram.ext import (
     CommandHandler,
@@ -12,10 +12,31 @@ from telegram.ext import (
     filters,
     ApplicationBuilder,
     Application,
-    CallbackQueryHandler 
+    CallbackQueryHandler,
+    TypeHandler
 )
-from LLMs import call_language_model  
+from telegram.error import BadRequest, RetryAfter
 from dotenv import load_dotenv
+
+# Load this bot's .env (next to this script) before the shared modules below read their settings
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+
+from LLMs import (FALLBACK_RESPONSE, RetryableAPIError, close_async_client, completion_hedging, get_async_client,
+                  probe_api_health, stream_hedging)
+from llm_gateway import NoProviderAvailable, create_gateway
+from circuit_breaker import CircuitOpenError
+from retry_policy import RetryPolicy, retry_metrics
+from llm_scheduler import PRIORITY_DIAGNOSIS, PRIORITY_PROBE, LLMScheduler
+from health_monitor import HealthMonitor
+from connection_warmer import ConnectionWarmer
+from storage import create_storage
+from visit_repository import VisitIdGenerator, VisitRepository, format_visit_code, format_visit_link_param
+from persistence_writer import PersistenceWriter
+from visit_reports import ReportCache, export_reports, render_report
+from session_persistence import SESSION_DB_FILE, SessionPersistence
+from prompt_builder import PromptBuilder, PromptSection
+from diagnosis_cache import DIAGNOSIS_CACHE_FILE, DiagnosisCache, canonical_profile, checked_symptoms, profile_key
+from diagnosis_parser import STRUCTURED_OUTPUT_INSTRUCTIONS, parse_diagnosis, visit_diagnosis_fields
 import sys
 import codecs
 
@@ -24,14 +45,26 @@ if sys.platform.startswith('win'):
     sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer)
 
 # ----------------- Configuration -----------------
-# Load environment variables
-load_dotenv(r"C:\Users\Administrator\Desktop\Dr_Agent - With MistralAI\.env")
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 BOT_USERNAME = os.getenv('TELEGRAM_BOT_USERNAME', '').lstrip('@')  # Remove @ if present
 if not BOT_USERNAME:
     print("Warning: TELEGRAM_BOT_USERNAME not set in environment variables")
 DB_FOLDER = r"C:\Users\Administrator\Desktop\Dr_Agent - With MistralAI\database"
-DB_FILE = "patients.json"
+DB_FILE = "patients.json"  # Legacy JSON array, migrated into the visit log on startup
+# Storage backend for visits and profiles: 'json' (visit log + patient_info.json) or 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+# Stream the diagnosis into the processing message while it is generated
+STREAM_DIAGNOSIS = os.getenv('STREAM_DIAGNOSIS', 'true').lower() in ('1', 'true', 'yes')
+# Ask the model for a JSON diagnosis (differential, urgency, recommendations, warnings) instead of free text.
+# The answer is validated once and stored as fields on the visit; it is not streamed, since raw JSON is not readable.
+STRUCTURED_DIAGNOSIS = os.getenv('STRUCTURED_DIAGNOSIS', 'false').lower() in ('1', 'true', 'yes')
+# Minimum seconds between edits of the streamed message (Telegram allows about one edit per second per chat)
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))
+# One retry budget per diagnosis, shared by the stream, its fallback and every retry below them
+# (DIAGNOSIS_TOTAL_BUDGET, DIAGNOSIS_MAX_ATTEMPTS, DIAGNOSIS_ATTEMPT_TIMEOUT, DIAGNOSIS_CONNECT_TIMEOUT, ...)
+DIAGNOSIS_RETRY_POLICY = RetryPolicy.from_env('DIAGNOSIS_')
+# Telegram rejects messages longer than 4096 characters
+TELEGRAM_MESSAGE_LIMIT = 4096
 
 # System prompt for your fine-tuned Mistral AI model
 SYSTEM_PROMPT = """
@@ -77,6 +110,13 @@ Respond in Persian using a professional, clear, and concise tone.
 Always remind that the information is for informational purposes only and to consult a healthcare professional for diagnosis and treatment.
 """
 
+# The diagnosis prompt is assembled once per request and kept within this many input tokens
+PROMPT_MAX_INPUT_TOKENS = int(os.getenv('PROMPT_MAX_INPUT_TOKENS', 4000))
+diagnosis_prompt_builder = PromptBuilder(
+    SYSTEM_PROMPT + STRUCTURED_OUTPUT_INSTRUCTIONS if STRUCTURED_DIAGNOSIS else SYSTEM_PROMPT,
+    PROMPT_MAX_INPUT_TOKENS
+)
+
 # Load questions from JSON file
 def load_questions():
     questions_file = r"C:\Users\Administrator\Desktop\Dr_Agent - With MistralAI\questions.json"
@@ -104,6 +144,52 @@ VIEW_PROFILE, VIEW_HISTORY, SELECT_VISIT_VERSION = range(12, 15)
 # Add path for patient info database
 PATIENT_INFO_DB = "patient_info.json"
 
+# Visit and profile storage shared by all handlers
+storage = create_storage(STORAGE_BACKEND, DB_FOLDER, PATIENT_INFO_DB)
+# Indexed visit lookups (deep links, visit codes) on top of the storage backend
+visit_repository = VisitRepository(storage)
+# Visits per page in the inline visit history
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 8))
+# Unique, time-ordered visit IDs used in visit codes and deep links
+visit_ids = VisitIdGenerator(node=int(os.getenv('VISIT_ID_NODE', 0)))
+# Single background writer for visits and profiles
+persistence_writer = PersistenceWriter(visit_repository)
+# Visit reports are rendered on demand from the stored record and cached per visit (user, timestamp and code)
+report_cache = ReportCache(max_bytes=int(os.getenv('REPORT_CACHE_BYTES', 8 * 1024 * 1024)))
+# Model providers in preference order (LLM_PROVIDERS, e.g. 'mistral,gemini'); the gateway routes by
+# latency and error rate and fails over between them
+llm_gateway = create_gateway(default='mistral,gemini')
+# Bounded pool for LLM calls; diagnoses go before health probes and bulk jobs.
+# Admins (ADMIN_USER_IDS, comma separated) can change the limit with /llm_concurrency <n>
+llm_scheduler = LLMScheduler(max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', 4)))
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+# Background probe of the Mistral API; the first runs at startup and /llm_stats shows the cached result.
+# Probes queue behind waiting diagnoses, so a busy bot spends its LLM slots on patients first.
+api_health = HealthMonitor(lambda: llm_scheduler.run(probe_api_health, PRIORITY_PROBE),
+                           interval=float(os.getenv('HEALTH_CHECK_INTERVAL', 60)))
+# Connections to every provider are opened at startup (one per concurrent LLM call by default) and pinged
+# every KEEPALIVE_PING_INTERVAL seconds so the first patient after a quiet spell skips the TCP/TLS handshake
+connection_warmer = ConnectionWarmer(
+    get_async_client,
+    [provider.base_url for provider in llm_gateway.providers if provider.base_url],
+    connections=int(os.getenv('WARMUP_CONNECTIONS', llm_scheduler.max_concurrency)),
+    interval=float(os.getenv('KEEPALIVE_PING_INTERVAL', 30))
+)
+# Pooled connections to the Telegram Bot API; streamed edits and replies of concurrent diagnoses share them
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv('TELEGRAM_CONNECTION_POOL_SIZE', llm_scheduler.max_concurrency + 4))
+# Diagnoses of identical intakes (same checked symptoms, age and gender, output mode and models) are reused
+# instead of calling the model again; DIAGNOSIS_CACHE_SIZE=0 turns the cache off
+DIAGNOSIS_CACHE_SIZE = int(os.getenv('DIAGNOSIS_CACHE_SIZE', 1024))
+# 'bypass': intakes with extra info or typed medical history are not cached; 'ignore': free text is left out of the key
+DIAGNOSIS_CACHE_FREE_TEXT = os.getenv('DIAGNOSIS_CACHE_FREE_TEXT', 'bypass')
+diagnosis_cache = DiagnosisCache(
+    max_entries=DIAGNOSIS_CACHE_SIZE,
+    ttl=float(os.getenv('DIAGNOSIS_CACHE_TTL_HOURS', 168)) * 3600,
+    path=os.path.join(DB_FOLDER, DIAGNOSIS_CACHE_FILE)
+    if os.getenv('DIAGNOSIS_CACHE_DISK', 'true').lower() in ('1', 'true', 'yes') else None
+)
+REPORTS_FOLDER = r"C:\Users\Administrator\Desktop\Dr_Agent - With MistralAI\Database\reports"
+
 # Add medical history categories
 MEDICAL_HISTORY_CATEGORIES = {
     'medical_history': [
@@ -188,14 +274,8 @@ async def start(update, context):
 async def process_visit_link(update, context, visit_param):
     """Process visit deep link parameter"""
     try:
-        # Extract and decode visit identifier
-        encoded_data = visit_param.replace('visit_', '')
-        padded_data = encoded_data + '=' * (-len(encoded_data) % 4)
-        decoded_data = base64.urlsafe_b64decode(padded_data).decode()
-        user_id, timestamp = decoded_data.split('-', 1)
-        
-        # Load visit from database
-        visit = await load_visit_by_id_and_timestamp(int(user_id), timestamp)
+        # Decode the visit identifier and load the visit from the index
+        visit = visit_repository.resolve_link(visit_param)
         
         if not visit:
             raise ValueError("Visit record not found")
@@ -228,30 +308,8 @@ async def process_visit_link(update, context, visit_param):
         )
         return GETTING_STARTED
 
-async def load_visit_by_id_and_timestamp(user_id, timestamp):
-    """Load specific visit from database"""
-    if os.path.exists(os.path.join(DB_FOLDER, DB_FILE)):
-        try:
-            with open(os.path.join(DB_FOLDER, DB_FILE), 'r', encoding='utf-8') as f:
-                visits = json.load(f)
-                return next(
-                    (v for v in visits 
-                     if v.get('user_id') == user_id and 
-                     v.get('visit_timestamp', '').startswith(timestamp)),
-                    None
-                )
-        except Exception as e:
-            print(f"Error loading visit data: {e}")
-    return None
-
 async def check_existing_info(user_id):
-    if os.path.exists(PATIENT_INFO_DB):
-        with open(PATIENT_INFO_DB, 'r', encoding='utf-8') as f:
-            patient_records = json.load(f)
-            for record in patient_records:
-                if record['user_id'] == user_id:
-                    return record
-    return None
+    return persistence_writer.get_profile(user_id)
 
 async def handle_start_choice(update, context):
     choice = update.message.text.strip()  # Add strip() to remove any whitespace
@@ -311,18 +369,11 @@ async def show_profile(update, context):
     user_id = update.message.from_user.id
     
     # Load patient info from database
-    if os.path.exists(PATIENT_INFO_DB):
-        with open(PATIENT_INFO_DB, 'r', encoding='utf-8') as f:
-            patient_records = json.load(f)
-            patient_info = next((record for record in patient_records 
-                               if record['user_id'] == user_id), None)
-    
-    # Load visit history
-    visits = []
-    if os.path.exists(os.path.join(DB_FOLDER, DB_FILE)):
-        with open(os.path.join(DB_FOLDER, DB_FILE), 'r', encoding='utf-8') as f:
-            all_visits = json.load(f)
-            visits = [v for v in all_visits if v['user_id'] == user_id]
+    patient_info = persistence_writer.get_profile(user_id)
+    
+    # Visit count and latest visits come from the per-user visit index
+    visit_count = visit_repository.count(user_id)
+    latest_visits = list(reversed(visit_repository.latest(user_id, 3)))
 
     if patient_info:
         profile_text = (
@@ -330,12 +381,12 @@ async def show_profile(update, context):
             f"نام و نام خانوادگی: {patient_info.get('name', 'ثبت نشده')}\n"
             f"سن: {patient_info.get('age', 'ثبت نشده')}\n"
             f"جنسیت: {patient_info.get('gender', 'ثبت نشده')}\n\n"
-            f"📊 تعداد ویزیت‌ها: {len(visits)}\n\n"
+            f"📊 تعداد ویزیت‌ها: {visit_count}\n\n"
             "آخرین ویزیت‌ها:"
         )
         
         # Add last 3 visits with error handling
-        for i, visit in enumerate(visits[-3:], 1):
+        for i, visit in enumerate(latest_visits, 1):
             try:
                 visit_date = datetime.fromisoformat(visit.get('visit_timestamp', '')).strftime("%Y-%m-%d %H:%M")
             except (ValueError, TypeError):
@@ -357,24 +408,15 @@ async def show_profile(update, context):
     )
     return GETTING_STARTED
 
-def generate_visit_code(user_id, timestamp):
-    """Generate a unique visit code based on user ID and timestamp."""
-    # Create a unique string combining user_id and timestamp
-    unique_str = f"{user_id}-{timestamp.strftime('%Y%m%d-%H%M%S')}"
-    # Create a URL-safe Base64 encoded string
-    encoded = base64.urlsafe_b64encode(unique_str.encode()).decode()
-    # Return a shorter, clean code
-    return f"VISIT-{encoded[:12]}"
+def generate_visit_code(visit_id):
+    """Generate the visit code (VISIT-<base62 visit ID>) shown to the patient."""
+    return format_visit_code(visit_id)
 
-def generate_visit_link(user_id, timestamp):
+def generate_visit_link(visit_id):
     """Generate a deep link for the Telegram bot."""
-    # Create a unique identifier combining user_id and timestamp
-    visit_id = f"{user_id}-{timestamp.strftime('%Y%m%d-%H%M%S')}"
-    # Base64 encode for URL safety
-    encoded_id = base64.urlsafe_b64encode(visit_id.encode()).decode().rstrip('=')
-    # Generate bot deep link with visit_ prefix
+    # The link carries the same fixed-width visit ID as the code
     if BOT_USERNAME:
-        return f"https://t.me/{BOT_USERNAME}?start=visit_{encoded_id}"
+        return f"https://t.me/{BOT_USERNAME}?start={format_visit_link_param(visit_id)}"
     return None
 
 async def handle_deep_link(update, context):
@@ -384,24 +426,8 @@ async def handle_deep_link(update, context):
         if not args or not args[0].startswith('visit_'):
             return await start(update, context)
 
-        # Extract and decode visit identifier
-        encoded_data = args[0].replace('visit_', '')
-        # Add padding if needed
-        padded_data = encoded_data + '=' * (-len(encoded_data) % 4)
-        # Decode the visit identifier
-        decoded_data = base64.urlsafe_b64decode(padded_data).decode()
-        user_id, timestamp = decoded_data.split('-', 1)
-
-        # Load visit from database
-        visit = None
-        if os.path.exists(os.path.join(DB_FOLDER, DB_FILE)):
-            with open(os.path.join(DB_FOLDER, DB_FILE), 'r', encoding='utf-8') as f:
-                visits = json.load(f)
-                for v in visits:
-                    if (str(v.get('user_id')) == user_id and 
-                        v.get('visit_timestamp', '').startswith(timestamp)):
-                        visit = v
-                        break
+        # Decode the visit identifier and load the visit from the index
+        visit = visit_repository.resolve_link(args[0])
 
         if not visit:
             raise ValueError("Visit record not found")
@@ -447,28 +473,45 @@ async def handle_deep_link(update, context):
         )
         return GETTING_STARTED
 
+def format_history_page(page):
+    """Build the message text and inline keyboard for one page of visit history"""
+    buttons = []
+    for entry in page['entries']:
+        try:
+            visit_date = datetime.fromisoformat(entry['visit_timestamp']).strftime("%Y-%m-%d %H:%M")
+        except (TypeError, ValueError):
+            visit_date = "تاریخ نامشخص"
+        visit_code = entry.get('visit_code') or 'نامشخص'
+        # Visit buttons carry the visit's own (timestamp, code), so they stay valid on any page
+        callback_data = f"hist_v|{entry['visit_timestamp']}|{entry.get('visit_code') or ''}"
+        buttons.append([InlineKeyboardButton(f"📋 {visit_date} | کد: {visit_code}", callback_data=callback_data)])
+    
+    # Cursor buttons carry the (timestamp, code) of the page edge
+    navigation = []
+    if page['newer']:
+        navigation.append(InlineKeyboardButton("➡️ صفحه قبل", callback_data="hist_n|" + "|".join(page['newer'])))
+    if page['older']:
+        navigation.append(InlineKeyboardButton("صفحه بعد ⬅️", callback_data="hist_o|" + "|".join(page['older'])))
+    if navigation:
+        buttons.append(navigation)
+    
+    text = (
+        f"📋 تاریخچه ویزیت‌های شما ({page['total']} ویزیت):\n"
+        "لطفاً یک ویزیت را انتخاب کنید:"
+    )
+    return text, InlineKeyboardMarkup(buttons)
+
 async def show_visit_history(update, context):
     user_id = update.message.from_user.id
     
-    # Load visits from database
-    visits = []
-    db_path = os.path.join(DB_FOLDER, DB_FILE)
-    if os.path.exists(db_path):
-        try:
-            with open(db_path, 'r', encoding='utf-8') as f:
-                all_visits = json.load(f)
-                # Filter visits for current user and ensure they have required fields
-                visits = [v for v in all_visits if (
-                    v.get('user_id') == user_id and 
-                    isinstance(v.get('visit_timestamp'), str)
-                )]
-                
-                # Sort visits by timestamp (most recent first)
-                visits.sort(key=lambda x: x.get('visit_timestamp', ''), reverse=True)
-        except json.JSONDecodeError:
-            print("Error reading visits database")
-    
-    if not visits:
+    # Load the newest page from the per-user visit index
+    page = None
+    try:
+        page = visit_repository.page(user_id, size=HISTORY_PAGE_SIZE)
+    except Exception as e:
+        print(f"Error reading visits database: {e}")
+    
+    if not page or not page['entries']:
         await update.message.reply_text(
             "تاریخچه ویزیتی یافت نشد.",
             reply_markup=ReplyKeyboardMarkup([
@@ -478,28 +521,69 @@ async def show_visit_history(update, context):
         )
         return GETTING_STARTED
     
-    # Store visits in context for later use
-    context.user_data['visits'] = visits
+    await update.message.reply_text(
+        "برای بازگشت از دکمه زیر استفاده کنید.",
+        reply_markup=ReplyKeyboardMarkup([['🔙 بازگشت به منوی اصلی']], resize_keyboard=True)
+    )
+    text, markup = format_history_page(page)
+    await update.message.reply_text(text, reply_markup=markup)
+    return VIEW_HISTORY
+
+async def handle_history_page(update, context):
+    """Handle inline history buttons: page navigation and visit selection"""
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+    action, _, value = query.data.partition('|')
+    timestamp, _, visit_code = value.partition('|')
     
-    # Create buttons for each visit
-    visit_buttons = []
-    for visit in visits[:10]:  # Show last 10 visits
+    if action == 'hist_v':
+        visit = None
         try:
-            visit_date = datetime.fromisoformat(visit['visit_timestamp']).strftime("%Y-%m-%d %H:%M")
-            visit_code = visit.get('visit_code', generate_visit_code(user_id, datetime.fromisoformat(visit['visit_timestamp'])))
-            visit_buttons.append([f"📋 {visit_date} | کد: {visit_code}"])
-        except (ValueError, KeyError):
-            continue
+            visit = visit_repository.get_entry(user_id, timestamp, visit_code)
+        except Exception as e:
+            print(f"Error reading visit from history: {e}")
+        if not visit and visit_code:
+            try:
+                visit = visit_repository.get_by_code(visit_code)
+            except Exception as e:
+                print(f"Error reading visit from history: {e}")
+        
+        if not visit or visit.get('user_id') != user_id:
+            await query.message.reply_text(
+                "ویزیت مورد نظر یافت نشد.",
+                reply_markup=ReplyKeyboardMarkup([['🔙 بازگشت به منوی اصلی']], resize_keyboard=True)
+            )
+            return VIEW_HISTORY
+        return await show_visit_versions(query.message, context, visit)
     
-    visit_buttons.append(['🔙 بازگشت به منوی اصلی'])
+    if action == 'hist_o':
+        page = visit_repository.page(user_id, before=(timestamp, visit_code), size=HISTORY_PAGE_SIZE)
+    else:
+        page = visit_repository.page(user_id, after=(timestamp, visit_code), size=HISTORY_PAGE_SIZE)
     
-    await update.message.reply_text(
-        "📋 تاریخچه ویزیت‌های شما:\n"
-        "لطفاً یک ویزیت را انتخاب کنید:",
-        reply_markup=ReplyKeyboardMarkup(visit_buttons, resize_keyboard=True)
-    )
+    text, markup = format_history_page(page)
+    await query.edit_message_text(text, reply_markup=markup)
     return VIEW_HISTORY
 
+async def show_visit_versions(message, context, visit):
+    """Remember the selected visit and offer its report versions"""
+    context.user_data['selected_visit'] = visit
+    
+    # Show version options
+    version_buttons = [
+        ['نسخه تشخیص'],
+        ['نسخه تجویز'],
+        ['📄 دریافت فایل گزارش'],
+        ['🔙 بازگشت به لیست ویزیت‌ها']
+    ]
+    
+    await message.reply_text(
+        "لطفاً نوع گزارش را انتخاب کنید:",
+        reply_markup=ReplyKeyboardMarkup(version_buttons, resize_keyboard=True)
+    )
+    return SELECT_VISIT_VERSION
+
 async def handle_visit_selection(update, context):
     choice = update.message.text
     
@@ -513,37 +597,17 @@ async def handle_visit_selection(update, context):
         await update.message.reply_text("ویزیت نامعتبر است.")
         return VIEW_HISTORY
     
-    visits = context.user_data.get('visits', [])
-    selected_visit = None
+    # Look the code up in the visit index; only the patient's own visits can be opened
+    selected_visit = visit_repository.get_by_code(visit_code.strip())
     
-    # Find the visit with matching code
-    for visit in visits:
-        if visit.get('visit_code') == visit_code:
-            selected_visit = visit
-            break
-    
-    if not selected_visit:
+    if not selected_visit or selected_visit.get('user_id') != update.message.from_user.id:
         await update.message.reply_text(
             "ویزیت مورد نظر یافت نشد.",
             reply_markup=ReplyKeyboardMarkup([['🔙 بازگشت به منوی اصلی']], resize_keyboard=True)
         )
         return VIEW_HISTORY
     
-    # Store selected visit in context
-    context.user_data['selected_visit'] = selected_visit
-    
-    # Show version options
-    version_buttons = [
-        ['نسخه تشخیص'],
-        ['نسخه تجویز'],
-        ['🔙 بازگشت به لیست ویزیت‌ها']
-    ]
-    
-    await update.message.reply_text(
-        "لطفاً نوع گزارش را انتخاب کنید:",
-        reply_markup=ReplyKeyboardMarkup(version_buttons, resize_keyboard=True)
-    )
-    return SELECT_VISIT_VERSION
+    return await show_visit_versions(update.message, context, selected_visit)
 
 async def request_patient_name(update, context):
     await update.message.reply_text(
@@ -591,30 +655,9 @@ async def save_gender_and_proceed(update, context):
     
     context.user_data['patient_info']['gender'] = gender
     
-    # Save/Update patient info in database
+    # Save/Update patient info in database (queued; the intake does not wait on disk)
     try:
-        patient_records = []
-        if os.path.exists(PATIENT_INFO_DB):
-            try:
-                with open(PATIENT_INFO_DB, 'r', encoding='utf-8') as f:
-                    patient_records = json.load(f)
-            except json.JSONDecodeError:
-                # فایل خالی یا معتبر نیست، با لیست خالی شروع می‌کنیم
-                patient_records = []
-        
-        # Update existing record or add new one
-        updated = False
-        for i, record in enumerate(patient_records):
-            if record['user_id'] == context.user_data['patient_info']['user_id']:
-                patient_records[i] = context.user_data['patient_info']
-                updated = True
-                break
-        
-        if not updated:
-            patient_records.append(context.user_data['patient_info'])
-        
-        with open(PATIENT_INFO_DB, 'w', encoding='utf-8') as f:
-            json.dump(patient_records, f, ensure_ascii=False, indent=2)
+        persistence_writer.submit_profile(context.user_data['patient_info'])
         
         info_summary = (
             "✅ اطلاعات پایه شما با موفقیت ثبت شد:\n\n"
@@ -1094,23 +1137,107 @@ async def prepare_final_summary(update, context):
     await update.message.reply_text(summary, reply_markup=consent_buttons)
     return DIAGNOSE
 
-# Add this function before diagnose_disease
-def check_api_health():
-    """Check if Mistral API is responsive and properly configured"""
+async def stream_diagnosis(processing_message, prompt, budget=None):
+    """Stream the diagnosis into the processing message and return the complete text.
+    
+    The message is edited at most once per STREAM_EDIT_INTERVAL (longer if Telegram asks
+    us to back off). If the stream fails before any text arrived, the regular
+    non-streaming request is used instead, with whatever is left of ``budget``.
+    """
+    text = ""
+    shown = ""
+    next_edit = 0.0
     try:
-        # Try making a minimal test call to Mistral API
-        response = call_language_model("test")
-        if response and not "خطا" in response:
-            return True, "API available"
-        return False, "API not responding properly"
+        async for delta in llm_gateway.stream(prompt.user, prompt.system, budget):
+            text += delta
+            now = time.monotonic()
+            if now < next_edit or text.strip() == shown:
+                continue
+            preview = "🔄 در حال تحلیل اطلاعات...\n\n" + text.strip()
+            if len(preview) > TELEGRAM_MESSAGE_LIMIT:
+                preview = preview[:TELEGRAM_MESSAGE_LIMIT - 1] + "…"
+            next_edit = now + STREAM_EDIT_INTERVAL
+            try:
+                await processing_message.edit_text(preview)
+                shown = text.strip()
+            except RetryAfter as e:
+                next_edit = now + float(e.retry_after)
+            except BadRequest as e:
+                # e.g. "message is not modified"; the next edit will catch up
+                print(f"Stream edit skipped: {e}")
     except Exception as e:
-        error_msg = str(e)
-        if "quota exceeded" in error_msg.lower():
-            return False, "API quota exceeded"
-        return False, f"API error: {error_msg}"
+        if text.strip():
+            raise
+        print(f"Streaming failed, falling back to a regular request: {str(e)}")
+        return await complete_diagnosis(prompt, budget)
+    return text.strip()
+
+async def complete_diagnosis(prompt, budget):
+    """Complete the prompt through the gateway, or return the fallback text if no provider could answer"""
+    try:
+        return await llm_gateway.complete(prompt.user, prompt.system, budget)
+    except (CircuitOpenError, NoProviderAvailable, RetryableAPIError, TimeoutError) as e:
+        print(f"No provider answered, returning the fallback response: {str(e)}")
+        return FALLBACK_RESPONSE
+
+async def show_queue_position(processing_message, position):
+    """Tell a waiting patient their place in the diagnosis queue"""
+    await processing_message.edit_text(
+        "🔄 در حال تحلیل اطلاعات...\n"
+        f"⏳ نوبت شما در صف: {position}\n"
+        "لطفاً صبور باشید، به محض آزاد شدن ظرفیت بررسی آغاز می‌شود."
+    )
+
+async def request_diagnosis(processing_message, medical_report):
+    """Run one diagnosis request within its retry budget and return the validated text"""
+    # Call language model within one retry budget; retries happen only inside LLMs,
+    # so the whole diagnosis succeeds or fails within DIAGNOSIS_TOTAL_BUDGET seconds
+    budget = DIAGNOSIS_RETRY_POLICY.begin('diagnosis')
+    try:
+        if STREAM_DIAGNOSIS and not STRUCTURED_DIAGNOSIS:
+            diagnosis = stream_diagnosis(processing_message, medical_report, budget)
+        else:
+            diagnosis = complete_diagnosis(medical_report, budget)
+        ai_response = await asyncio.wait_for(diagnosis, timeout=budget.remaining())
+    except asyncio.TimeoutError:
+        budget.finish(False)
+        raise Exception("Diagnosis deadline exceeded")
+    except Exception:
+        budget.finish(False)
+        raise
+    valid = bool(ai_response and isinstance(ai_response, str) and len(ai_response) > 50)
+    budget.finish(valid and ai_response != FALLBACK_RESPONSE)
+    print(f"Diagnosis finished after {budget.attempts} attempt(s)")
+    if not valid:
+        print(f"Invalid response from AI model: {ai_response!r}")
+        raise Exception("Failed to get valid response from AI model")
+    return ai_response
+
+def diagnosis_cache_key(patient_data, user_data):
+    """Cache key for this intake, or None if it should not be cached"""
+    if not DIAGNOSIS_CACHE_SIZE:
+        return None
+    profile = canonical_profile(patient_data, user_data.get('patient_info', {}), DIAGNOSIS_CACHE_FREE_TEXT,
+                                mode='structured' if STRUCTURED_DIAGNOSIS else 'text', model=llm_gateway.signature())
+    return profile_key(profile) if profile else None
+
+async def diagnosis_in_progress(update, context):
+    """Answer this user's updates while their diagnosis is still running"""
+    text = (
+        "⏳ تحلیل اطلاعات شما هنوز در حال انجام است.\n"
+        "لطفاً تا دریافت نتیجه صبر کنید."
+    )
+    if update.callback_query:
+        await update.callback_query.answer(text)
+    elif update.message:
+        await update.message.reply_text(text)
 
 async def diagnose_disease(update, context):
-    """Enhanced disease diagnosis with better error handling"""
+    """Enhanced disease diagnosis with better error handling
+    
+    Runs as a non-blocking handler: other users' updates are processed while the model
+    answers. The intake is read before the first await so the run works on a fixed copy.
+    """
     user_response = update.message.text
     
     if user_response == 'خیر، فرآیند متوقف شود':
@@ -1124,12 +1251,17 @@ async def diagnose_disease(update, context):
     if user_response != 'بله، اطلاعات ارسال شود':
         return DIAGNOSE
 
+    patient_data = dict(context.user_data.get('patient_data', {}))
+    patient_info = dict(context.user_data.get('patient_info', {}))
+    intake = {'patient_info': patient_info}
+
     try:
         # Get user information
         user = update.message.from_user
         visit_timestamp = datetime.now()
-        visit_code = generate_visit_code(user.id, visit_timestamp)
-        visit_link = generate_visit_link(user.id, visit_timestamp)
+        visit_id = visit_ids.next_id()
+        visit_code = generate_visit_code(visit_id)
+        visit_link = generate_visit_link(visit_id)
         
         processing_message = await update.message.reply_text(
             "🔄 در حال تحلیل اطلاعات...\n"
@@ -1137,44 +1269,45 @@ async def diagnose_disease(update, context):
         )
         
         # Format medical report
-        patient_data = context.user_data.get('patient_data', {})
-        medical_report = format_medical_report(patient_data, context.user_data)
-        
-        # Debug log
-        print("Sending to AI model:", medical_report[:500] + "..." if len(medical_report) > 500 else medical_report)
+        medical_report = format_medical_report(patient_data, intake)
+        print(f"Diagnosis prompt: {medical_report.describe(PROMPT_MAX_INPUT_TOKENS)}")
         
         try:
-            # Call language model with retries
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    ai_response = call_language_model(medical_report)
-                    if ai_response and isinstance(ai_response, str) and len(ai_response) > 50:
-                        break
-                    print(f"Attempt {attempt + 1}: Invalid response from AI model")
-                    if attempt == max_retries - 1:
-                        raise Exception("Failed to get valid response from AI model")
-                except Exception as e:
-                    if attempt == max_retries - 1:
-                        raise
-                    print(f"Attempt {attempt + 1} failed: {str(e)}")
-                    await asyncio.sleep(2)  # Wait before retry
+            cache_key = diagnosis_cache_key(patient_data, intake)
+            ai_response = await asyncio.to_thread(diagnosis_cache.get, cache_key) if cache_key else None
+            if ai_response:
+                print("Diagnosis served from cache")
+            else:
+                ai_response = await llm_scheduler.run(
+                    lambda: request_diagnosis(processing_message, medical_report),
+                    PRIORITY_DIAGNOSIS,
+                    on_position=lambda position: show_queue_position(processing_message, position)
+                )
+
+                # Answers that mention the patient by name are not shared with other patients
+                name = str(patient_info.get('name', '')).strip()
+                if cache_key and ai_response != FALLBACK_RESPONSE and not (name and name in ai_response):
+                    await asyncio.to_thread(diagnosis_cache.put, cache_key, ai_response)
             
             if not ai_response:
                 raise Exception("No response received from AI model")
             
+            # Parsed once here; every later view reads the stored fields
+            diagnosis, diagnosis_fields = parse_diagnosis(ai_response)
+            
             # Save visit data
             visit_data = {
                 **patient_data,
-                'diagnosis': ai_response,
+                'diagnosis': diagnosis,
+                'diagnosis_fields': diagnosis_fields,
                 'visit_code': visit_code,
                 'visit_timestamp': visit_timestamp.isoformat(),
                 'visit_link': visit_link,
                 'user_id': user.id
             }
             
-            # Save to database
-            save_visit_to_database(patient_data, ai_response, visit_code, visit_timestamp, visit_link)
+            # Queue the visit for saving; the reply does not wait for the disk write
+            save_visit_to_database(patient_data, diagnosis, diagnosis_fields, visit_code, visit_timestamp, visit_link)
             
             # Delete processing message
             await processing_message.delete()
@@ -1182,7 +1315,7 @@ async def diagnose_disease(update, context):
             # Send formatted response
             response_message = (
                 "✅ تحلیل علائم انجام شد\n\n"
-                f"{ai_response}\n\n"
+                f"{diagnosis}\n\n"
                 "🔗 لینک اختصاصی این ویزیت:\n"
                 f"{visit_link}\n\n"
                 "⚠️ توجه مهم:\n"
@@ -1222,77 +1355,45 @@ async def diagnose_disease(update, context):
         )
         return GETTING_STARTED
 
-def extract_symptoms_from_answers(answers):
-    """Extract symptoms from answers for the diagnosis section."""
-    symptoms = []
-    for question, data in answers.items():
-        if isinstance(data, dict) and data.get('answer') == '✅':
-            symptoms.append(data.get('description', question))
-    return symptoms
-
-def write_symptoms_in_diagnosis_section(patient_data):
-    """Write symptoms in the diagnosis section."""
-    symptoms = extract_symptoms_from_answers(patient_data.get('answers', {}))
-    if symptoms:
-        return "🔍 علائم گزارش شده:\n" + "\n".join(f"• {symptom}" for symptom in symptoms)
-    return "🔍 علائم گزارش شده: هیچ علامتی گزارش نشده است."
-
 def format_medical_report(patient_data, user_data):
-    """Enhanced medical report formatting with structured sections"""
-    report = f"""بیمار جدید با مشخصات زیر:
-
-👤 اطلاعات پایه:
-نام: {user_data['patient_info'].get('name', 'نامشخص')}
-سن: {user_data['patient_info'].get('age', 'نامشخص')}
-جنسیت: {user_data['patient_info'].get('gender', 'نامشخص')}
-
-{write_symptoms_in_diagnosis_section(patient_data)}
-
-💭 توضیحات تکمیلی بیمار:
-{patient_data.get('extra_info', 'بدون توضیحات اضافی')}
-
-📚 سوابق پزشکی:
-"""
-    # Add symptoms with better structure
-    if patient_data.get('answers'):
-        for section, answers in patient_data['answers'].items():
-            if answers:  # Check if section has any answers
-                report += f"\n▫️ {section}:\n"
-                if isinstance(answers, list):
-                    for answer in answers:
-                        if isinstance(answer, dict) and answer.get('answer') == '✅':
-                            report += f"• {answer.get('description', '')}\n"
-                elif isinstance(answers, dict):
-                    report += f"• {answers.get('description', '')}\n"
-
-    # Add extra information if available
-    if patient_data.get('extra_info'):
-        report += f"\n💭 توضیحات تکمیلی بیمار:\n{patient_data['extra_info']}\n"
-
-    # Add medical history if available
-    if patient_data.get('medical_history'):
-        report += "\n📚 سوابق پزشکی:\n"
-        for category, data in patient_data['medical_history'].items():
-            if isinstance(data, dict) and data:
-                report += f"\n▫️ {category}:\n"
-                for key, value in data.items():
-                    if value and value not in ['-', 'ندارم']:
-                        report += f"• {value}\n"
-
-    # Add the system prompt at the end
-    report += f"\n\n{SYSTEM_PROMPT}\n"
-    return report
-
-def save_visit_to_database(patient_data, diagnosis, visit_code, visit_timestamp, visit_link):
-    """Save visit information to database with enhanced diagnosis storage"""
-    # Ensure the diagnosis is properly structured with recommendations
-    if not "توصیه‌های درمانی:" in diagnosis and not "توصیه‌ها:" in diagnosis:
-        # Add recommendations section if missing
-        diagnosis = diagnosis.rstrip() + "\n\nتوصیه‌های درمانی:\n" + extract_recommendations(diagnosis)
+    """Build the diagnosis prompt: SYSTEM_PROMPT once as the system message and each intake section once.
     
+    Medical history is trimmed first, then the patient's extra notes, when the prompt
+    is over PROMPT_MAX_INPUT_TOKENS; basic information and symptoms are kept.
+    """
+    patient_info = user_data.get('patient_info', {})
+    basic = [
+        f"نام: {patient_info.get('name', 'نامشخص')}",
+        f"سن: {patient_info.get('age', 'نامشخص')}",
+        f"جنسیت: {patient_info.get('gender', 'نامشخص')}"
+    ]
+
+    # Each category header and its items form one group, trimmed together
+    symptoms = [(f"▫️ {section}:", [f"• {description}" for description in checked])
+                for section, checked in checked_symptoms(patient_data.get('answers'))]
+    history = []
+    for category, data in (patient_data.get('medical_history') or {}).items():
+        if isinstance(data, dict):
+            values = [value for value in data.values() if value and value not in ['-', 'ندارم']]
+            history.append((f"▫️ {category}:", [f"• {value}" for value in values]))
+
+    no_symptoms = [] if symptoms else ["هیچ علامتی گزارش نشده است."]
+    symptom_lines = len(no_symptoms) + sum(1 + len(items) for _, items in symptoms)
+    extra_info = (patient_data.get('extra_info') or '').strip()
+    return diagnosis_prompt_builder.build([
+        PromptSection('basic', "بیمار جدید با مشخصات زیر:\n\n👤 اطلاعات پایه:", basic, priority=3, min_lines=len(basic)),
+        PromptSection('symptoms', "🔍 علائم گزارش شده:", no_symptoms, priority=2, min_lines=symptom_lines,
+                      groups=symptoms),
+        PromptSection('extra_info', "💭 توضیحات تکمیلی بیمار:", extra_info.splitlines(), priority=1),
+        PromptSection('medical_history', "📚 سوابق پزشکی:", priority=0, groups=history)
+    ])
+
+def save_visit_to_database(patient_data, diagnosis, diagnosis_fields, visit_code, visit_timestamp, visit_link):
+    """Save visit information to database with the diagnosis text and its parsed fields"""
     visit_data = {
         **patient_data,
         'diagnosis': diagnosis,
+        'diagnosis_fields': diagnosis_fields,
         'visit_code': visit_code,
         'visit_timestamp': visit_timestamp.isoformat(),
         'visit_link': visit_link,
@@ -1303,44 +1404,9 @@ def save_visit_to_database(patient_data, diagnosis, visit_code, visit_timestamp,
         }
     }
     
-    os.makedirs(DB_FOLDER, exist_ok=True)
-    file_path = os.path.join(DB_FOLDER, DB_FILE)
-    
-    try:
-        if not os.path.exists(file_path):
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump([visit_data], f, ensure_ascii=False, indent=2)
-        else:
-            with open(file_path, 'r+', encoding='utf-8') as f:
-                data = json.load(f)
-                data.append(visit_data)
-                f.seek(0)
-                f.truncate()
-                json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving to database: {str(e)}")
-        raise
-
-    # Update markdown file in parallel.
-    update_markdown_report(visit_data)
-
-def extract_recommendations(diagnosis):
-    """Extract or generate recommendations from diagnosis text"""
-    recommendations = []
-    
-    # Look for treatment-related keywords
-    keywords = ['درمان', 'دارو', 'توصیه', 'پیشنهاد', 'مصرف']
-    
-    for line in diagnosis.split('\n'):
-        for keyword in keywords:
-            if keyword in line and not any(rec in line for rec in recommendations):
-                recommendations.append(line.strip())
-                break
-    
-    if not recommendations:
-        recommendations.append("مراجعه به پزشک برای دریافت درمان مناسب")
-    
-    return "\n".join(f"• {rec}" for rec in recommendations)
+    # Hand the writes to the single persistence writer; the returned future resolves
+    # once the visit is durable, so callers only wait on disk if they need to.
+    return persistence_writer.submit_visit(visit_data)
 
 async def send_diagnosis_response(update, diagnosis, visit_link):
     """Send formatted diagnosis response to user"""
@@ -1653,29 +1719,8 @@ async def handle_version_selection(update, context):
                 reply_markup=ReplyKeyboardMarkup([['🔙 بازگشت به لیست ویزیت‌ها']], resize_keyboard=True)
             )
     elif choice == 'نسخه تجویز':
-        # Extract recommendations from diagnosis
-        diagnosis = selected_visit.get('diagnosis', '')
-        recommendations = []
-        
-        # Look for different recommendation sections
-        sections = [
-            ('توصیه‌های ایمن:', 'توصیه‌های درمانی:'),
-            ('توصیه‌های درمانی:', '⚠️'),
-            ('💊 توصیه‌ها:', '\n\n'),
-            ('توصیه‌ها:', '\n\n')
-        ]
-        
-        for start_marker, end_marker in sections:
-            if start_marker in diagnosis:
-                try:
-                    start_idx = diagnosis.index(start_marker) + len(start_marker)
-                    if end_marker in diagnosis[start_idx:]:
-                        end_idx = diagnosis.index(end_marker, start_idx)
-                        recommendation = diagnosis[start_idx:end_idx].strip()
-                        if recommendation:
-                            recommendations.append(recommendation)
-                except ValueError:
-                    continue
+        # Recommendations were parsed when the visit was saved
+        recommendations = visit_diagnosis_fields(selected_visit)['recommendations']
         
         prescription_text = (
             f"👨‍⚕️ نسخه تجویزی (کد ویزیت: {visit_code})\n"
@@ -1701,12 +1746,23 @@ async def handle_version_selection(update, context):
             reply_markup=ReplyKeyboardMarkup([['🔙 بازگشت به لیست ویزیت‌ها']], resize_keyboard=True)
         )
     
+    elif choice == '📄 دریافت فایل گزارش':
+        # Render the report on demand from the stored record (cached per visit)
+        report_html = render_report(selected_visit, 'html', report_cache)
+        await update.message.reply_document(
+            document=report_html.encode('utf-8'),
+            filename=f"{visit_code}.html",
+            caption=f"📄 گزارش ویزیت (کد ویزیت: {visit_code})",
+            reply_markup=ReplyKeyboardMarkup([['🔙 بازگشت به لیست ویزیت‌ها']], resize_keyboard=True)
+        )
+    
     else:
         await update.message.reply_text(
             "لطفاً یکی از گزینه‌های موجود را انتخاب کنید.",
             reply_markup=ReplyKeyboardMarkup([
                 ['نسخه تشخیص'],
                 ['نسخه تجویز'],
+                ['📄 دریافت فایل گزارش'],
                 ['🔙 بازگشت به لیست ویزیت‌ها']
             ], resize_keyboard=True)
         )
@@ -1721,14 +1777,8 @@ async def handle_visit_link(update, context):
         if len(command_parts) != 2:
             raise ValueError("Invalid visit link format")
             
-        # Extract and decode visit identifier
-        encoded_data = command_parts[1].replace('visit_', '')
-        padded_data = encoded_data + '=' * (-len(encoded_data) % 4)
-        decoded_data = base64.urlsafe_b64decode(padded_data).decode()
-        patient_id, date_time = decoded_data.split('-', 1)
-        
-        # Load visit details
-        visit = await get_visit_details(int(patient_id), date_time)
+        # Decode the visit identifier and load the visit from the index
+        visit = visit_repository.resolve_link(command_parts[1])
         if not visit:
             raise ValueError("Visit record not found")
 
@@ -1785,32 +1835,11 @@ def format_medical_info(visit):
     
     return info
 
-async def get_visit_details(user_id, timestamp):
-    """Retrieve visit details from database"""
-    if os.path.exists(os.path.join(DB_FOLDER, DB_FILE)):
-        try:
-            with open(os.path.join(DB_FOLDER, DB_FILE), 'r', encoding='utf-8') as f:
-                visits = json.load(f)
-                for visit in visits:
-                    if (visit.get('user_id') == user_id and 
-                        visit.get('visit_timestamp', '').startswith(timestamp)):
-                        return visit
-        except Exception as e:
-            print(f"Error reading visit database: {e}")
-    return None
-
 async def send_visit_details(update, visit_info):
     """Format and send visit information"""
     try:
         # Get patient info
-        patient_info = None
-        if os.path.exists(PATIENT_INFO_DB):
-            with open(PATIENT_INFO_DB, 'r', encoding='utf-8') as f:
-                patients = json.load(f)
-                patient_info = next(
-                    (p for p in patients if p['user_id'] == visit_info['user_id']),
-                    None
-                )
+        patient_info = persistence_writer.get_profile(visit_info['user_id'])
 
         # Format visit details
         visit_date = datetime.fromisoformat(visit_info['visit_timestamp']).strftime("%Y-%m-%d %H:%M")
@@ -1875,136 +1904,98 @@ async def send_visit_details(update, visit_info):
             reply_markup=ReplyKeyboardMarkup([['🔙 بازگشت به منوی اصلی']], resize_keyboard=True)
         )
 
-def update_markdown_report(visit_data):
-    """
-    Append visit report to markdown file.
-    The report includes:
-      - Visit Code & Timestamp
-      - Patient name
-      - Diagnosis details
-      - Prescription (extracted using recommendations markers)
-    """
-    # Use the correct reports folder path
-    reports_folder = r"C:\Users\Administrator\Desktop\Dr_Agent - With MistralAI\Database\reports"
-    os.makedirs(reports_folder, exist_ok=True)
-    
-    md_path = os.path.join(reports_folder, "visit_reports.md")
-    
-    try:
-        # Create file with header if it doesn't exist
-        if not os.path.exists(md_path):
-            with open(md_path, "w", encoding="utf-8") as md_file:
-                md_file.write("# Visit Reports Repository\n\n"
-                            "This file stores visit details including diagnosis and prescription data.\n\n"
-                            "---\n")
-        
-        # Extract age and gender ensuring complete patient data
-        age = visit_data.get('age') or visit_data.get('patient_info', {}).get('age', 'نامشخص')
-        gender = visit_data.get('gender') or visit_data.get('patient_info', {}).get('gender', 'نامشخص')
+async def set_llm_concurrency(update, context):
+    """Show or change how many LLM requests may run at once (admins only)"""
+    if update.message.from_user.id not in ADMIN_USER_IDS:
+        return
+    if context.args:
         try:
-            visit_date = datetime.fromisoformat(visit_data.get('visit_timestamp', '')).strftime("%Y-%m-%d %H:%M")
-        except:
-            visit_date = datetime.now().strftime("%Y-%m-%d %H:%M")
-            
-        # Create a detailed visit report entry including age and gender
-        report_entry = (
-            f"\n\n## Visit Report - {visit_data.get('visit_code', 'N/A')}\n"
-            f"**Date:** {visit_date}\n"
-            f"**Patient:** {visit_data.get('name', 'نامشخص')}\n"
-            f"**Gender:** {gender}\n"
-            f"**Age:** {age}\n\n"
-        )
-        
-        # Add symptoms section if available
-        symptoms_text = format_symptoms_for_markdown(visit_data.get('answers', {}))
-        if symptoms_text:
-            report_entry += f"### Symptoms\n{symptoms_text}\n\n"
-        
-        # Add additional information if available
-        extra_info = visit_data.get('extra_info')
-        if (extra_info):
-            report_entry += f"### Additional Information\n{extra_info}\n\n"
-        
-        # Add medical history if available
-        medical_history = visit_data.get('medical_history', {})
-        if medical_history:
-            report_entry += "### Medical History\n"
-            for category, data in medical_history.items():
-                if isinstance(data, dict) and data:
-                    report_entry += f"\n#### {category}\n"
-                    for key, value in data.items():
-                        if value and value not in ['-', 'ندارم']:
-                            report_entry += f"- {value}\n"
-            report_entry += "\n"
-        
-        # Extract prescription details from diagnosis
-        diagnosis = visit_data.get('diagnosis', '')
-        prescription = ""
-        
-        # Try different markers to extract prescription
-        markers = [
-            ('توصیه‌های درمانی:', '⚠️'),
-            ('توصیه‌های درمانی:', '\n\n'),
-            ('توصیه‌ها:', '\n\n'),
-            ('💊 توصیه‌ها:', '\n\n')
-        ]
-        
-        for start_marker, end_marker in markers:
-            if start_marker in diagnosis:
-                try:
-                    start_idx = diagnosis.index(start_marker) + len(start_marker)
-                    if end_marker in diagnosis[start_idx:]:
-                        end_idx = diagnosis.index(end_marker, start_idx)
-                        prescription = diagnosis[start_idx:end_idx].strip()
-                        break
-                except ValueError:
-                    continue
-        
-        # If no prescription found using markers, use recommendation extraction
-        if not prescription:
-            prescription = extract_recommendations(diagnosis)
-        
-        # Add diagnosis and prescription
-        report_entry += (
-            f"### Diagnosis\n{diagnosis}\n\n"
-            f"### Prescription\n{prescription}\n\n"
-            "---\n"
+            llm_scheduler.set_concurrency(int(context.args[0]))
+        except ValueError:
+            await update.message.reply_text("استفاده: /llm_concurrency <عدد>")
+            return
+    stats = llm_scheduler.snapshot()
+    await update.message.reply_text(
+        f"حداکثر درخواست همزمان: {stats['max_concurrency']}\n"
+        f"در حال اجرا: {stats['active']}\n"
+        f"در صف: {stats['waiting']}"
+    )
+
+async def show_llm_stats(update, context):
+    """Show the cached API health, per-provider gateway stats and the retry counters of every LLM operation since startup (admins only)"""
+    if update.message.from_user.id not in ADMIN_USER_IDS:
+        return
+    health = api_health.status()
+    health_icon = {True: "✅", False: "❌"}.get(health['healthy'], "❔")
+    await update.message.reply_text(
+        f"{health_icon} Mistral API: {health['message']}\n\n"
+        f"🔀 Providers:\n{format_gateway_stats(llm_gateway.snapshot())}\n\n"
+        f"📊 LLM retry stats:\n{retry_metrics.summary()}"
+    )
+
+def format_gateway_stats(stats):
+    """One line per gateway provider: availability, calls, error rate, median latency and time to first token"""
+    lines = []
+    for name, provider in stats.items():
+        latency = f"{provider['p50_latency']}s" if provider['p50_latency'] is not None else "-"
+        first_token = f"{provider['p50_first_token']}s" if provider['p50_first_token'] is not None else "-"
+        lines.append(
+            f"{'✅' if provider['available'] else '❌'} {name}: {provider['calls']} calls, "
+            f"{provider['error_rate']:.0%} errors, p50 {latency}, first token p50 {first_token}"
         )
-        
-        # Append the report to the file
-        with open(md_path, "a", encoding="utf-8") as md_file:
-            md_file.write(report_entry)
-            
-        print(f"Visit report successfully saved to {md_path}")
-        
-    except Exception as e:
-        print(f"Error updating markdown report: {e}")
-        # Create error log for debugging
-        error_log_path = os.path.join(reports_folder, "error_log.txt")
-        with open(error_log_path, "a", encoding="utf-8") as error_file:
-            error_file.write(f"\n[{datetime.now()}] Error: {str(e)}\n")
-            error_file.write(f"Failed visit code: {visit_data.get('visit_code', 'N/A')}\n")
-
-def format_symptoms_for_markdown(answers):
-    """Helper function to format symptoms for markdown, including all responses"""
-    if not answers:
-        return "No symptoms recorded."
-    
-    formatted_symptoms = []
-    for question, data in answers.items():
-        if isinstance(data, dict):
-            section = data.get('section', 'General')
-            description = data.get('description', question)
-            response = data.get('answer', '')
-            formatted_symptoms.append(f"- **{section}:** {description} → **{response}**")
-        else:
-            formatted_symptoms.append(f"- {question}: {data}")
-    
-    return "\n".join(formatted_symptoms)
+    return "\n".join(lines) or "-"
+
+async def on_startup(application):
+    """Warm up LLM connections and probe the API once, then start the persistence writer, health monitor and keep-alive pings"""
+    # The Telegram connection is already open: the application called getMe while initializing
+    await connection_warmer.warm_up()
+    # The first probe runs before any update is handled, so the health status is never read unchecked
+    await api_health.check_now()
+    persistence_writer.start()
+    api_health.start()
+    connection_warmer.start()
+
+async def on_shutdown(application):
+    """Flush queued writes and release pooled API connections before the bot exits"""
+    await persistence_writer.stop()
+    await api_health.stop()
+    await connection_warmer.stop()
+    await close_async_client()
+    print(f"Retry stats:\n{retry_metrics.summary()}")
+    print(f"Provider stats:\n{format_gateway_stats(llm_gateway.snapshot())}")
+    if completion_hedging.enabled:
+        print(f"Hedging stats: completions {completion_hedging.snapshot()}, streams {stream_hedging.snapshot()}")
+    diagnosis_cache.close()
 
 def main():
+    # Move visits from the legacy patients.json array into the configured storage (runs once)
+    storage.migrate_legacy(os.path.join(DB_FOLDER, DB_FILE))
+
+    # Optional archival export instead of running the bot:
+    #   python Dr_Agent.py --export-reports [output_folder]
+    if len(sys.argv) > 1 and sys.argv[1] == '--export-reports':
+        export_folder = sys.argv[2] if len(sys.argv) > 2 else os.path.join(REPORTS_FOLDER, 'archive')
+        counts = export_reports(storage.iter_visits(), export_folder)
+        print(f"Exported {sum(counts.values())} visit reports into {len(counts)} daily files in {export_folder}")
+        return
+
+    # Intake progress (user_data and conversation states) survives restarts; changed
+    # sessions are written in one batch every SESSION_FLUSH_INTERVAL seconds
+    session_persistence = SessionPersistence(
+        os.path.join(DB_FOLDER, SESSION_DB_FILE),
+        update_interval=float(os.getenv('SESSION_FLUSH_INTERVAL', 30))
+    )
+
     # Build application using ApplicationBuilder
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(TELEGRAM_CONNECTION_POOL_SIZE)
+        .persistence(session_persistence)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[
@@ -2016,9 +2007,11 @@ def main():
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_start_choice)
             ],
             VIEW_HISTORY: [
+                CallbackQueryHandler(handle_history_page, pattern=r'^hist_'),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_visit_selection)
             ],
             SELECT_VISIT_VERSION: [
+                CallbackQueryHandler(handle_history_page, pattern=r'^hist_'),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_version_selection)
             ],
             GET_NAME: [
@@ -2066,8 +2059,13 @@ def main():
             GET_MEDICAL_HISTORY: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, save_medical_history_answer)
             ],
+            # Non-blocking: a diagnosis no longer holds up every other user's updates.
+            # While it runs, this user's conversation is pending and their updates go to WAITING.
             DIAGNOSE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, diagnose_disease)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, diagnose_disease, block=False)
+            ],
+            ConversationHandler.WAITING: [
+                TypeHandler(Update, diagnosis_in_progress)
             ],
             SECTION_CHECK: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_section_check)
@@ -2076,10 +2074,14 @@ def main():
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_question_answer)
             ],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='dr_agent_conversation',
+        persistent=True
     )
 
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('llm_concurrency', set_llm_concurrency))
+    application.add_handler(CommandHandler('llm_stats', show_llm_stats))
     
     # Add handler for visit links
     application.add_handler(MessageHandler(
@@ -1,43 +1,139 @@
 import os
 import json
-from dotenv import load_dotenv
-import requests
 import time
-from typing import Tuple
-import backoff
-import urllib3
+import asyncio
+import httpx
+from typing import AsyncIterator, Dict, Optional, Tuple
 
-# Load environment variables securely to decouple configuration from code.
-# This aids in maintaining environment-specific settings and supports the twelve-factor app methodology.
-load_dotenv()
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from hedging import HedgePolicy, hedged_call, hedged_stream
+from latency import AdaptiveTimeouts, ConnectTimer
+from prompt_builder import estimate_tokens
+from rate_limiter import RateLimiter
+from retry_policy import RetryBudget, RetryPolicy
+
+# Configuration comes from the environment. Each bot loads its own .env before importing this module,
+# so a shared module never picks up another bot's keys.
 MISTRAL_API_KEY = os.getenv('MISTRAL_API_KEY')
 MISTRAL_API_BASE = os.getenv('MISTRAL_API_BASE', 'https://api.mistral.ai')
 MISTRAL_API_VERSION = "v1"
+MISTRAL_MODEL = "mistral-medium"  # Align with defined model archetypes for consistent AI performance.
 MISTRAL_API_ENDPOINT = f"{MISTRAL_API_BASE}/{MISTRAL_API_VERSION}/chat/completions"
+# Lightweight endpoint used for health probes: it checks reachability and the key without generating tokens.
+MISTRAL_MODELS_ENDPOINT = f"{MISTRAL_API_BASE}/{MISTRAL_API_VERSION}/models"
 
 # Configure optional proxies if defined, ensuring flexible network routing and compliance with corporate security policies.
 HTTP_PROXY = os.getenv('HTTP_PROXY')
 HTTPS_PROXY = os.getenv('HTTPS_PROXY')
 
-# Initialize a persistence-enabled session object to facilitate connection reuse and integrated retry policies.
-# This aligns with efficient resource management and minimizes overhead in network calls.
-session = requests.Session()
-if HTTP_PROXY or HTTPS_PROXY:
-    session.proxies = {
-        'http': HTTP_PROXY,
-        'https': HTTPS_PROXY
-    }
+# Model calls expected in flight at once (the bot's LLM_MAX_CONCURRENCY); the connection pool is sized from it.
+EXPECTED_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 4))
+# Connection pool limits for the shared async client. Every diagnosis reuses pooled
+# keep-alive connections instead of paying a TCP/TLS handshake per request.
+# Hedging can double the requests in flight, and the health probe needs one more.
+MAX_CONNECTIONS = int(os.getenv('MISTRAL_MAX_CONNECTIONS', EXPECTED_CONCURRENCY * 2 + 1))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('MISTRAL_MAX_KEEPALIVE_CONNECTIONS', EXPECTED_CONCURRENCY + 1))
+# Seconds an idle pooled connection stays open; httpx's default of 5s drops the pool between bursts.
+KEEPALIVE_EXPIRY = float(os.getenv('MISTRAL_KEEPALIVE_EXPIRY', 120))
+
+# HTTP statuses worth retrying with backoff (previously handled by the urllib3 retry adapter).
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# The single retry/deadline policy for model calls (LLM_TOTAL_BUDGET, LLM_MAX_ATTEMPTS, LLM_ATTEMPT_TIMEOUT,
+# LLM_CONNECT_TIMEOUT, LLM_BASE_DELAY, LLM_MAX_DELAY, LLM_MIN_ATTEMPT_TIME; defaults 120s / 3 / 90s / 15s).
+# Callers start one budget per logical call and pass it down, so retries never multiply across layers.
+DEFAULT_RETRY_POLICY = RetryPolicy.from_env()
+
+# Circuit breaker in front of the Mistral endpoint. While it is open, requests fail in microseconds with
+# CircuitOpenError and callers serve FALLBACK_RESPONSE instead of walking every patient through the retry budget.
+# MISTRAL_BREAKER_SLOW_CALL_SECONDS applies to a stream's time to first token only: a completion's duration grows
+# with its length, so completions are judged on errors and timeouts alone.
+mistral_breaker = CircuitBreaker(
+    "mistral",
+    window=int(os.getenv('MISTRAL_BREAKER_WINDOW', 20)),
+    min_calls=int(os.getenv('MISTRAL_BREAKER_MIN_CALLS', 5)),
+    failure_rate=float(os.getenv('MISTRAL_BREAKER_FAILURE_RATE', 0.5)),
+    slow_call_seconds=float(os.getenv('MISTRAL_BREAKER_SLOW_CALL_SECONDS', 30)),
+    open_seconds=float(os.getenv('MISTRAL_BREAKER_OPEN_SECONDS', 30))
+)
 
-# Define a retry strategy using urllib3 to handle transient HTTP errors robustly.
-# This strategy ensures graceful degradation under load and mitigates issues from intermittent connectivity.
-retry_strategy = urllib3.util.Retry(
-    total=3,
-    backoff_factor=1,
-    status_forcelist=[429, 500, 502, 503, 504]
+# Client-side rate limits, so bursts queue here (in arrival order) instead of turning into a storm of 429s.
+# Each request reserves its estimated prompt size plus max_tokens; limits reported in response headers take over.
+mistral_rate_limiter = RateLimiter(
+    requests_per_second=float(os.getenv('MISTRAL_REQUESTS_PER_SECOND', 1)),
+    tokens_per_minute=float(os.getenv('MISTRAL_TOKENS_PER_MINUTE', 500000))
 )
-adapter = requests.adapters.HTTPAdapter(max_retries=retry_strategy)
-session.mount("http://", adapter)
-session.mount("https://", adapter)
+
+# Optional request hedging (LLM_HEDGING=true): if a request has not answered - or a stream has not produced its first
+# token - after LLM_HEDGE_DELAY seconds (default: the LLM_HEDGE_PERCENTILE of recent latencies), an identical second
+# request is sent and the first to succeed wins. Hedges cost extra tokens; snapshot() reports how often they fire and win.
+def _hedge_policy() -> HedgePolicy:
+    return HedgePolicy(
+        enabled=os.getenv('LLM_HEDGING', 'false').lower() in ('1', 'true', 'yes'),
+        delay=float(os.environ['LLM_HEDGE_DELAY']) if os.getenv('LLM_HEDGE_DELAY') else None,
+        percentile=float(os.getenv('LLM_HEDGE_PERCENTILE', 95))
+    )
+
+
+# Completions and streams are tracked separately: full response time vs. time to first token.
+completion_hedging = _hedge_policy()
+stream_hedging = _hedge_policy()
+
+# Timeouts learned from observed latencies instead of one fixed value for every request: the LLM_TIMEOUT_PERCENTILE of
+# recent completion times (time to first token for streams) for the same model, prompt size and max_tokens, times
+# LLM_TIMEOUT_MARGIN. A stuck request is abandoned after a few typical durations rather than the whole attempt timeout,
+# leaving budget for a retry. Learned values only ever shorten the RetryBudget's timeouts, never extend them, so the
+# overall deadline holds; calls that timed out count as samples at the timeout that fired, so they raise the estimate.
+adaptive_timeouts = AdaptiveTimeouts(
+    percentile=float(os.getenv('LLM_TIMEOUT_PERCENTILE', 99)),
+    margin=float(os.getenv('LLM_TIMEOUT_MARGIN', 1.5)),
+    min_samples=int(os.getenv('LLM_TIMEOUT_MIN_SAMPLES', 20)),
+    min_read=float(os.getenv('LLM_TIMEOUT_MIN_READ', 10)),
+    min_connect=float(os.getenv('LLM_TIMEOUT_MIN_CONNECT', 2))
+)
+
+# One AsyncClient per event loop: httpx clients are bound to the loop they were first used
+# on, so the bot's loop and the short-lived loops of the sync wrapper each get their own pool.
+_async_clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+
+
+class RetryableAPIError(Exception):
+    """A transient failure (timeout, connection error, 429/5xx, garbled body) worth another attempt."""
+
+
+def _build_async_client() -> httpx.AsyncClient:
+    mounts = {}
+    if HTTP_PROXY:
+        mounts["http://"] = httpx.AsyncHTTPTransport(proxy=httpx.Proxy(HTTP_PROXY))
+    if HTTPS_PROXY:
+        mounts["https://"] = httpx.AsyncHTTPTransport(proxy=httpx.Proxy(HTTPS_PROXY))
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY
+        ),
+        mounts=mounts or None
+    )
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Return the pooled client for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        # Drop clients of loops that no longer run so their pools can be collected.
+        for stale_loop in [l for l in _async_clients if l.is_closed()]:
+            del _async_clients[stale_loop]
+        client = _async_clients[loop] = _build_async_client()
+    return client
+
+
+async def close_async_client() -> None:
+    """Close the running loop's client; call on shutdown to release pooled connections."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
 
 # Establish a detailed system prompt to direct the AI's clinical responses.
 # This design encourages consistency in diagnostic recommendations by aligning the model with domain-specific best practices.
@@ -60,77 +156,142 @@ SYSTEM_PROMPT = """شما یک پزشک متخصص هستید که باید با
 ⚠️ هشدارها:
 [در صورت وجود علائم خطرناک یا نیاز به مراجعه فوری به پزشک]"""
 
-# Apply the exponential backoff design pattern to manage transient failures.
-# This decorator ensures that retry attempts are spaced exponentially, reducing the risk of overwhelming the API service.
-@backoff.on_exception(
-    backoff.expo,
-    (requests.exceptions.RequestException, json.JSONDecodeError),
-    max_tries=5,
-    max_time=120
-)
-def make_api_request(headers: dict, data: dict, timeout: int = 90):
-    """Perform an API call with integrated error handling and retry logic.
+# A single attempt: retries are driven by the caller's RetryBudget, which bounds both the number of attempts
+# and the total time across every layer, instead of each layer retrying on its own schedule.
+async def make_api_request(headers: dict, data: dict, timeout: float = 90, connect_timeout: float = 15) -> dict:
+    """Perform one API call with integrated error handling.
     
     This abstraction facilitates robust external integrations by capturing common I/O exceptions and providing
-    insightful error messages that simplify downstream troubleshooting.
+    insightful error messages that simplify downstream troubleshooting. Transient failures raise
+    :class:`RetryableAPIError` so the caller can decide, within its budget, whether another attempt fits.
     """
+    reserved = await _admit(data)
+    prompt_tokens = _prompt_tokens(data)
+    connect_timeout, timeout = adaptive_timeouts.timeouts(
+        data["model"], prompt_tokens, data["max_tokens"], connect_timeout, timeout
+    )
+    started = time.monotonic()
+    healthy = False
+    cancelled = False
     try:
-        response = session.post(
-            MISTRAL_API_ENDPOINT,
-            headers=headers,
-            json=data,
-            timeout=(15, timeout)
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.Timeout:
-        # Indicates potential network latency or server-side slowness. Consider reviewing infrastructure if frequent.
-        raise Exception("درخواست با تاخیر مواجه شد - لطفاً مجدداً تلاش کنید")
-    except requests.exceptions.ConnectionError:
-        # Highlights possible connectivity issues; ensure network availability or proxy configurations.
-        raise Exception("خطای اتصال - لطفاً اتصال اینترنت خود را بررسی کنید")
-    except requests.exceptions.HTTPError as e:
-        # Handle specific HTTP errors to offer precise feedback and control application flow.
-        if response.status_code == 401:
-            raise Exception("کلید API نامعتبر است") from e
-        elif response.status_code == 429:
-            raise Exception("محدودیت تعداد درخواست. لطفاً چند دقیقه صبر کنید") from e
-        elif response.status_code >= 500:
-            raise Exception("خطای سرور Mistral AI") from e
+        try:
+            response = await get_async_client().post(
+                MISTRAL_API_ENDPOINT,
+                headers=headers,
+                json=data,
+                timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                extensions={"trace": _connect_timer(data["model"]).trace}
+            )
+        except httpx.TransportError as e:
+            _record_timeout(e, data["model"], data["model"], prompt_tokens, data["max_tokens"], connect_timeout, timeout)
+            raise _transport_error(e) from e
+        # Any answer other than a transient error shows the endpoint is up, even a 401 or other 4xx.
+        healthy = response.status_code not in RETRYABLE_STATUS_CODES
+        _check_status(response)
+        try:
+            result = response.json()
+        except json.JSONDecodeError as e:
+            healthy = False
+            raise RetryableAPIError("پاسخ نامعتبر از سرور Mistral AI") from e
+        used = (result.get('usage') or {}).get('total_tokens') if isinstance(result, dict) else None
+        if used:
+            mistral_rate_limiter.refund(reserved - used)
+        elapsed = time.monotonic() - started
+        completion_hedging.tracker.record(elapsed)
+        adaptive_timeouts.record_read(data["model"], prompt_tokens, data["max_tokens"], elapsed)
+        return result
+    except asyncio.CancelledError:
+        # Cancelled (deadline hit or a hedge won): neither a success nor a failure.
+        cancelled = True
         raise
-    except Exception as e:
-        # Fallback for all unexpected exceptions; log details may be required for post-mortem debugging.
-        raise Exception(f"خطای غیرمنتظره: {str(e)}")
+    finally:
+        # No duration: a long completion is not a slow endpoint, and a hung one ends in a (failed) timeout
+        if cancelled:
+            mistral_breaker.cancel()
+        else:
+            mistral_breaker.record(healthy)
 
-def call_language_model(prompt: str, max_retries: int = 3, retry_delay: int = 2) -> str:
-    """Engage the Mistral AI API with meticulous error management and retry schemes.
-    
-    This function encapsulates the full interaction lifecycle with the external API, including fallback logic that
-    maintains service continuity when facing repeated transient failures.
-    """
-    
-    if not MISTRAL_API_KEY:
-        return "خطا: کلید API یافت نشد"
 
-    headers = {
+async def _admit(data: dict) -> int:
+    """Pass the circuit breaker, then wait for the rate limiter; return the tokens reserved for the request."""
+    # The breaker goes first: an open circuit fails without queueing, and a half-open probe is rate limited too.
+    if not mistral_breaker.allow():
+        raise CircuitOpenError("سرویس Mistral AI موقتاً در دسترس نیست")
+    reserved = _prompt_tokens(data) + data["max_tokens"]
+    try:
+        await mistral_rate_limiter.acquire(reserved)
+    except BaseException:
+        # Never sent: give a half-open probe slot back
+        mistral_breaker.cancel()
+        raise
+    return reserved
+
+
+def _prompt_tokens(data: dict) -> int:
+    return estimate_tokens(" ".join(m["content"] for m in data["messages"]))
+
+
+def _connect_timer(model: str) -> ConnectTimer:
+    """Trace hook feeding the handshake time of newly opened connections into the learned connect timeout."""
+    return ConnectTimer(lambda seconds: adaptive_timeouts.record_connect(model, seconds))
+
+
+def _record_timeout(error: httpx.TransportError, model: str, timeout_key: str, prompt_tokens: int, max_tokens: int,
+                    connect_timeout: float, timeout: float) -> None:
+    """Count a timed-out call as a sample at the timeout that fired; its real latency was at least that."""
+    if isinstance(error, httpx.ConnectTimeout):
+        adaptive_timeouts.record_connect(model, connect_timeout)
+    elif isinstance(error, httpx.ReadTimeout):
+        adaptive_timeouts.record_read(timeout_key, prompt_tokens, max_tokens, timeout)
+
+
+def _transport_error(error: httpx.TransportError) -> RetryableAPIError:
+    if isinstance(error, httpx.TimeoutException):
+        # Indicates potential network latency or server-side slowness. Consider reviewing infrastructure if frequent.
+        return RetryableAPIError("درخواست با تاخیر مواجه شد - لطفاً مجدداً تلاش کنید")
+    # Highlights possible connectivity issues; ensure network availability or proxy configurations.
+    return RetryableAPIError("خطای اتصال - لطفاً اتصال اینترنت خود را بررسی کنید")
+
+
+def _check_status(response: httpx.Response) -> None:
+    # Learn the server's actual limits (and any Retry-After) before judging the status.
+    mistral_rate_limiter.update_from_headers(response.headers)
+    # Handle specific HTTP errors to offer precise feedback and control application flow.
+    if response.status_code == 401:
+        raise Exception("کلید API نامعتبر است")
+    elif response.status_code == 429:
+        raise RetryableAPIError("محدودیت تعداد درخواست. لطفاً چند دقیقه صبر کنید")
+    elif response.status_code in RETRYABLE_STATUS_CODES:
+        raise RetryableAPIError("خطای سرور Mistral AI")
+    elif response.status_code >= 400:
+        raise Exception(f"خطای غیرمنتظره: HTTP {response.status_code}")
+
+
+def _request_headers(accept: str = "application/json") -> dict:
+    return {
         "Authorization": f"Bearer {MISTRAL_API_KEY}",
         "Content-Type": "application/json",
-        "Accept": "application/json"
+        "Accept": accept
     }
-    
-    data = {
-        "model": "mistral-medium",  # Align with defined model archetypes for consistent AI performance.
+
+
+def _chat_payload(prompt: str, stream: bool = False, system_prompt: Optional[str] = None,
+                  max_tokens: int = 2000, temperature: float = 0.7) -> dict:
+    return {
+        "model": MISTRAL_MODEL,
         "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
+            # Exactly one system message: the caller's own prompt replaces the default rather than adding to it.
+            {"role": "system", "content": system_prompt or SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
-        "temperature": 0.7,
-        "max_tokens": 2000,
-        "stream": False
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": stream
     }
 
-    # Predefine a fallback response to ensure system responsiveness even when the external service fails repeatedly.
-    fallback_response = """
+
+# Predefine a fallback response to ensure system responsiveness even when the external service fails repeatedly.
+FALLBACK_RESPONSE = """
 📋 تشخیص احتمالی:
 به دلیل اختلال در ارتباط با سرور، امکان تشخیص دقیق وجود ندارد.
 
@@ -144,32 +305,139 @@ def call_language_model(prompt: str, max_retries: int = 3, retry_delay: int = 2)
 این پاسخ موقت است و جایگزین مشاوره پزشکی نیست.
 """
 
-    for attempt in range(max_retries):
+
+async def mistral_complete(prompt: str, timeout: float, connect_timeout: float = 15, system_prompt: Optional[str] = None,
+                           max_tokens: int = 2000, temperature: float = 0.7) -> str:
+    """One completion attempt (hedged when enabled) that returns the text or raises; retries are up to the caller."""
+    data = _chat_payload(prompt, system_prompt=system_prompt, max_tokens=max_tokens, temperature=temperature)
+    response_data = await hedged_call(
+        completion_hedging,
+        lambda: make_api_request(_request_headers(), data, timeout, connect_timeout)
+    )
+    if 'choices' in response_data:
+        content = response_data['choices'][0]['message']['content'].strip()
+        if content:
+            return content
+    # Alert on schema mismatch and potential API changes.
+    raise RetryableAPIError("قالب پاسخ Mistral AI نامعتبر است")
+
+
+async def mistral_stream(prompt: str, timeout: float, connect_timeout: float = 15, system_prompt: Optional[str] = None,
+                         max_tokens: int = 2000, temperature: float = 0.7) -> AsyncIterator[str]:
+    """One streaming attempt (hedged when enabled) yielding text deltas."""
+    payload = _chat_payload(prompt, stream=True, system_prompt=system_prompt, max_tokens=max_tokens, temperature=temperature)
+    async for delta in hedged_stream(stream_hedging, lambda: _stream_once(payload, timeout, connect_timeout)):
+        yield delta
+
+
+async def _stream_once(payload: dict, timeout: float, connect_timeout: float) -> AsyncIterator[str]:
+    """One streaming request, admitted by the rate limiter and circuit breaker."""
+    await _admit(payload)
+    # Streams learn their time to first token, which is what the read timeout bounds before any text arrives.
+    timeout_key = f"{payload['model']}:stream"
+    prompt_tokens = _prompt_tokens(payload)
+    connect_timeout, timeout = adaptive_timeouts.timeouts(
+        timeout_key, prompt_tokens, payload["max_tokens"], connect_timeout, timeout
+    )
+    started = time.monotonic()
+    healthy = False
+    cancelled = False
+    recorded = False
+    completed = False
+
+    try:
+        async with get_async_client().stream(
+            "POST",
+            MISTRAL_API_ENDPOINT,
+            headers=_request_headers("text/event-stream"),
+            json=payload,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            extensions={"trace": _connect_timer(payload["model"]).trace}
+        ) as response:
+            healthy = response.status_code not in RETRYABLE_STATUS_CODES
+            _check_status(response)
+            # Server-sent events: one "data: <json chunk>" line per event, terminated by "data: [DONE]".
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = line[len("data:"):].strip()
+                if event == "[DONE]":
+                    completed = True
+                    return
+                choices = json.loads(event).get("choices") or []
+                if choices:
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        if not recorded:
+                            recorded = True
+                            first_token = time.monotonic() - started
+                            mistral_breaker.record(True, first_token)
+                            stream_hedging.tracker.record(first_token)
+                            adaptive_timeouts.record_read(timeout_key, prompt_tokens, payload["max_tokens"], first_token)
+                        yield delta
+    except httpx.TransportError as e:
+        if not recorded:
+            _record_timeout(e, payload["model"], timeout_key, prompt_tokens, payload["max_tokens"], connect_timeout, timeout)
+        raise _transport_error(e) from e
+    except (asyncio.CancelledError, GeneratorExit):
+        cancelled = True
+        raise
+    finally:
+        if cancelled and not recorded:
+            mistral_breaker.cancel(time.monotonic() - started)
+        elif not recorded:
+            mistral_breaker.record(healthy and completed, time.monotonic() - started)
+
+
+async def probe_api_health(timeout: float = 10) -> Tuple[bool, str]:
+    """Single cheap request that tells whether the API is reachable and the key is accepted.
+    
+    Lists the available models instead of running a completion, so a probe costs no tokens; there are no retries,
+    and it bypasses the rate limiter and circuit breaker so it can observe recovery independently of patient traffic.
+    """
+    if not MISTRAL_API_KEY:
+        return False, "API key missing"
+    try:
+        response = await get_async_client().get(
+            MISTRAL_MODELS_ENDPOINT,
+            headers=_request_headers(),
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 5))
+        )
+    except httpx.TransportError as e:
+        return False, f"API unreachable: {type(e).__name__}"
+    if response.status_code == 200:
+        return True, "API available"
+    if response.status_code == 401:
+        return False, "API key rejected"
+    if response.status_code == 429:
+        # Throttled but answering: completions will be queued by the rate limiter, not refused.
+        return True, "API available (rate limited)"
+    return False, f"API returned HTTP {response.status_code}"
+
+
+# Gateway used by the sync wrapper, built on first use (llm_gateway itself imports this module).
+_script_gateway = None
+
+
+def call_language_model(prompt: str, budget: Optional[RetryBudget] = None, system_prompt: Optional[str] = None) -> str:
+    """Synchronous wrapper around the LLM gateway for scripts and tests.
+    
+    Runs one gateway completion (LLM_PROVIDERS, with failover and one retry budget) on a private event loop and
+    closes that loop's connection pool afterwards; returns FALLBACK_RESPONSE if no provider answers.
+    Must not be called from inside a running event loop; async code should await the gateway directly.
+    """
+    global _script_gateway
+    if _script_gateway is None:
+        from llm_gateway import create_gateway
+        _script_gateway = create_gateway()
+
+    async def _run() -> str:
         try:
-            print(f"Making API request attempt {attempt + 1}")  # Log attempt to support traceability.
-            response_data = make_api_request(headers, data)
-            
-            if 'choices' in response_data:
-                content = response_data['choices'][0]['message']['content'].strip()
-                if content:
-                    return content
-                
-            print(f"Invalid response format on attempt {attempt + 1}")  # Alert on schema mismatch and potential API changes.
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay * (attempt + 1))  # Exponential delay integration enhances overall system stability.
-                continue
-                
+            return await _script_gateway.complete(prompt, system_prompt=system_prompt, budget=budget)
         except Exception as e:
-            print(f"Error on attempt {attempt + 1}: {str(e)}")  # Error logging for operational diagnostics.
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            elif "Invalid API key" in str(e):
-                return "خطا: کلید API نامعتبر است"
-            elif "Rate limit exceeded" in str(e):
-                return "خطا: محدودیت تعداد درخواست. لطفاً چند دقیقه صبر کنید"
-            elif "server error" in str(e):
-                return "خطا: سرور Mistral AI در دسترس نیست"
-            
-    # Return the predefined fallback response after all retry attempts have been exhausted.
-    return fallback_response
+            print(f"Language model call failed: {str(e)}")
+            return FALLBACK_RESPONSE
+        finally:
+            await close_async_client()
+
+    return asyncio.run(_run())
@@ -0,0 +1,112 @@
+import time
+import threading
+from collections import deque
+from typing import Dict
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit is open."""
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker driven by the error rate and latency of recent calls.
+
+    The last ``window`` calls are kept; once at least ``min_calls`` are recorded and the
+    share of failed or slow (longer than ``slow_call_seconds``) calls reaches
+    ``failure_rate``, the circuit opens and :meth:`allow` refuses calls for
+    ``open_seconds``. After that, up to ``half_open_probes`` calls are let through;
+    if they all succeed the circuit closes again, a single failure re-opens it.
+    A call cancelled before it had an outcome is reported with :meth:`cancel` instead.
+    """
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                 slow_call_seconds: float = 30.0, open_seconds: float = 30.0, half_open_probes: int = 1):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window)  # True for a failed or slow call
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_started = 0
+        self._probes_passed = 0
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._advance()
+            return self._state
+
+    def allow(self) -> bool:
+        """Return True if a call may go ahead (counting it as a probe when half-open)."""
+        with self._lock:
+            self._advance()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes_started < self.half_open_probes:
+                self._probes_started += 1
+                return True
+            self._rejected += 1
+            return False
+
+    def record(self, succeeded: bool, duration: float = 0.0) -> None:
+        """Record the outcome of a call that :meth:`allow` let through."""
+        bad = not succeeded or duration > self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if bad:
+                    self._open()
+                else:
+                    self._probes_passed += 1
+                    if self._probes_passed >= self.half_open_probes:
+                        print(f"Circuit '{self.name}' closed")
+                        self._state = CLOSED
+                        self._calls.clear()
+                return
+            if self._state == OPEN:
+                return
+            self._calls.append(bad)
+            if len(self._calls) >= self.min_calls and sum(self._calls) / len(self._calls) >= self.failure_rate:
+                self._open()
+
+    def cancel(self, duration: float = 0.0) -> None:
+        """Account for a call that :meth:`allow` let through but that was cancelled before it finished.
+
+        A call that had already been running longer than ``slow_call_seconds`` counts as slow.
+        Otherwise it says nothing about the dependency: it is not recorded, and when
+        half-open its probe slot is released so another call can probe instead.
+        """
+        if duration > self.slow_call_seconds:
+            self.record(False, duration)
+            return
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes_started > self._probes_passed:
+                self._probes_started -= 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            self._advance()
+            return {
+                'state': self._state,
+                'recent_calls': len(self._calls),
+                'recent_failures': sum(self._calls),
+                'rejected': self._rejected
+            }
+
+    def _open(self) -> None:
+        print(f"Circuit '{self.name}' opened for {self.open_seconds:.0f}s")
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+
+    def _advance(self) -> None:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_started = 0
+            self._probes_passed = 0
@@ -0,0 +1,77 @@
+import time
+import asyncio
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+
+class ConnectionWarmer:
+    """Opens pooled connections before the first request needs them and keeps them from going cold.
+
+    :meth:`warm_up` resolves each URL's host and opens ``connections`` connections to it
+    with concurrent HEAD requests; any HTTP status will do, only the connection matters.
+    After :meth:`start`, the same pings run every ``interval`` seconds so that neither the
+    pool's keep-alive expiry nor the server's idle timeout closes them between bursts.
+    """
+
+    def __init__(self, client_factory: Callable[[], httpx.AsyncClient], urls: List[str],
+                 connections: int = 2, interval: float = 30, timeout: float = 5):
+        self.client_factory = client_factory
+        self.urls = urls
+        self.connections = max(1, connections)
+        self.interval = interval
+        self.timeout = timeout
+        self._task: Optional[asyncio.Task] = None
+
+    async def warm_up(self) -> Dict[str, Optional[float]]:
+        """Resolve and connect to every URL; returns the seconds each took, or None if it failed."""
+        results = await asyncio.gather(*(self._warm(url) for url in self.urls))
+        warmed = dict(zip(self.urls, results))
+        for url, seconds in warmed.items():
+            if seconds is None:
+                print(f"Connection warm-up failed for {url}")
+            else:
+                print(f"Opened {self.connections} connection(s) to {url} in {seconds:.2f}s")
+        return warmed
+
+    def start(self) -> None:
+        if self._task is None and self.interval > 0 and self.urls:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _warm(self, url: str) -> Optional[float]:
+        started = time.monotonic()
+        parts = urlsplit(url)
+        try:
+            await asyncio.get_running_loop().getaddrinfo(
+                parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+            )
+        except OSError as e:
+            print(f"Could not resolve {parts.hostname}: {str(e)}")
+            return None
+        if not await self._ping(url):
+            return None
+        return time.monotonic() - started
+
+    async def _ping(self, url: str) -> bool:
+        client = self.client_factory()
+        results = await asyncio.gather(
+            *(client.head(url, timeout=self.timeout) for _ in range(self.connections)),
+            return_exceptions=True
+        )
+        return any(isinstance(result, httpx.Response) for result in results)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            for url in self.urls:
+                await self._ping(url)
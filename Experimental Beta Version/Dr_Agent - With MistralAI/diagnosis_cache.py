@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+DIAGNOSIS_CACHE_FILE = "diagnosis_cache.sqlite3"
+
+# How free-text answers (extra info, typed medical history) affect caching
+FREE_TEXT_BYPASS = 'bypass'  # intakes with any free text are never cached
+FREE_TEXT_IGNORE = 'ignore'  # free text is left out of the key
+FREE_TEXT_MODES = (FREE_TEXT_BYPASS, FREE_TEXT_IGNORE)
+
+# Answers that mean "nothing to report"
+EMPTY_ANSWERS = ('', '-', 'ندارم', 'بدون توضیحات اضافی')
+
+# Bump when the profile layout (or the prompt it feeds) changes so old entries stop matching
+PROFILE_VERSION = 3
+
+CHECKED = '✅'
+
+
+def checked_symptoms(answers) -> List[Tuple[str, List[str]]]:
+    """``(section, descriptions)`` of the answered-yes symptoms, in intake order.
+
+    The diagnosis prompt and the cache key both read the intake through this, so a
+    symptom is in the key exactly when the model is told about it.
+    """
+    checked = []
+    for section, section_answers in (answers or {}).items():
+        if isinstance(section_answers, list):
+            descriptions = [answer.get('description', '') for answer in section_answers
+                            if isinstance(answer, dict) and answer.get('answer') == CHECKED]
+        elif isinstance(section_answers, dict) and section_answers.get('answer') == CHECKED:
+            descriptions = [section_answers.get('description', section)]
+        else:
+            descriptions = []
+        if descriptions:
+            checked.append((section, descriptions))
+    return checked
+
+
+def _checked_symptoms(answers) -> List[List[str]]:
+    symptoms = set()
+    for section, descriptions in checked_symptoms(answers):
+        for description in descriptions:
+            symptoms.add((str(section), ' '.join(str(description).split())))
+    return [list(symptom) for symptom in sorted(symptoms)]
+
+
+def _free_text(patient_data: Dict) -> List[str]:
+    texts = [patient_data.get('extra_info') or '']
+    for data in (patient_data.get('medical_history') or {}).values():
+        if isinstance(data, dict):
+            texts.extend(str(value) for value in data.values() if value)
+    return [text.strip() for text in texts if text and text.strip() not in EMPTY_ANSWERS]
+
+
+def canonical_profile(patient_data: Dict, patient_info: Dict, free_text: str = FREE_TEXT_BYPASS,
+                      mode: str = 'text', model: str = '') -> Optional[Dict]:
+    """Reduce an intake to what the diagnosis depends on, or None if it must not be cached.
+
+    The name is left out and checked symptoms are sorted. The exact age is kept, since the
+    prompt (and so the answer) states it. ``mode`` (free text or structured output) and
+    ``model`` (the providers and models that answer) are part of the key as well.
+    """
+    if free_text not in FREE_TEXT_MODES:
+        raise ValueError(f"Unknown free-text mode '{free_text}', expected one of {FREE_TEXT_MODES}")
+    if free_text == FREE_TEXT_BYPASS and _free_text(patient_data):
+        return None
+
+    age = patient_info.get('age', patient_data.get('age'))
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        age = str(age)
+    return {
+        'version': PROFILE_VERSION,
+        'mode': mode,
+        'model': model,
+        'age': age,
+        'gender': str(patient_info.get('gender', patient_data.get('gender', ''))),
+        'symptoms': _checked_symptoms(patient_data.get('answers'))
+    }
+
+
+def profile_key(profile: Dict) -> str:
+    """Stable hash of a canonical profile."""
+    encoded = json.dumps(profile, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class DiagnosisCache:
+    """LRU + TTL cache of diagnoses keyed by :func:`profile_key`, with an optional SQLite tier.
+
+    The memory tier holds at most ``max_entries`` diagnoses. With ``path`` set, every
+    stored diagnosis is also written to disk, so entries survive restarts and memory
+    misses fall back to the disk before the model is called. Each entry counts its hits;
+    counts are written back to disk when the entry leaves memory and on :meth:`close`.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 7 * 24 * 3600, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry['created'] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None and self.path:
+                entry = self._load(key, now)
+                if entry is not None:
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry['hits'] += 1
+            self.hits += 1
+            return entry['diagnosis']
+
+    def put(self, key: str, diagnosis: str) -> None:
+        entry = {'diagnosis': diagnosis, 'created': time.time(), 'hits': 0}
+        with self._lock:
+            self._remember(key, entry)
+            self.stores += 1
+            if self.path:
+                with self._db():
+                    self._db().execute(
+                        "INSERT OR REPLACE INTO diagnoses (key, diagnosis, created, hits) VALUES (?, ?, ?, 0)",
+                        (key, diagnosis, entry['created']))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'stores': self.stores}
+
+    def entry_stats(self, limit: int = 10) -> List[Dict]:
+        """The most-hit entries in memory, most hits first."""
+        with self._lock:
+            ranked = sorted(self._entries.items(), key=lambda item: item[1]['hits'], reverse=True)[:limit]
+            return [{'key': key, 'hits': entry['hits'], 'created': entry['created']} for key, entry in ranked]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.executemany("UPDATE diagnoses SET hits = ? WHERE key = ?",
+                                           [(entry['hits'], key) for key, entry in self._entries.items()])
+                self._conn.close()
+                self._conn = None
+
+    def _remember(self, key: str, entry: Dict) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            if self.path:
+                with self._db():
+                    self._db().execute("UPDATE diagnoses SET hits = ? WHERE key = ?", (evicted['hits'], evicted_key))
+
+    def _load(self, key: str, now: float) -> Optional[Dict]:
+        row = self._db().execute("SELECT diagnosis, created, hits FROM diagnoses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl:
+            with self._db():
+                self._db().execute("DELETE FROM diagnoses WHERE key = ?", (key,))
+            return None
+        return {'diagnosis': row[0], 'created': row[1], 'hits': row[2]}
+
+    def _db(self) -> sqlite3.Connection:
+        # Opened on first use so constructing the cache never touches the disk
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS diagnoses ("
+                "key TEXT PRIMARY KEY, diagnosis TEXT NOT NULL, created REAL NOT NULL, hits INTEGER NOT NULL)")
+            self._conn.commit()
+        return self._conn
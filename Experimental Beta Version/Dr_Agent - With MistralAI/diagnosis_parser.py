@@ -0,0 +1,205 @@
+import re
+import json
+from typing import Dict, List, Optional, Tuple
+
+SOURCE_JSON = 'json'
+SOURCE_TEXT = 'text'
+
+URGENCY_LEVELS = ('low', 'medium', 'high')
+URGENCY_LABELS = {'low': 'کم', 'medium': 'متوسط', 'high': 'بالا'}
+# Persian (and common English) spellings the model uses for each urgency level
+URGENCY_ALIASES = {
+    'low': 'low', 'کم': 'low', 'پایین': 'low',
+    'medium': 'medium', 'moderate': 'medium', 'متوسط': 'medium',
+    'high': 'high', 'بالا': 'high', 'زیاد': 'high', 'emergency': 'high', 'اورژانسی': 'high'
+}
+
+# Appended to the system prompt in structured mode; replaces the free-text response template
+STRUCTURED_OUTPUT_INSTRUCTIONS = """
+Output format:
+Ignore the Response Template above and reply with one JSON object only, without markdown fences or any text around it:
+{"differential": [{"condition": "...", "reason": "..."}], "urgency": "low" | "medium" | "high", "urgency_reason": "...", "explanation": "...", "recommendations": ["..."], "warnings": ["..."]}
+List 3-5 conditions, most likely first. Put emergency actions and escalation triggers in "warnings". Write every text value in Persian.
+"""
+
+# Section titles of the free-text templates (Dr_Agent and LLMs prompts), without spaces or ZWNJ, by field
+SECTION_TITLES = (
+    ('differential', ('تشخیص',)),
+    ('urgency', ('سطحفوریت', 'فوریت')),
+    ('recommendations', ('توصیه',)),
+    ('warnings', ('هشدار', 'اقداماتاضطراری')),
+    ('explanation', ('توضیحات',))
+)
+
+# Lines that mention treatment, used when a free-text answer has no recommendations section
+TREATMENT_KEYWORDS = ('درمان', 'دارو', 'توصیه', 'پیشنهاد', 'مصرف')
+DEFAULT_RECOMMENDATION = "مراجعه به پزشک برای دریافت درمان مناسب"
+
+DISCLAIMER = "⚠️ هشدار: این تحلیل جایگزین تشخیص پزشکی نیست. برای ارزیابی دقیق به پزشک یا بیمارستان مراجعه نمایید."
+
+# Emoji, numbering and markdown in front of a section title
+_HEADER_PREFIX = re.compile(r'^[\W\d_]*')
+_BULLET = re.compile(r'^\s*(?:[-•*+▫️]|[\d۰-۹]+[.)\-]|\[\s*\])+\s*')
+
+
+def parse_diagnosis(response: str) -> Tuple[str, Dict]:
+    """Parse a model response once into ``(display text, fields)``.
+
+    A JSON response is validated and rendered into the usual Persian layout; anything
+    else is kept as written and split into fields by its section headings. The fields
+    are ``source``, ``differential`` (``condition``/``reason`` dicts), ``urgency``
+    (one of :data:`URGENCY_LEVELS` or None), ``urgency_reason``, ``explanation``,
+    ``recommendations`` and ``warnings``.
+    """
+    response = (response or '').strip()
+    try:
+        fields = parse_structured(response)
+    except ValueError:
+        return response, parse_free_text(response)
+    return render_diagnosis(fields), fields
+
+
+def parse_structured(response: str) -> Dict:
+    """Validate a JSON diagnosis and return its fields; raises ValueError if it does not fit the schema."""
+    start, end = response.find('{'), response.rfind('}')
+    if start < 0 or end < start:
+        raise ValueError("no JSON object in response")
+    try:
+        data = json.loads(response[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise ValueError("response is not a JSON object")
+
+    differential = []
+    for item in data.get('differential') or []:
+        if isinstance(item, str):
+            item = {'condition': item}
+        if not isinstance(item, dict) or not str(item.get('condition') or '').strip():
+            raise ValueError("differential entries need a condition")
+        differential.append({'condition': str(item['condition']).strip(), 'reason': str(item.get('reason') or '').strip()})
+    if not differential:
+        raise ValueError("differential is empty")
+
+    urgency = data.get('urgency')
+    if urgency is not None:
+        urgency = URGENCY_ALIASES.get(str(urgency).strip().lower())
+        if urgency is None:
+            raise ValueError(f"unknown urgency {data.get('urgency')!r}")
+
+    return {
+        'source': SOURCE_JSON,
+        'differential': differential,
+        'urgency': urgency,
+        'urgency_reason': str(data.get('urgency_reason') or '').strip(),
+        'explanation': str(data.get('explanation') or '').strip(),
+        'recommendations': _string_list(data.get('recommendations'), 'recommendations') or [DEFAULT_RECOMMENDATION],
+        'warnings': _string_list(data.get('warnings'), 'warnings')
+    }
+
+
+def parse_free_text(text: str) -> Dict:
+    """Split a free-text diagnosis into fields by its section headings (one pass over the lines)."""
+    sections: Dict[str, List[str]] = {}
+    current: Optional[str] = None
+    for line in text.splitlines():
+        # The disclaimer starts with "هشدار" but is not one of the model's warnings
+        if line.strip() == DISCLAIMER:
+            continue
+        field, rest = _section_header(line)
+        if field:
+            current = field
+            line = rest
+        item = _BULLET.sub('', line).strip()
+        # Sub-labels such as "داروها:" group items but are not items themselves
+        if current and item and not item.endswith((':', '：')):
+            sections.setdefault(current, []).append(item)
+
+    urgency, urgency_reason = None, ''
+    for line in sections.get('urgency', []):
+        level = _urgency_in(line)
+        if level and urgency is None:
+            urgency = level
+        urgency_reason = (urgency_reason + ' ' + line).strip()
+
+    recommendations = sections.get('recommendations') or _treatment_lines(text) or [DEFAULT_RECOMMENDATION]
+    return {
+        'source': SOURCE_TEXT,
+        'differential': [_condition(line) for line in sections.get('differential', [])],
+        'urgency': urgency,
+        'urgency_reason': urgency_reason,
+        'explanation': '\n'.join(sections.get('explanation', [])),
+        'recommendations': recommendations,
+        'warnings': sections.get('warnings', [])
+    }
+
+
+def render_diagnosis(fields: Dict) -> str:
+    """Render fields in the layout of the free-text template, for patients and stored reports."""
+    lines = ["۱. تشخیص‌های احتمالی:"]
+    for item in fields['differential']:
+        lines.append(f"• {item['condition']}: {item['reason']}" if item['reason'] else f"• {item['condition']}")
+    if fields.get('explanation'):
+        # Under its own heading, so the rendered text parses back into the same fields
+        lines += ["", "توضیحات:", fields['explanation']]
+    if fields.get('urgency'):
+        urgency = URGENCY_LABELS[fields['urgency']]
+        lines += ["", "۲. سطح فوریت:", f"{urgency} - {fields['urgency_reason']}" if fields.get('urgency_reason') else urgency]
+    lines += ["", "۳. توصیه‌های ایمن:"] + [f"• {item}" for item in fields['recommendations']]
+    if fields.get('warnings'):
+        lines += ["", "۴. اقدامات اضطراری:"] + [f"• {item}" for item in fields['warnings']]
+    lines += ["", DISCLAIMER]
+    return "\n".join(lines)
+
+
+def visit_diagnosis_fields(visit: Dict) -> Dict:
+    """The parsed fields of a visit; visits saved before fields were stored are parsed once and keep the result."""
+    fields = visit.get('diagnosis_fields')
+    if fields is None:
+        fields = visit['diagnosis_fields'] = parse_diagnosis(visit.get('diagnosis') or '')[1]
+    return fields
+
+
+def _string_list(value, name: str) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"{name} must be a list of strings")
+    return [item.strip() for item in value if item.strip()]
+
+
+def _section_header(line: str) -> Tuple[Optional[str], str]:
+    """``(field, text after the heading)`` if the line opens a section, else ``(None, line)``."""
+    heading = _HEADER_PREFIX.sub('', line.strip()).replace('：', ':')
+    title, colon, rest = heading.partition(':')
+    # Without a colon only a short bare heading counts, so sentences starting with e.g. "توصیه" stay content
+    if (not colon and len(title) > 30) or len(title) > 40:
+        return None, line
+    title = re.sub(r'[\s\u200c*#]', '', title)
+    for field, prefixes in SECTION_TITLES:
+        if title.startswith(prefixes):
+            return field, rest.strip()
+    return None, line
+
+
+def _condition(line: str) -> Dict:
+    condition, _, reason = line.partition(':')
+    return {'condition': condition.strip(), 'reason': reason.strip()}
+
+
+def _urgency_in(line: str) -> Optional[str]:
+    for word in re.findall(r'\w+', line.lower()):
+        if word in URGENCY_ALIASES:
+            return URGENCY_ALIASES[word]
+    return None
+
+
+def _treatment_lines(text: str) -> List[str]:
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line and line not in lines and any(keyword in line for keyword in TREATMENT_KEYWORDS):
+            lines.append(line)
+    return lines
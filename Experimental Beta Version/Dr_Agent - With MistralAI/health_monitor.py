@@ -0,0 +1,62 @@
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+Probe = Callable[[], Awaitable[Tuple[bool, str]]]
+
+
+class HealthMonitor:
+    """Runs a cheap probe every ``interval`` seconds and caches the last result.
+
+    Handlers read :meth:`status` (a dictionary lookup, never a network call), so no
+    user request waits on a health check. Until the first probe finishes the status
+    is unknown: ``healthy`` is None rather than False.
+    """
+
+    def __init__(self, probe: Probe, interval: float = 60):
+        self.probe = probe
+        self.interval = interval
+        self._status: Dict = {'healthy': None, 'message': 'not checked yet', 'checked_at': None, 'latency': None}
+        self._task: Optional[asyncio.Task] = None
+
+    def status(self) -> Dict:
+        """Last probe result: ``healthy``, ``message``, ``checked_at`` (epoch seconds) and ``latency``."""
+        return self._status
+
+    def start(self) -> None:
+        """Probe every ``interval`` seconds; the first probe runs right away unless :meth:`check_now` already ran."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def check_now(self) -> Dict:
+        started = time.monotonic()
+        try:
+            healthy, message = await self.probe()
+        except Exception as e:
+            healthy, message = False, f"probe failed: {str(e)}"
+        if healthy != self._status['healthy'] and self._status['checked_at'] is not None:
+            print(f"API health changed: {'healthy' if healthy else 'unhealthy'} ({message})")
+        # Replaced as a whole so readers never see a half-updated status
+        self._status = {
+            'healthy': healthy,
+            'message': message,
+            'checked_at': time.time(),
+            'latency': round(time.monotonic() - started, 3)
+        }
+        return self._status
+
+    async def _run(self) -> None:
+        if self._status['checked_at'] is None:
+            await self.check_now()
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check_now()
@@ -0,0 +1,154 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+from latency import LatencyTracker
+
+T = TypeVar('T')
+
+
+class HedgePolicy:
+    """When to fire a second, identical request, and how often that paid off.
+
+    The hedge delay is ``delay`` if given; otherwise the ``percentile`` of recent
+    latencies once ``min_samples`` are known, and ``initial_delay`` before that.
+    """
+
+    def __init__(self, enabled: bool = False, delay: Optional[float] = None, percentile: float = 95,
+                 initial_delay: float = 10.0, min_samples: int = 20, tracker: Optional[LatencyTracker] = None):
+        self.enabled = enabled
+        self.delay = delay
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+
+    def hedge_delay(self) -> float:
+        if self.delay is not None:
+            return self.delay
+        if len(self.tracker) >= self.min_samples:
+            return self.tracker.percentile(self.percentile)
+        return self.initial_delay
+
+    def snapshot(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'hedge_delay': round(self.hedge_delay(), 3),
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'hedge_rate': round(self.hedged / self.requests, 3) if self.requests else 0.0,
+            'hedge_wins': self.hedge_wins,
+            'primary_wins': self.primary_wins
+        }
+
+
+async def _cancel(task: asyncio.Future) -> None:
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+
+
+async def hedged_call(policy: HedgePolicy, call: Callable[[], Awaitable[T]]) -> T:
+    """Await ``call()``; if it is still running after the hedge delay, race it against a second call.
+
+    The first call to succeed wins and the other is cancelled. A call that fails does not
+    end the race while the other one may still succeed.
+    """
+    if not policy.enabled:
+        return await call()
+    policy.requests += 1
+    primary = asyncio.ensure_future(call())
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=policy.hedge_delay())
+    except asyncio.CancelledError:
+        await _cancel(primary)
+        raise
+    if done:
+        return primary.result()
+
+    policy.hedged += 1
+    print(f"Hedging request after {policy.hedge_delay():.1f}s")
+    secondary = asyncio.ensure_future(call())
+    pending = {primary, secondary}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is secondary:
+                        policy.hedge_wins += 1
+                    else:
+                        policy.primary_wins += 1
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in pending:
+            await _cancel(task)
+
+
+async def hedged_stream(policy: HedgePolicy, open_stream: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+    """Like :func:`hedged_call` for streams: the stream that produces its first item first wins."""
+    if not policy.enabled:
+        async for item in open_stream():
+            yield item
+        return
+
+    async def first_item(stream):
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    policy.requests += 1
+    streams = {}
+    primary_stream = open_stream()
+    primary = asyncio.ensure_future(first_item(primary_stream))
+    streams[primary] = primary_stream
+    winner, error = None, None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=policy.hedge_delay())
+        if done:
+            winner = primary
+        else:
+            policy.hedged += 1
+            print(f"Hedging stream after {policy.hedge_delay():.1f}s without a first token")
+            secondary_stream = open_stream()
+            secondary = asyncio.ensure_future(first_item(secondary_stream))
+            streams[secondary] = secondary_stream
+            pending = {primary, secondary}
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is secondary:
+                            policy.hedge_wins += 1
+                        else:
+                            policy.primary_wins += 1
+                        break
+                    error = error or task.exception()
+    finally:
+        for task, stream in streams.items():
+            if task is not winner:
+                await _cancel(task)
+                await stream.aclose()
+
+    if winner is None:
+        raise error
+    first = winner.result()
+    stream = streams[winner]
+    try:
+        if first is None:
+            return
+        yield first
+        async for item in stream:
+            yield item
+    finally:
+        await stream.aclose()
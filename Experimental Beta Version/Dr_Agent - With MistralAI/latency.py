@@ -0,0 +1,131 @@
+import time
+import threading
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+# Upper bounds (estimated prompt tokens) of the prompt-size buckets; larger prompts share the last bucket
+PROMPT_SIZE_BUCKETS = (250, 500, 1000, 2000, 4000, 8000)
+
+
+class LatencyTracker:
+    """Sliding window of recent latencies with percentile lookups."""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(percent / 100 * len(samples))) - 1))
+        return samples[index]
+
+
+def prompt_size_bucket(tokens: int) -> int:
+    for bound in PROMPT_SIZE_BUCKETS:
+        if tokens <= bound:
+            return bound
+    return PROMPT_SIZE_BUCKETS[-1] + 1
+
+
+class AdaptiveTimeouts:
+    """Connect and read timeouts learned from observed latencies.
+
+    Read latencies are kept per ``(model, prompt-size bucket, max_tokens)``, connect
+    times per model. A timeout is the ``percentile`` of its samples times ``margin``,
+    never below the floors; until ``min_samples`` are known the caller's timeout applies.
+    The caller's timeout (what is left of its retry budget) is never exceeded, floors
+    included. While a size bucket is still sparse, the history for the model and
+    ``max_tokens`` across all prompt sizes is used, since output length dominates
+    generation time.
+
+    Calls that time out are recorded as samples equal to the timeout that fired (the
+    true latency is at least that), so a model that slows down past its learned timeout
+    pushes the timeout back up instead of only ever being measured on the calls that made it.
+    """
+
+    def __init__(self, percentile: float = 99, margin: float = 1.5, min_samples: int = 20,
+                 min_read: float = 10.0, min_connect: float = 2.0):
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.min_read = min_read
+        self.min_connect = min_connect
+        self._read: Dict[tuple, LatencyTracker] = {}
+        self._connect: Dict[str, LatencyTracker] = {}
+        self._lock = threading.Lock()
+
+    def record_read(self, model: str, prompt_tokens: int, max_tokens: int, seconds: float) -> None:
+        for key in ((model, prompt_size_bucket(prompt_tokens), max_tokens), (model, max_tokens)):
+            self._tracker(self._read, key).record(seconds)
+
+    def record_connect(self, model: str, seconds: float) -> None:
+        self._tracker(self._connect, model).record(seconds)
+
+    def timeouts(self, model: str, prompt_tokens: int, max_tokens: int,
+                 default_connect: float, default_read: float) -> Tuple[float, float]:
+        """``(connect, read)`` for a request; learned values only ever shorten the defaults."""
+        read_floor = min(self.min_read, default_read)
+        read = self._learned(self._read.get((model, prompt_size_bucket(prompt_tokens), max_tokens)), read_floor)
+        if read is None:
+            read = self._learned(self._read.get((model, max_tokens)), read_floor)
+        connect = self._learned(self._connect.get(model), min(self.min_connect, default_connect))
+        return (min(default_connect, connect) if connect else default_connect,
+                min(default_read, read) if read else default_read)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            read = dict(self._read)
+            connect = dict(self._connect)
+        stats: Dict[str, Dict] = {}
+        for key, tracker in read.items():
+            if len(key) == 3:
+                stats.setdefault(key[0], {})[f"read<={key[1]}t/{key[2]}"] = self._learned(tracker, self.min_read)
+        for model, tracker in connect.items():
+            stats.setdefault(model, {})['connect'] = self._learned(tracker, self.min_connect)
+        return stats
+
+    def _tracker(self, trackers: Dict, key) -> LatencyTracker:
+        with self._lock:
+            tracker = trackers.get(key)
+            if tracker is None:
+                tracker = trackers[key] = LatencyTracker()
+            return tracker
+
+    def _learned(self, tracker: Optional[LatencyTracker], floor: float) -> Optional[float]:
+        if tracker is None or len(tracker) < self.min_samples:
+            return None
+        return max(floor, tracker.percentile(self.percentile) * self.margin)
+
+
+class ConnectTimer:
+    """httpcore trace hook that reports how long opening a new connection (TCP + TLS) took.
+
+    Pass ``{"trace": timer.trace}`` as request extensions. Requests that reuse a pooled
+    keep-alive connection open none and report nothing.
+    """
+
+    def __init__(self, on_connect):
+        self.on_connect = on_connect
+        self._started: Optional[float] = None
+        self._connected: Optional[float] = None
+
+    async def trace(self, event_name: str, info: dict) -> None:
+        if event_name == 'connection.connect_tcp.started':
+            self._started = time.monotonic()
+        elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            self._connected = time.monotonic()
+        elif event_name.endswith('send_request_headers.started') and self._started is not None:
+            # The connection is fully set up once the first request goes out on it
+            if self._connected is not None:
+                self.on_connect(self._connected - self._started)
+            self._started = None
@@ -0,0 +1,318 @@
+import os
+import time
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+import LLMs
+from LLMs import RETRYABLE_STATUS_CODES, RetryableAPIError, get_async_client
+from circuit_breaker import OPEN, CircuitBreaker, CircuitOpenError
+from latency import LatencyTracker
+from retry_policy import RetryBudget, RetryPolicy
+
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta')
+GEMINI_SAFETY_CATEGORIES = (
+    'HARM_CATEGORY_HARASSMENT',
+    'HARM_CATEGORY_HATE_SPEECH',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT',
+    'HARM_CATEGORY_DANGEROUS_CONTENT'
+)
+
+# Latency assumed for a provider that has not answered yet when ranking providers
+DEFAULT_LATENCY = 5.0
+
+
+class NoProviderAvailable(Exception):
+    """Every configured provider is unavailable (open circuit) or already failed this call."""
+
+
+class LLMProvider:
+    """One model API behind the gateway.
+
+    ``complete`` and ``stream`` make a single attempt and raise on failure; retries and
+    failover belong to :class:`LLMGateway`. Providers without native streaming yield the
+    whole completion as one chunk.
+    """
+
+    name = 'provider'
+    # Model that answers, so callers can tell answers of different models apart
+    model = ''
+    # Endpoint the bot pre-connects to at startup; None for providers without one
+    base_url: Optional[str] = None
+
+    def available(self) -> bool:
+        return True
+
+    async def complete(self, prompt: str, system_prompt: Optional[str], timeout: float, connect_timeout: float,
+                       max_tokens: int, temperature: float) -> str:
+        raise NotImplementedError
+
+    async def stream(self, prompt: str, system_prompt: Optional[str], timeout: float, connect_timeout: float,
+                     max_tokens: int, temperature: float) -> AsyncIterator[str]:
+        yield await self.complete(prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature)
+
+
+class MistralProvider(LLMProvider):
+    """Mistral through LLMs: shared connection pool, rate limiter, circuit breaker and hedging."""
+
+    name = 'mistral'
+    model = LLMs.MISTRAL_MODEL
+    base_url = LLMs.MISTRAL_API_BASE
+
+    def available(self) -> bool:
+        return bool(LLMs.MISTRAL_API_KEY) and LLMs.mistral_breaker.state != OPEN
+
+    async def complete(self, prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature):
+        return await LLMs.mistral_complete(prompt, timeout, connect_timeout, system_prompt, max_tokens, temperature)
+
+    async def stream(self, prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature):
+        async for delta in LLMs.mistral_stream(prompt, timeout, connect_timeout, system_prompt, max_tokens, temperature):
+            yield delta
+
+
+class GeminiProvider(LLMProvider):
+    """Google Gemini over its REST API, on the same pooled HTTP client as Mistral."""
+
+    name = 'gemini'
+    base_url = GEMINI_API_BASE
+
+    def __init__(self, api_key: Optional[str] = None, model: Optional[str] = None, top_p: float = 0.9):
+        self.api_key = api_key or os.getenv('GEMINI_API_KEY')
+        self.model = model or os.getenv('GEMINI_MODEL', 'gemini-pro')
+        self.top_p = top_p
+        self.breaker = CircuitBreaker('gemini')
+
+    def available(self) -> bool:
+        return bool(self.api_key) and self.breaker.state != OPEN
+
+    async def complete(self, prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature):
+        if not self.breaker.allow():
+            raise CircuitOpenError("Gemini circuit is open")
+        # gemini-pro has no system role, so the instructions lead the user turn (as the Co-Ai bot always did)
+        text = f"{system_prompt}\n{prompt}" if system_prompt else prompt
+        payload = {
+            'contents': [{'role': 'user', 'parts': [{'text': text}]}],
+            'generationConfig': {'temperature': temperature, 'topP': self.top_p, 'maxOutputTokens': max_tokens},
+            'safetySettings': [{'category': category, 'threshold': 'BLOCK_MEDIUM_AND_ABOVE'}
+                               for category in GEMINI_SAFETY_CATEGORIES]
+        }
+        healthy = False
+        cancelled = False
+        try:
+            try:
+                response = await get_async_client().post(
+                    f"{GEMINI_API_BASE}/models/{self.model}:generateContent",
+                    headers={'x-goog-api-key': self.api_key, 'Content-Type': 'application/json'},
+                    json=payload,
+                    timeout=httpx.Timeout(timeout, connect=connect_timeout)
+                )
+            except httpx.TransportError as e:
+                raise RetryableAPIError(f"Gemini connection error: {type(e).__name__}") from e
+            healthy = response.status_code not in RETRYABLE_STATUS_CODES
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                raise RetryableAPIError(f"Gemini returned HTTP {response.status_code}")
+            if response.status_code >= 400:
+                raise Exception(f"Gemini returned HTTP {response.status_code}")
+            candidates = response.json().get('candidates') or []
+            parts = (candidates[0].get('content') or {}).get('parts') or [] if candidates else []
+            content = "".join(part.get('text', '') for part in parts).strip()
+            if not content:
+                # Usually a safety block; another provider may still answer
+                raise Exception("Empty response from Gemini")
+            return content
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # Judged on errors and timeouts only, since a completion's duration grows with its length
+            if cancelled:
+                self.breaker.cancel()
+            else:
+                self.breaker.record(healthy)
+
+
+class MockProvider(LLMProvider):
+    """Local stand-in that answers after ``latency`` seconds; for development without API keys."""
+
+    name = 'mock'
+    model = 'mock'
+
+    def __init__(self, latency: float = 0.2, response: Optional[str] = None):
+        self.latency = latency
+        self.response = response
+
+    async def complete(self, prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature):
+        await asyncio.sleep(min(self.latency, timeout))
+        return self.response or f"[mock] {prompt[:200]}"
+
+    async def stream(self, prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature):
+        text = await self.complete(prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature)
+        for start in range(0, len(text), 40):
+            yield text[start:start + 40]
+
+
+PROVIDERS = {'mistral': MistralProvider, 'gemini': GeminiProvider, 'mock': MockProvider}
+
+
+class LLMGateway:
+    """Routes completions to the best available provider and fails over to the others.
+
+    Providers are ranked by their median latency, inflated by their recent error rate;
+    providers whose circuit is open are skipped. Completions are ranked on full completion
+    time and streams on time to first token, each tracked separately. One :class:`RetryBudget` covers the
+    whole call: a failed attempt moves on to the next provider, and when every provider
+    has been tried the round starts again while the budget allows.
+    """
+
+    def __init__(self, providers: List[LLMProvider], retry_policy: Optional[RetryPolicy] = None,
+                 error_window: int = 20):
+        if not providers:
+            raise ValueError("LLMGateway needs at least one provider")
+        self.providers = providers
+        self.retry_policy = retry_policy or LLMs.DEFAULT_RETRY_POLICY
+        self._latency = {provider.name: LatencyTracker(window=100) for provider in providers}
+        self._first_token = {provider.name: LatencyTracker(window=100) for provider in providers}
+        self._outcomes = {provider.name: deque(maxlen=error_window) for provider in providers}
+        self._calls = {provider.name: 0 for provider in providers}
+
+    def ranked(self, streaming: bool = False) -> List[LLMProvider]:
+        """Available providers, best first (configured order breaks ties)."""
+        trackers = self._first_token if streaming else self._latency
+        scored = []
+        for index, provider in enumerate(self.providers):
+            if not provider.available():
+                continue
+            latency = trackers[provider.name].percentile(50) or DEFAULT_LATENCY
+            outcomes = self._outcomes[provider.name]
+            error_rate = outcomes.count(False) / len(outcomes) if outcomes else 0.0
+            scored.append((latency * (1 + 4 * error_rate), index, provider))
+        return [provider for _, _, provider in sorted(scored, key=lambda item: item[:2])]
+
+    async def complete(self, prompt: str, system_prompt: Optional[str] = None, budget: Optional[RetryBudget] = None,
+                       max_tokens: int = 2000, temperature: float = 0.7) -> str:
+        own_budget = budget is None
+        if own_budget:
+            budget = self.retry_policy.begin('gateway_complete')
+        error: Optional[Exception] = None
+        # Providers that failed in a way a retry will not fix (bad key, refused content)
+        excluded = set()
+        try:
+            while True:
+                providers = [provider for provider in self.ranked() if provider.name not in excluded]
+                if not providers:
+                    raise error or NoProviderAvailable("No LLM provider available")
+                for provider in providers:
+                    try:
+                        timeout = budget.start_attempt()
+                    except TimeoutError:
+                        raise error or NoProviderAvailable("Retry budget exhausted")
+                    started = time.monotonic()
+                    try:
+                        content = await provider.complete(prompt, system_prompt, timeout, budget.connect_timeout(timeout),
+                                                          max_tokens, temperature)
+                    except CircuitOpenError as e:
+                        error = error or e
+                        continue
+                    except Exception as e:
+                        self._record(provider, False)
+                        print(f"{provider.name} attempt {budget.attempts} failed: {str(e)}")
+                        error = e
+                        if not isinstance(e, RetryableAPIError):
+                            excluded.add(provider.name)
+                        continue
+                    self._record(provider, True, time.monotonic() - started)
+                    if own_budget:
+                        budget.finish(True)
+                    return content
+                delay = budget.next_delay()
+                if delay is None:
+                    raise error or NoProviderAvailable("Retry budget exhausted")
+                await asyncio.sleep(delay)
+        finally:
+            if own_budget:
+                budget.finish(False)
+
+    async def stream(self, prompt: str, system_prompt: Optional[str] = None, budget: Optional[RetryBudget] = None,
+                     max_tokens: int = 2000, temperature: float = 0.7) -> AsyncIterator[str]:
+        """Stream from the best provider, failing over only while nothing has been yielded yet."""
+        own_budget = budget is None
+        if own_budget:
+            budget = self.retry_policy.begin('gateway_stream')
+        error: Optional[Exception] = None
+        completed = False
+        try:
+            for provider in self.ranked(streaming=True):
+                timeout = budget.start_attempt()
+                started = time.monotonic()
+                yielded = False
+                try:
+                    async for delta in provider.stream(prompt, system_prompt, timeout, budget.connect_timeout(timeout),
+                                                       max_tokens, temperature):
+                        if not yielded:
+                            yielded = True
+                            self._record(provider, True)
+                            self._first_token[provider.name].record(time.monotonic() - started)
+                        yield delta
+                except CircuitOpenError as e:
+                    error = error or e
+                    continue
+                except Exception as e:
+                    if yielded:
+                        raise
+                    self._record(provider, False)
+                    print(f"{provider.name} stream failed before its first token: {str(e)}")
+                    error = e
+                    continue
+                completed = True
+                return
+            raise error or NoProviderAvailable("No LLM provider available")
+        finally:
+            if own_budget:
+                budget.finish(completed)
+
+    def signature(self) -> str:
+        """The configured providers and their models, e.g. ``mistral/mistral-medium,gemini/gemini-pro``."""
+        return ",".join(f"{provider.name}/{provider.model}" for provider in self.providers)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Per-provider availability, call count, recent error rate, median latency and time to first token."""
+        stats = {}
+        for provider in self.providers:
+            outcomes = self._outcomes[provider.name]
+            latency = self._latency[provider.name].percentile(50)
+            first_token = self._first_token[provider.name].percentile(50)
+            stats[provider.name] = {
+                'available': provider.available(),
+                'calls': self._calls[provider.name],
+                'error_rate': round(outcomes.count(False) / len(outcomes), 3) if outcomes else 0.0,
+                'p50_latency': round(latency, 3) if latency is not None else None,
+                'p50_first_token': round(first_token, 3) if first_token is not None else None
+            }
+        return stats
+
+    def _record(self, provider: LLMProvider, succeeded: bool, latency: Optional[float] = None) -> None:
+        self._calls[provider.name] += 1
+        self._outcomes[provider.name].append(succeeded)
+        if latency is not None:
+            self._latency[provider.name].record(latency)
+
+
+def create_gateway(names: Optional[str] = None, default: str = 'mistral,gemini',
+                   retry_policy: Optional[RetryPolicy] = None) -> LLMGateway:
+    """Build a gateway from a comma-separated provider list (``LLM_PROVIDERS`` by default), in preference order.
+
+    Providers without an API key are left out, unless that would leave none.
+    """
+    names = names or os.getenv('LLM_PROVIDERS', default)
+    providers = []
+    for name in (part.strip().lower() for part in names.split(',')):
+        if not name:
+            continue
+        if name not in PROVIDERS:
+            raise ValueError(f"Unknown LLM provider '{name}', expected one of {list(PROVIDERS)}")
+        providers.append(PROVIDERS[name]())
+    configured = [provider for provider in providers
+                  if not isinstance(provider, (MistralProvider, GeminiProvider)) or provider.available()]
+    return LLMGateway(configured or providers, retry_policy)
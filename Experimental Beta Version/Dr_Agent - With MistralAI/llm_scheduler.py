@@ -0,0 +1,109 @@
+import heapq
+import asyncio
+import itertools
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+# Lower runs first
+PRIORITY_DIAGNOSIS = 0
+PRIORITY_PROBE = 5
+PRIORITY_BULK = 10
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class LLMScheduler:
+    """Bounded pool of in-flight LLM jobs fed from a priority queue.
+
+    At most ``max_concurrency`` jobs run at once; the rest wait ordered by priority and
+    then arrival. A waiting job's ``on_position`` callback is told its 1-based place in
+    the queue whenever it changes. The limit can be changed while the bot is running
+    with :meth:`set_concurrency`.
+    """
+
+    def __init__(self, max_concurrency: int = 4):
+        self.max_concurrency = max(1, max_concurrency)
+        self.completed = 0
+        self._active = 0
+        # Heap entries: [priority, sequence, future, on_position, last reported position]
+        self._waiting: List[list] = []
+        self._sequence = itertools.count()
+        self._callbacks = set()
+
+    async def run(self, job: Callable[[], Awaitable[T]], priority: int = PRIORITY_DIAGNOSIS,
+                  on_position: Optional[PositionCallback] = None) -> T:
+        """Wait for a free slot, then await ``job()`` and return its result."""
+        await self._acquire(priority, on_position)
+        try:
+            return await job()
+        finally:
+            self.completed += 1
+            self._release()
+
+    def set_concurrency(self, max_concurrency: int) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self._dispatch()
+
+    def snapshot(self) -> Dict:
+        waiting: Dict[int, int] = {}
+        for entry in self._waiting:
+            waiting[entry[0]] = waiting.get(entry[0], 0) + 1
+        return {
+            'max_concurrency': self.max_concurrency,
+            'active': self._active,
+            'waiting': len(self._waiting),
+            'waiting_by_priority': waiting,
+            'completed': self.completed
+        }
+
+    async def _acquire(self, priority: int, on_position: Optional[PositionCallback]) -> None:
+        if self._active < self.max_concurrency and not self._waiting:
+            self._active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._sequence), future, on_position, None]
+        heapq.heappush(self._waiting, entry)
+        self._report_positions()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # Still queued, unless _dispatch already popped and skipped it
+                if any(waiting is entry for waiting in self._waiting):
+                    self._waiting = [waiting for waiting in self._waiting if waiting is not entry]
+                    heapq.heapify(self._waiting)
+                    self._report_positions()
+            else:
+                # The slot was granted just as the waiter was cancelled; pass it on
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._active < self.max_concurrency and self._waiting:
+            entry = heapq.heappop(self._waiting)
+            if entry[2].done():
+                # Cancelled while queued; its task removes nothing and takes no slot
+                continue
+            self._active += 1
+            entry[2].set_result(None)
+        self._report_positions()
+
+    def _report_positions(self) -> None:
+        for position, entry in enumerate(sorted(self._waiting), start=1):
+            if entry[3] is not None and entry[4] != position:
+                entry[4] = position
+                task = asyncio.get_running_loop().create_task(self._notify(entry[3], position))
+                self._callbacks.add(task)
+                task.add_done_callback(self._callbacks.discard)
+
+    @staticmethod
+    async def _notify(callback: PositionCallback, position: int) -> None:
+        try:
+            await callback(position)
+        except Exception as e:
+            print(f"Error reporting queue position: {str(e)}")
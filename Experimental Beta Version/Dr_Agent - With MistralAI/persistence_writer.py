@@ -0,0 +1,159 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from visit_repository import VisitRepository
+
+VISIT, PROFILE = 'visit', 'profile'
+
+
+class PersistenceWriter:
+    """Single writer for visits and patient profiles.
+
+    Handlers enqueue writes and get an ``asyncio.Future`` back; they only await it when
+    they need durability confirmation. One background task drains the queue, coalesces
+    profile upserts for the same user, and commits everything that is pending as one
+    batch in a worker thread (one fsync per file per batch), so the event loop never
+    blocks on disk and concurrent handlers can no longer race on the same file.
+    Queued profiles are readable through :meth:`get_profile` before they are written.
+    A second task periodically lets the storage backend compact closed data.
+    """
+
+    def __init__(self, repository: VisitRepository, max_batch: int = 256, linger: float = 0.05,
+                 compact_interval: float = 3600):
+        self.repository = repository
+        self.storage = repository.storage
+        self.max_batch = max_batch
+        # Seconds to wait for more writes after the first one so they share an fsync
+        self.linger = linger
+        self.compact_interval = compact_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._compactor: Optional[asyncio.Task] = None
+        # Latest queued profile per user, until the batch holding it is committed
+        self._pending_profiles: Dict[object, Dict] = {}
+
+    def start(self) -> None:
+        """Start the writer (and compaction) tasks on the running event loop."""
+        if self._task is None:
+            loop = asyncio.get_running_loop()
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+            if self.compact_interval:
+                self._compactor = loop.create_task(self._compact_periodically())
+
+    async def stop(self) -> None:
+        """Flush everything that is queued and stop the writer task."""
+        if self._task is None:
+            return
+        if self._compactor is not None:
+            self._compactor.cancel()
+            try:
+                await self._compactor
+            except asyncio.CancelledError:
+                pass
+            self._compactor = None
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def submit_visit(self, visit: Dict) -> asyncio.Future:
+        # Index the visit right away so deep links work before it reaches disk
+        token = self.repository.add_pending(visit)
+        return self._submit(VISIT, visit, token)
+
+    def submit_profile(self, profile: Dict) -> asyncio.Future:
+        profile = dict(profile)
+        self._pending_profiles[profile['user_id']] = profile
+        return self._submit(PROFILE, profile)
+
+    def get_profile(self, user_id) -> Optional[Dict]:
+        """The user's profile, including one that is still queued."""
+        pending = self._pending_profiles.get(user_id)
+        if pending is not None:
+            return dict(pending)
+        return self.storage.get_profile(user_id)
+
+    def _submit(self, kind: str, payload: Dict, token=None) -> asyncio.Future:
+        if self._task is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        # Failures are logged by the writer; mark them retrieved for fire-and-forget callers
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._queue.put_nowait((kind, payload, token, future))
+        return future
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            if self.linger:
+                await asyncio.sleep(self.linger)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[tuple]) -> None:
+        visits = [item for item in batch if item[0] == VISIT]
+        # Coalesce profile upserts: only the latest profile per user is written
+        profiles: Dict[object, Dict] = {}
+        for kind, payload, _, _ in batch:
+            if kind == PROFILE:
+                profiles[payload['user_id']] = payload
+
+        # Visits are settled before profiles are written, so a failed profile save
+        # cannot fail (or un-index) visits that are already on disk
+        if visits:
+            try:
+                locations = await asyncio.to_thread(self.storage.add_visits, [item[1] for item in visits])
+            except Exception as e:
+                print(f"Error saving visits to database: {str(e)}")
+                self.repository.discard_pending([item[2] for item in visits])
+                self._settle(visits, e)
+            else:
+                self.repository.commit_pending([item[2] for item in visits], locations)
+                self._settle(visits)
+
+        if profiles:
+            updates = [item for item in batch if item[0] == PROFILE]
+            try:
+                await asyncio.to_thread(self.storage.save_profiles, list(profiles.values()))
+            except Exception as e:
+                print(f"Error saving profiles to database: {str(e)}")
+                self._settle(updates, e)
+            else:
+                self._settle(updates)
+            finally:
+                self._release_profiles(profiles)
+
+    @staticmethod
+    def _settle(items: List[tuple], error: Optional[BaseException] = None) -> None:
+        for *_, future in items:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _release_profiles(self, profiles: Dict[object, Dict]) -> None:
+        # A newer submit for the same user stays visible until its own batch commits
+        for user_id, profile in profiles.items():
+            if self._pending_profiles.get(user_id) is profile:
+                del self._pending_profiles[user_id]
+
+    async def _compact_periodically(self) -> None:
+        while True:
+            try:
+                compacted = await asyncio.to_thread(self.storage.compact)
+                if compacted:
+                    print(f"Compacted {compacted} closed visit partitions")
+            except Exception as e:
+                print(f"Error compacting storage: {str(e)}")
+            await asyncio.sleep(self.compact_interval)
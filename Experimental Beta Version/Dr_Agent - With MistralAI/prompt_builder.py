@@ -0,0 +1,102 @@
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate the model's token count without loading its tokenizer.
+
+    Punctuation and emoji count as one token each. Latin words are counted at about
+    four characters per token and Persian words at about two, which is how BPE
+    vocabularies trained mostly on English tend to split them.
+    """
+    tokens = 0
+    for piece in _TOKEN_PATTERN.findall(text or ''):
+        per_token = 4 if piece.isascii() else 2
+        tokens += max(1, -(-len(piece) // per_token))
+    return tokens
+
+
+class PromptSection:
+    """A titled block of lines in the user message.
+
+    Each of ``lines`` is a block of its own; each ``(header, items)`` pair in ``groups`` is
+    one block, rendered as the header followed by its items. When the prompt is over
+    budget, whole blocks are removed from the end of the sections with the lowest
+    ``priority`` first, never going below ``min_lines`` lines, so a header is never left
+    without its items.
+    """
+
+    def __init__(self, name: str, title: str, lines: Iterable[str] = (), priority: int = 0, min_lines: int = 0,
+                 groups: Iterable[Tuple[str, List[str]]] = ()):
+        self.name = name
+        self.title = title
+        self.blocks = [[line] for line in lines if line and line.strip()]
+        for header, items in groups:
+            items = [item for item in items if item and item.strip()]
+            if items:
+                self.blocks.append([header] + items)
+        self.priority = priority
+        self.min_lines = min_lines
+
+    @property
+    def lines(self) -> List[str]:
+        return [line for block in self.blocks for line in block]
+
+    def render(self) -> str:
+        return "\n".join([self.title] + self.lines) if self.lines else ""
+
+
+class Prompt:
+    """System and user content of one request, with their estimated sizes."""
+
+    def __init__(self, system: str, user: str, trimmed: Dict[str, int]):
+        self.system = system
+        self.user = user
+        self.system_tokens = estimate_tokens(system)
+        self.user_tokens = estimate_tokens(user)
+        # Section name -> number of lines removed to fit the budget
+        self.trimmed = trimmed
+
+    @property
+    def tokens(self) -> int:
+        return self.system_tokens + self.user_tokens
+
+    def describe(self, budget: Optional[int] = None) -> str:
+        text = f"system {self.system_tokens} + user {self.user_tokens} = {self.tokens} tokens"
+        if budget:
+            text += f" (budget {budget})"
+        if self.trimmed:
+            text += ", trimmed " + ", ".join(f"{name}: {count} lines" for name, count in self.trimmed.items())
+        return text
+
+
+class PromptBuilder:
+    """Assemble the system prompt and the user sections once, within ``max_input_tokens``."""
+
+    def __init__(self, system_prompt: str, max_input_tokens: int = 4000):
+        self.system_prompt = system_prompt.strip()
+        self.max_input_tokens = max_input_tokens
+
+    def build(self, sections: List[PromptSection]) -> Prompt:
+        sections = [section for section in sections if section.blocks]
+        budget = self.max_input_tokens - estimate_tokens(self.system_prompt)
+        # Block costs include the newline after each of their lines
+        costs = {id(section): [sum(estimate_tokens(line) + 1 for line in block) for block in section.blocks]
+                 for section in sections}
+        total = sum(estimate_tokens(section.title) + 2 + sum(costs[id(section)]) for section in sections)
+        trimmed: Dict[str, int] = {}
+
+        for section in sorted(sections, key=lambda s: s.priority):
+            lines = len(section.lines)
+            while total > budget and section.blocks and lines - len(section.blocks[-1]) >= section.min_lines:
+                removed = section.blocks.pop()
+                total -= costs[id(section)].pop()
+                lines -= len(removed)
+                trimmed[section.name] = trimmed.get(section.name, 0) + len(removed)
+            if total <= budget:
+                break
+
+        user = "\n\n".join(filter(None, (section.render() for section in sections)))
+        return Prompt(self.system_prompt, user, trimmed)
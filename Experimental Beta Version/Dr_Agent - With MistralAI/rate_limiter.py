@@ -0,0 +1,133 @@
+import time
+import asyncio
+import threading
+from typing import Dict, Mapping, Optional
+
+# Rate-limit headers we learn from, most specific first (Mistral's own names, then the common ones)
+TOKEN_LIMIT_HEADERS = ('x-ratelimitbysize-limit-minute', 'x-ratelimit-limit-tokens')
+TOKEN_REMAINING_HEADERS = ('x-ratelimitbysize-remaining-minute', 'x-ratelimit-remaining-tokens')
+REQUEST_LIMIT_HEADERS = ('x-ratelimit-limit-requests',)  # per minute
+REQUEST_REMAINING_HEADERS = ('x-ratelimit-remaining-requests',)
+
+
+def _header_number(headers: Mapping[str, str], names) -> Optional[float]:
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                continue
+    return None
+
+
+class TokenBucket:
+    """Classic token bucket: ``capacity`` units, refilled at ``rate`` units per second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until ``amount`` units are available (call after :meth:`refill`)."""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate) if self.rate > 0 else 0.0
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Requests-per-second and tokens-per-minute budgets shared by every call to one API.
+
+    :meth:`acquire` waits until both budgets allow the request. Waiters are served strictly
+    in arrival order, so a large prompt cannot be overtaken forever by small ones. Limits
+    and remaining quota reported by the server (:meth:`update_from_headers`) replace the
+    configured values, and a ``Retry-After`` pauses every caller until it has passed.
+    """
+
+    def __init__(self, requests_per_second: float = 1.0, tokens_per_minute: float = 500_000):
+        self._requests = TokenBucket(requests_per_second, max(1.0, requests_per_second))
+        self._tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self._paused_until = 0.0
+        self._state_lock = threading.Lock()
+        # asyncio locks are bound to one event loop; keep one FIFO per loop (as with the HTTP clients)
+        self._queues: Dict[asyncio.AbstractEventLoop, asyncio.Lock] = {}
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait (in FIFO order) until one request of about ``tokens`` tokens may be sent."""
+        async with self._queue():
+            while True:
+                with self._state_lock:
+                    now = time.monotonic()
+                    self._requests.refill(now)
+                    self._tokens.refill(now)
+                    wait = max(self._paused_until - now, self._requests.wait_time(1), self._tokens.wait_time(tokens))
+                    if wait <= 0:
+                        self._requests.take(1)
+                        self._tokens.take(tokens)
+                        return
+                    self.waits += 1
+                    self.wait_seconds += wait
+                await asyncio.sleep(wait)
+
+    def refund(self, tokens: int) -> None:
+        """Return tokens that were reserved but not used (estimate above actual usage)."""
+        if tokens > 0:
+            with self._state_lock:
+                self._tokens.level = min(self._tokens.capacity, self._tokens.level + tokens)
+
+    def pause(self, seconds: float) -> None:
+        with self._state_lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Adopt the limits and remaining quota the server reports, when it reports them."""
+        token_limit = _header_number(headers, TOKEN_LIMIT_HEADERS)
+        token_remaining = _header_number(headers, TOKEN_REMAINING_HEADERS)
+        request_limit = _header_number(headers, REQUEST_LIMIT_HEADERS)
+        request_remaining = _header_number(headers, REQUEST_REMAINING_HEADERS)
+        retry_after = _header_number(headers, ('retry-after',))
+        with self._state_lock:
+            now = time.monotonic()
+            self._tokens.refill(now)
+            self._requests.refill(now)
+            if token_limit:
+                self._tokens.capacity = token_limit
+                self._tokens.rate = token_limit / 60
+            if token_remaining is not None:
+                self._tokens.level = min(self._tokens.level, token_remaining)
+            if request_limit:
+                self._requests.rate = request_limit / 60
+                self._requests.capacity = max(1.0, self._requests.rate)
+            if request_remaining is not None:
+                self._requests.level = min(self._requests.level, request_remaining)
+        if retry_after:
+            self.pause(retry_after)
+
+    def snapshot(self) -> Dict:
+        with self._state_lock:
+            return {
+                'requests_per_second': self._requests.rate,
+                'tokens_per_minute': self._tokens.rate * 60,
+                'tokens_available': int(self._tokens.level),
+                'waits': self.waits,
+                'wait_seconds': round(self.wait_seconds, 3)
+            }
+
+    def _queue(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        queue = self._queues.get(loop)
+        if queue is None:
+            for stale_loop in [l for l in self._queues if l.is_closed()]:
+                del self._queues[stale_loop]
+            queue = self._queues[loop] = asyncio.Lock()
+        return queue
@@ -0,0 +1,132 @@
+import os
+import time
+import random
+import threading
+from typing import Dict, Optional
+
+
+class RetryMetrics:
+    """Per-operation counters of calls, attempts and retries."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations: Dict[str, Dict] = {}
+
+    def record_attempt(self, name: str) -> None:
+        with self._lock:
+            self._counters(name)['attempts'] += 1
+
+    def record_call(self, name: str, attempts: int, succeeded: bool) -> None:
+        with self._lock:
+            counters = self._counters(name)
+            counters['calls'] += 1
+            counters['succeeded' if succeeded else 'failed'] += 1
+            counters['retries'] += max(0, attempts - 1)
+            histogram = counters['attempts_per_call']
+            histogram[attempts] = histogram.get(attempts, 0) + 1
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Return a copy of all counters, keyed by operation name."""
+        with self._lock:
+            return {name: dict(counters, attempts_per_call=dict(counters['attempts_per_call']))
+                    for name, counters in self._operations.items()}
+
+    def summary(self) -> str:
+        """One line per operation, for logs and the admin stats command."""
+        lines = []
+        for name, c in sorted(self.snapshot().items()):
+            lines.append(f"{name}: {c['calls']} calls, {c['succeeded']} ok, {c['failed']} failed, "
+                         f"{c['retries']} retries, attempts per call {c['attempts_per_call']}")
+        return "\n".join(lines) or "no calls yet"
+
+    def _counters(self, name: str) -> Dict:
+        return self._operations.setdefault(name, {
+            'calls': 0, 'succeeded': 0, 'failed': 0, 'attempts': 0, 'retries': 0, 'attempts_per_call': {}
+        })
+
+
+retry_metrics = RetryMetrics()
+
+
+class RetryPolicy:
+    """Retry and deadline settings for one logical call, however many layers it passes through.
+
+    ``total_budget`` bounds the whole call including waits between attempts; each attempt
+    gets at most ``attempt_timeout`` seconds and never more than what is left of the budget.
+    The defaults keep the original client's 15s connect / 90s read timeouts for one attempt,
+    so a long completion is not cut short, and leave 30s of the budget for a retry.
+    """
+
+    def __init__(self, total_budget: float = 120.0, max_attempts: int = 3, attempt_timeout: float = 90.0,
+                 connect_timeout: float = 15.0, base_delay: float = 0.5, max_delay: float = 4.0,
+                 min_attempt_time: float = 2.0, metrics: RetryMetrics = retry_metrics):
+        self.total_budget = total_budget
+        self.max_attempts = max_attempts
+        self.attempt_timeout = attempt_timeout
+        self.connect_timeout = connect_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Do not start an attempt that would have less time than this
+        self.min_attempt_time = min_attempt_time
+        self.metrics = metrics
+
+    @classmethod
+    def from_env(cls, prefix: str = 'LLM_') -> 'RetryPolicy':
+        """Policy from ``<prefix>TOTAL_BUDGET``, ``MAX_ATTEMPTS``, ``ATTEMPT_TIMEOUT``, ``CONNECT_TIMEOUT``,
+        ``BASE_DELAY``, ``MAX_DELAY`` and ``MIN_ATTEMPT_TIME``; unset ones keep the defaults."""
+        defaults = cls()
+        return cls(
+            total_budget=float(os.getenv(f'{prefix}TOTAL_BUDGET', defaults.total_budget)),
+            max_attempts=int(os.getenv(f'{prefix}MAX_ATTEMPTS', defaults.max_attempts)),
+            attempt_timeout=float(os.getenv(f'{prefix}ATTEMPT_TIMEOUT', defaults.attempt_timeout)),
+            connect_timeout=float(os.getenv(f'{prefix}CONNECT_TIMEOUT', defaults.connect_timeout)),
+            base_delay=float(os.getenv(f'{prefix}BASE_DELAY', defaults.base_delay)),
+            max_delay=float(os.getenv(f'{prefix}MAX_DELAY', defaults.max_delay)),
+            min_attempt_time=float(os.getenv(f'{prefix}MIN_ATTEMPT_TIME', defaults.min_attempt_time)),
+        )
+
+    def begin(self, name: str) -> 'RetryBudget':
+        """Start the clock for one call; pass the budget down instead of retrying at every layer."""
+        return RetryBudget(self, name)
+
+
+class RetryBudget:
+    """Remaining time and attempts of one call started from a :class:`RetryPolicy`."""
+
+    def __init__(self, policy: RetryPolicy, name: str):
+        self.policy = policy
+        self.name = name
+        self.deadline = time.monotonic() + policy.total_budget
+        self.attempts = 0
+        self._finished = False
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def start_attempt(self) -> float:
+        """Count an attempt and return its timeout (bounded by the remaining budget)."""
+        if self.attempts >= self.policy.max_attempts or self.remaining() <= 0:
+            raise TimeoutError(f"{self.name}: retry budget exhausted after {self.attempts} attempts")
+        self.attempts += 1
+        self.policy.metrics.record_attempt(self.name)
+        return min(self.policy.attempt_timeout, self.remaining())
+
+    def connect_timeout(self, attempt_timeout: float) -> float:
+        return min(self.policy.connect_timeout, attempt_timeout)
+
+    def next_delay(self) -> Optional[float]:
+        """Seconds to wait before the next attempt, or None if no attempt fits in the budget."""
+        if self.attempts >= self.policy.max_attempts:
+            return None
+        delay = min(self.policy.max_delay, self.policy.base_delay * 2 ** max(0, self.attempts - 1))
+        # Full jitter on the upper half keeps concurrent retries from synchronising
+        delay *= random.uniform(0.5, 1.0)
+        if self.remaining() - delay < self.policy.min_attempt_time:
+            return None
+        return delay
+
+    def finish(self, succeeded: bool) -> None:
+        """Record the outcome once; later calls are ignored."""
+        if not self._finished:
+            self._finished = True
+            self.policy.metrics.record_call(self.name, self.attempts, succeeded)
@@ -0,0 +1,164 @@
+import os
+import json
+import pickle
+import asyncio
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+SESSION_DB_FILE = "sessions.sqlite3"
+
+
+class SessionPersistence(BasePersistence):
+    """Keeps ``user_data`` and persistent conversation states in SQLite across restarts.
+
+    Sessions are loaded lazily: nothing is read at startup except the (small)
+    conversation states, and a user's ``user_data`` is read on the first update from
+    that user. PTB reports changed sessions every ``update_interval`` seconds; those
+    reports are buffered and written as one transaction per interval, so a busy intake
+    costs one write per user per interval instead of one per answer.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state BLOB NOT NULL,
+            PRIMARY KEY (name, key)
+        );
+    """
+
+    def __init__(self, db_path: str, update_interval: float = 30):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval)
+        self.db_path = db_path
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+        self._loaded_users = set()
+        # Pending writes; a value of None means the row is deleted
+        self._dirty_users: Dict[int, Optional[bytes]] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Optional[bytes]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        # Loaded per user in refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        stored = await asyncio.to_thread(self._read_user, user_id)
+        for key, value in (stored or {}).items():
+            user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._loaded_users.add(user_id)
+        self._dirty_users[user_id] = pickle.dumps(data)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty_users[user_id] = None
+        self._schedule_write()
+
+    async def get_conversations(self, name: str) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        state = None if new_state is None else pickle.dumps(new_state)
+        self._dirty_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_write()
+
+    async def flush(self) -> None:
+        """Write everything still buffered; called once when the application shuts down."""
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
+        with self._lock:
+            self._conn.close()
+
+    # chat_data, bot_data and callback_data are not stored (see store_data)
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    def _schedule_write(self) -> None:
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        # Let every update of the current persistence run register before writing
+        await asyncio.sleep(0)
+        while self._dirty_users or self._dirty_conversations:
+            users, self._dirty_users = self._dirty_users, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            try:
+                await asyncio.to_thread(self._write, users, conversations)
+            except Exception as e:
+                print(f"Error saving sessions: {str(e)}")
+                # Keep the batch for the next run unless newer data has arrived meanwhile
+                for user_id, data in users.items():
+                    self._dirty_users.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._dirty_conversations.setdefault(key, state)
+                return
+
+    def _read_user(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _write(self, users: Dict[int, Optional[bytes]], conversations: Dict[Tuple[str, str], Optional[bytes]]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO user_data (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                [(user_id, data) for user_id, data in users.items() if data is not None])
+            self._conn.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in users.items() if data is None])
+            self._conn.executemany(
+                "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state",
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None])
+            self._conn.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None])
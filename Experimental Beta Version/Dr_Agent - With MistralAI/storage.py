@@ -0,0 +1,992 @@
+import os
+import re
+import gzip
+import json
+import lzma
+import time
+import shutil
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Visits are stored as an append-only JSON Lines log. Each diagnosis costs a single
+# append plus an fsync instead of re-serialising every visit ever recorded.
+VISIT_LOG_FILE = "visits.jsonl"
+# The sidecar index maps every record to its byte offset in the log, so a record can be
+# read back with one seek. It is derived data and is rebuilt from the log when it lags.
+VISIT_INDEX_FILE = "visits.idx"
+# The log is split into one segment per calendar month inside this folder
+# (visits-YYYY-MM.jsonl + visits-YYYY-MM.idx); closed months are compressed.
+VISIT_PARTITION_DIR = "visits"
+UNDATED_PARTITION = "undated"
+COLD_SEGMENT_CODECS = {'gz': gzip, 'xz': lzma}
+# Decompressed cold segments kept in memory. Gzip/xz streams cannot seek, so without it
+# every record read from a closed month would decompress the month up to that record.
+COLD_SEGMENT_CACHE_SIZE = 4
+SQLITE_DB_FILE = "dr_agent.sqlite3"
+
+STORAGE_BACKENDS = ('json', 'sqlite')
+
+_LINK_TIMESTAMP = re.compile(r'^(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})$')
+_PARTITION_KEY = re.compile(r'^\d{4}-\d{2}')
+_PARTITION_FILE = re.compile(r'^visits-(\d{4}-\d{2}|' + UNDATED_PARTITION + r')\.jsonl(?:\.(gz|xz))?$')
+
+
+def link_timestamp_prefix(timestamp: str) -> str:
+    """Convert a deep-link timestamp (``YYYYmmdd-HHMMSS``) to the ISO prefix stored on visits.
+
+    Anything that is not in the deep-link format is returned unchanged and matched as a prefix.
+    """
+    match = _LINK_TIMESTAMP.match(timestamp or '')
+    if not match:
+        return timestamp or ''
+    year, month, day, hour, minute, second = match.groups()
+    return f"{year}-{month}-{day}T{hour}:{minute}:{second}"
+
+
+def partition_key(visit_timestamp) -> str:
+    """Return the monthly partition (``YYYY-MM``) an ISO visit timestamp belongs to."""
+    if isinstance(visit_timestamp, str) and _PARTITION_KEY.match(visit_timestamp):
+        return visit_timestamp[:7]
+    return UNDATED_PARTITION
+
+
+class VisitLog:
+    """Append-only JSON Lines visit log with a sidecar offset index."""
+
+    def __init__(self, folder: str, log_name: str = VISIT_LOG_FILE, index_name: str = VISIT_INDEX_FILE):
+        self.folder = folder
+        self.log_path = os.path.join(folder, log_name)
+        self.index_path = os.path.join(folder, index_name)
+        # _lock guards the in-memory index; _write_lock serialises appends so that
+        # readers are not blocked while a writer waits on fsync.
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._index: Optional[List[Dict]] = None
+
+    def append(self, visit: Dict) -> int:
+        """Append one visit, fsync the log and return the record's byte offset."""
+        return self.append_many([visit])[0]
+
+    def append_many(self, visits: List[Dict]) -> List[int]:
+        """Append several visits with a single fsync and return their byte offsets."""
+        lines = [(json.dumps(visit, ensure_ascii=False) + "\n").encode('utf-8') for visit in visits]
+        with self._write_lock:
+            with self._lock:
+                self._load_index()
+            os.makedirs(self.folder, exist_ok=True)
+            entries = []
+            with open(self.log_path, 'ab') as log_file:
+                for visit, line in zip(visits, lines):
+                    entries.append(_index_entry(visit, log_file.tell(), len(line)))
+                    log_file.write(line)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+            # The index is recoverable from the log, so it is flushed but not fsynced.
+            with open(self.index_path, 'a', encoding='utf-8') as index_file:
+                for entry in entries:
+                    index_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            with self._lock:
+                index = self._load_index()
+                indexed_end = index[-1]['offset'] + index[-1]['length'] if index else 0
+                # A concurrent reader may already have indexed this tail from the log
+                index.extend(e for e in entries if e['offset'] >= indexed_end)
+        return [entry['offset'] for entry in entries]
+
+    def read_at(self, offset: int) -> Dict:
+        """Read the visit stored at the given byte offset."""
+        with open(self.log_path, 'rb') as log_file:
+            log_file.seek(offset)
+            return json.loads(log_file.readline().decode('utf-8'))
+
+    def iter_visits(self) -> Iterator[Dict]:
+        """Yield every visit in insertion order."""
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'r', encoding='utf-8') as log_file:
+            for line in log_file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def entries(self) -> List[Dict]:
+        """Return a copy of the offset index (user_id, visit_timestamp, visit_code, offset)."""
+        with self._lock:
+            return list(self._load_index())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._load_index())
+
+    def _load_index(self) -> List[Dict]:
+        """Load the sidecar index, re-indexing any log tail it does not cover yet."""
+        if self._index is not None:
+            index = self._index
+            indexed_end = index[-1]['offset'] + index[-1]['length'] if index else 0
+            log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+            if log_size == indexed_end:
+                return index
+            if log_size > indexed_end:
+                # Another writer appended to the log; pick up just the new tail
+                index.extend(self._scan_log(indexed_end))
+                return index
+            self._index = None
+
+        index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as index_file:
+                for line in index_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line after a crash; the log tail scan below recovers it.
+                        break
+                    if not index or entry['offset'] >= index[-1]['offset'] + index[-1]['length']:
+                        index.append(entry)
+
+        indexed_end = index[-1]['offset'] + index[-1]['length'] if index else 0
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        if indexed_end > log_size:
+            # The index refers to data the log does not have; rebuild it from scratch.
+            index, indexed_end = [], 0
+        if indexed_end < log_size or not os.path.exists(self.index_path):
+            index = index + list(self._scan_log(indexed_end))
+            self._rewrite_index(index)
+
+        self._index = index
+        return index
+
+    def _scan_log(self, start: int) -> Iterator[Dict]:
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'rb') as log_file:
+            log_file.seek(start)
+            yield from _scan_records(log_file, start)
+
+    def _rewrite_index(self, index: List[Dict]) -> None:
+        os.makedirs(self.folder, exist_ok=True)
+        _write_index(self.index_path, index)
+
+
+class ColdSegment:
+    """Read-only, compressed segment of a closed month.
+
+    The sidecar index stays uncompressed and its offsets point into the decompressed
+    stream (they are the offsets the records had in the plain log), so listing and
+    locating visits never decompresses anything; only reading a record back does. The
+    decompressed bytes of the last :data:`COLD_SEGMENT_CACHE_SIZE` segments read are
+    shared by all instances, so paging through a closed month decompresses it once.
+    """
+
+    _cache: 'OrderedDict[Tuple[str, Optional[Tuple[int, int]]], bytes]' = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, data_path: str, index_path: str, index: Optional[List[Dict]] = None):
+        self.data_path = data_path
+        self.index_path = index_path
+        self.codec = COLD_SEGMENT_CODECS[data_path.rsplit('.', 1)[-1]]
+        self._lock = threading.Lock()
+        self._index = index
+
+    def read_at(self, offset: int) -> Dict:
+        data = self._data()
+        end = data.find(b'\n', offset)
+        return json.loads(data[offset:end if end >= 0 else len(data)].decode('utf-8'))
+
+    def iter_visits(self) -> Iterator[Dict]:
+        with self.codec.open(self.data_path, 'rt', encoding='utf-8') as data_file:
+            for line in data_file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def entries(self) -> List[Dict]:
+        with self._lock:
+            if self._index is None:
+                self._index = self._load_index()
+            return list(self._index)
+
+    def __len__(self) -> int:
+        return len(self.entries())
+
+    def _load_index(self) -> List[Dict]:
+        index = []
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as index_file:
+                for line in index_file:
+                    index.append(json.loads(line))
+            return index
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        # Missing or damaged index: rebuild it once from the compressed data
+        print(f"Rebuilding visit index for {self.data_path}")
+        with self.codec.open(self.data_path, 'rb') as data_file:
+            index = list(_scan_records(data_file, 0))
+        _write_index(self.index_path, index)
+        return index
+
+    def _data(self) -> bytes:
+        # Keyed by file version too: a reopened month that is compressed again reuses the path
+        key = (self.data_path, _file_version(self.data_path))
+        with self._cache_lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                return data
+        with self.codec.open(self.data_path, 'rb') as data_file:
+            data = data_file.read()
+        with self._cache_lock:
+            self._cache[key] = data
+            while len(self._cache) > COLD_SEGMENT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return data
+
+
+class PartitionedVisitLog:
+    """Visit log split into one segment per calendar month.
+
+    Open months are plain :class:`VisitLog` segments. Once a month is closed and has
+    been idle for ``min_idle`` seconds, :meth:`compact` compresses it into a read-only
+    :class:`ColdSegment`. A location is ``(partition, offset)``, so reading a record
+    opens exactly one segment, and lookups by timestamp only consult the index of the
+    month the timestamp falls in.
+    """
+
+    def __init__(self, folder: str, compression: str = 'gz', min_idle: float = 3600):
+        if compression not in COLD_SEGMENT_CODECS:
+            raise ValueError(f"Unknown compression '{compression}', expected one of {tuple(COLD_SEGMENT_CODECS)}")
+        self.folder = folder
+        self.partition_folder = os.path.join(folder, VISIT_PARTITION_DIR)
+        self.compression = compression
+        self.min_idle = min_idle
+        # _lock guards the segment map; each partition also has a lock that serialises
+        # appends with compaction of that partition.
+        self._lock = threading.Lock()
+        self._segments: Dict[str, object] = {}
+        self._partition_locks: Dict[str, threading.Lock] = {}
+        self._recovered = False
+
+    def append(self, visit: Dict) -> Tuple[str, int]:
+        return self.append_many([visit])[0]
+
+    def append_many(self, visits: List[Dict]) -> List[Tuple[str, int]]:
+        """Append visits to their monthly segments (one fsync per touched month)."""
+        by_partition: Dict[str, List[int]] = {}
+        for position, visit in enumerate(visits):
+            by_partition.setdefault(partition_key(visit.get('visit_timestamp')), []).append(position)
+
+        locations: List[Optional[Tuple[str, int]]] = [None] * len(visits)
+        for key, positions in by_partition.items():
+            with self._partition_lock(key):
+                segment = self._open_segment(key)
+                offsets = segment.append_many([visits[position] for position in positions])
+            for position, offset in zip(positions, offsets):
+                locations[position] = (key, offset)
+        return locations
+
+    def read_at(self, location: Tuple[str, int]) -> Dict:
+        key, offset = location
+        try:
+            return self._segment(key).read_at(offset)
+        except FileNotFoundError:
+            # The segment was compacted or reopened between lookup and open; offsets are
+            # preserved across both, so reading the current segment is enough.
+            with self._lock:
+                self._refresh()
+            return self._segment(key).read_at(offset)
+
+    def entries(self, partition: Optional[str] = None) -> List[Dict]:
+        """Return index entries (with their ``partition``), optionally for one month only."""
+        with self._lock:
+            self._refresh()
+            if partition is not None:
+                segments = [(partition, self._segments[partition])] if partition in self._segments else []
+            else:
+                segments = sorted(self._segments.items())
+        return [dict(entry, partition=key) for key, segment in segments for entry in segment.entries()]
+
+    def iter_visits(self) -> Iterator[Dict]:
+        """Yield every visit, month by month (decompressing closed months)."""
+        with self._lock:
+            self._refresh()
+            segments = [segment for _, segment in sorted(self._segments.items())]
+        for segment in segments:
+            yield from segment.iter_visits()
+
+    def __len__(self) -> int:
+        return len(self.entries())
+
+    def data_version(self):
+        """File versions of every segment; changes on appends, compaction and reopening."""
+        with self._lock:
+            self._refresh()
+            return tuple(sorted(
+                (key, _file_version(segment.log_path if isinstance(segment, VisitLog) else segment.data_path))
+                for key, segment in self._segments.items()))
+
+    def compact(self) -> int:
+        """Compress every closed, idle month into a cold segment; returns how many were compressed."""
+        current = partition_key(datetime.now().isoformat())
+        with self._lock:
+            self._refresh()
+            candidates = sorted(key for key, segment in self._segments.items()
+                                if isinstance(segment, VisitLog) and key != UNDATED_PARTITION and key < current)
+        compacted = 0
+        for key in candidates:
+            with self._partition_lock(key):
+                segment = self._segment(key)
+                if not isinstance(segment, VisitLog):
+                    continue
+                try:
+                    idle = time.time() - os.path.getmtime(segment.log_path)
+                except FileNotFoundError:
+                    continue
+                if idle < self.min_idle:
+                    continue
+                self._compress(key, segment)
+                compacted += 1
+        return compacted
+
+    def import_visits(self, visits: Iterable[Dict], batch_size: int = 500) -> int:
+        """Append visits that are not stored yet (matched on user, timestamp and code)."""
+        known = {(e.get('user_id'), e.get('visit_timestamp'), e.get('visit_code')) for e in self.entries()}
+        imported, batch = 0, []
+        for visit in visits:
+            if not isinstance(visit, dict):
+                continue
+            key = (visit.get('user_id'), visit.get('visit_timestamp'), visit.get('visit_code'))
+            if key in known:
+                continue
+            known.add(key)
+            batch.append(visit)
+            if len(batch) >= batch_size:
+                imported += len(self.append_many(batch))
+                batch = []
+        if batch:
+            imported += len(self.append_many(batch))
+        return imported
+
+    def migrate_single_log(self) -> int:
+        """Split the pre-partitioning ``visits.jsonl`` log into monthly segments."""
+        legacy = VisitLog(self.folder)
+        if not os.path.exists(legacy.log_path):
+            return 0
+        migrated = self.import_visits(legacy.iter_visits())
+        os.replace(legacy.log_path, legacy.log_path + ".migrated")
+        if os.path.exists(legacy.index_path):
+            os.remove(legacy.index_path)
+        print(f"Migrated {migrated} visits from {legacy.log_path} into {self.partition_folder}")
+        return migrated
+
+    def migrate_from_json(self, json_path: str) -> int:
+        """Import a legacy ``patients.json`` array.
+
+        The source file is renamed to ``<name>.migrated`` afterwards so the import runs once.
+        Returns the number of migrated visits.
+        """
+        if not os.path.exists(json_path):
+            return 0
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                visits = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Error: cannot migrate invalid JSON file {json_path}")
+            return 0
+
+        migrated = self.import_visits(visits)
+        os.replace(json_path, json_path + ".migrated")
+        print(f"Migrated {migrated} visits from {json_path} to {self.partition_folder}")
+        return migrated
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        return (os.path.join(self.partition_folder, f"visits-{key}.jsonl"),
+                os.path.join(self.partition_folder, f"visits-{key}.idx"))
+
+    def _partition_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._partition_locks.setdefault(key, threading.Lock())
+
+    def _segment(self, key: str):
+        with self._lock:
+            segment = self._segments.get(key)
+            if segment is None:
+                self._refresh()
+                segment = self._segments.get(key)
+            if segment is None:
+                raise FileNotFoundError(f"No visit partition '{key}' in {self.partition_folder}")
+            return segment
+
+    def _open_segment(self, key: str) -> VisitLog:
+        """Return the writable segment for a month, reopening it if it was compressed."""
+        with self._lock:
+            self._refresh()
+            segment = self._segments.get(key)
+        if isinstance(segment, VisitLog):
+            return segment
+
+        log_path, index_path = self._paths(key)
+        if isinstance(segment, ColdSegment):
+            # A late write for a closed month (clock change, migration): decompress it again.
+            tmp_path = log_path + ".tmp"
+            with segment.codec.open(segment.data_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            with self._lock:
+                os.replace(tmp_path, log_path)
+                os.remove(segment.data_path)
+            print(f"Reopened closed visit partition {key}")
+
+        os.makedirs(self.partition_folder, exist_ok=True)
+        segment = VisitLog(self.partition_folder, os.path.basename(log_path), os.path.basename(index_path))
+        with self._lock:
+            self._segments[key] = segment
+        return segment
+
+    def _compress(self, key: str, segment: VisitLog) -> None:
+        index = segment.entries()
+        end = index[-1]['offset'] + index[-1]['length'] if index else 0
+        cold_path = f"{segment.log_path}.{self.compression}"
+        tmp_path = cold_path + ".tmp"
+        codec = COLD_SEGMENT_CODECS[self.compression]
+        # The bytes are copied verbatim (minus a torn tail), so every offset in the index
+        # and every location handed out so far stays valid for the cold segment.
+        with open(segment.log_path, 'rb') as src, open(tmp_path, 'wb') as raw:
+            with codec.open(raw, 'wb') as dst:
+                remaining = end
+                while remaining > 0:
+                    chunk = src.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+            raw.flush()
+            os.fsync(raw.fileno())
+        _write_index(segment.index_path, index)
+        with self._lock:
+            os.replace(tmp_path, cold_path)
+            os.remove(segment.log_path)
+            self._segments[key] = ColdSegment(cold_path, segment.index_path, index)
+        print(f"Compacted visit partition {key} into {cold_path}")
+
+    def _refresh(self) -> None:
+        """Sync the segment map with the partition folder (caller holds ``_lock``)."""
+        try:
+            names = os.listdir(self.partition_folder)
+        except FileNotFoundError:
+            names = []
+        found: Dict[str, set] = {}
+        for name in names:
+            match = _PARTITION_FILE.match(name)
+            if match:
+                found.setdefault(match.group(1), set()).add(match.group(2))
+
+        for key, kinds in found.items():
+            log_path, index_path = self._paths(key)
+            if None in kinds:
+                if not self._recovered:
+                    # Compaction was interrupted after the compressed copy appeared: the plain
+                    # log is still authoritative, the partial cold copy is dropped.
+                    for ext in kinds - {None}:
+                        os.remove(f"{log_path}.{ext}")
+                if not isinstance(self._segments.get(key), VisitLog):
+                    self._segments[key] = VisitLog(
+                        self.partition_folder, os.path.basename(log_path), os.path.basename(index_path))
+            else:
+                cold_path = f"{log_path}.{sorted(kinds)[0]}"
+                current = self._segments.get(key)
+                if not isinstance(current, ColdSegment) or current.data_path != cold_path:
+                    self._segments[key] = ColdSegment(cold_path, index_path)
+        for key in list(self._segments):
+            if key not in found:
+                del self._segments[key]
+        self._recovered = True
+
+
+def _index_entry(visit: Dict, offset: int, length: int) -> Dict:
+    return {
+        'offset': offset,
+        'length': length,
+        'user_id': visit.get('user_id'),
+        'visit_timestamp': visit.get('visit_timestamp'),
+        'visit_code': visit.get('visit_code')
+    }
+
+
+def _scan_records(data_file, start: int) -> Iterator[Dict]:
+    """Index the complete records of a binary JSON Lines stream positioned at ``start``."""
+    offset = start
+    for raw in data_file:
+        if raw.endswith(b"\n") and raw.strip():
+            try:
+                yield _index_entry(json.loads(raw.decode('utf-8')), offset, len(raw))
+            except json.JSONDecodeError:
+                print(f"Skipping corrupt visit record at offset {offset}")
+        offset += len(raw)
+
+
+def _write_index(index_path: str, index: List[Dict]) -> None:
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as index_file:
+        for entry in index:
+            index_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, index_path)
+
+
+class ProfileStore:
+    """Keyed patient profile store with O(1) upsert and lookup by ``user_id``.
+
+    ``patient_info.json`` stays the snapshot (same array format as before). Upserts are
+    appended to a ``.journal`` JSON Lines file and fsynced, then applied to the in-memory
+    map. Once the journal grows as large as the snapshot it is folded back into a new
+    snapshot written to a temporary file and atomically renamed, which keeps the
+    amortised cost of an upsert constant as the number of patients grows.
+    """
+
+    def __init__(self, snapshot_path: str, min_compact_entries: int = 1000):
+        self.snapshot_path = snapshot_path
+        self.journal_path = snapshot_path + ".journal"
+        self.min_compact_entries = min_compact_entries
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._profiles: Optional[Dict[object, Dict]] = None
+        self._journal_entries = 0
+        self._version = None
+
+    def get(self, user_id) -> Optional[Dict]:
+        with self._lock:
+            return self._load().get(user_id)
+
+    def upsert(self, profile: Dict) -> None:
+        self.upsert_many([profile])
+
+    def upsert_many(self, profiles: Iterable[Dict]) -> None:
+        """Journal the profiles with a single fsync and apply them."""
+        profiles = list(profiles)
+        if not profiles:
+            return
+        with self._write_lock:
+            with self._lock:
+                self._load()
+            folder = os.path.dirname(self.journal_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            with open(self.journal_path, 'a', encoding='utf-8') as journal:
+                for profile in profiles:
+                    journal.write(json.dumps(profile, ensure_ascii=False) + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+            with self._lock:
+                current = self._load_after_write()
+                for profile in profiles:
+                    current[profile['user_id']] = profile
+                self._journal_entries += len(profiles)
+                snapshot = None
+                if self._journal_entries >= max(self.min_compact_entries, len(current)):
+                    snapshot = list(current.values())
+                self._version = self._files_version()
+            if snapshot is not None:
+                self._compact(snapshot)
+                with self._lock:
+                    self._journal_entries = 0
+                    self._version = self._files_version()
+
+    def values(self) -> List[Dict]:
+        with self._lock:
+            return list(self._load().values())
+
+    def _files_version(self):
+        return _file_version(self.snapshot_path), _file_version(self.journal_path)
+
+    def _load_after_write(self) -> Dict[object, Dict]:
+        # Our own journal append changed the file version; only reload if a reader
+        # has not already done so (the reload would include our entries anyway).
+        if self._profiles is None:
+            return self._load()
+        return self._profiles
+
+    def _load(self) -> Dict[object, Dict]:
+        version = self._files_version()
+        if self._profiles is not None and version == self._version:
+            return self._profiles
+
+        profiles: Dict[object, Dict] = {}
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                    for record in json.load(f):
+                        profiles[record['user_id']] = record
+            except json.JSONDecodeError:
+                # Empty or invalid file, start with an empty snapshot
+                print(f"Error reading profile snapshot {self.snapshot_path}")
+        entries = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line after a crash; the upsert was never acknowledged
+                        break
+                    profiles[record['user_id']] = record
+                    entries += 1
+
+        self._profiles = profiles
+        self._journal_entries = entries
+        self._version = version
+        return profiles
+
+    def _compact(self, profiles: List[Dict]) -> None:
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(profiles, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # The journal is only dropped once the snapshot that contains it is durable
+        with open(self.journal_path, 'w', encoding='utf-8'):
+            pass
+
+
+class Storage(ABC):
+    """Interface shared by the visit/profile storage backends.
+
+    Every stored visit has a backend-specific *location* (a segment offset or a row id) that
+    can be read back directly; ``VisitRepository`` keeps its in-memory index on top of it.
+    """
+
+    @abstractmethod
+    def add_visit(self, visit: Dict):
+        """Persist a visit and return its location."""
+
+    @abstractmethod
+    def add_visits(self, visits: List[Dict]) -> List:
+        """Persist several visits as one durable batch and return their locations."""
+
+    @abstractmethod
+    def read_visit(self, location) -> Dict:
+        """Read back the visit stored at ``location``."""
+
+    @abstractmethod
+    def iter_index(self) -> Iterator[Tuple]:
+        """Yield ``(location, user_id, visit_timestamp, visit_code)`` without decoding records."""
+
+    @abstractmethod
+    def data_version(self):
+        """Return a value that changes whenever the stored visits change (file mtimes)."""
+
+    @abstractmethod
+    def find_visit(self, user_id: int, timestamp: str) -> Optional[Dict]:
+        """Return the user's visit whose timestamp starts with ``timestamp`` (deep-link format accepted)."""
+
+    @abstractmethod
+    def get_visit_by_code(self, visit_code: str) -> Optional[Dict]:
+        """Return the first visit with ``visit_code``."""
+
+    @abstractmethod
+    def list_user_visits(self, user_id: int) -> List[Dict]:
+        """Return all visits of a user, oldest first."""
+
+    @abstractmethod
+    def list_user_visit_entries(self, user_id: int) -> List[Dict]:
+        """Return ``location``, ``visit_timestamp`` and ``visit_code`` of a user's visits, oldest first.
+
+        Served from the index alone, so listing history never reads (or decompresses) records.
+        """
+
+    @abstractmethod
+    def iter_visits(self) -> Iterator[Dict]:
+        """Yield every stored visit in storage order."""
+
+    @abstractmethod
+    def get_profile(self, user_id: int) -> Optional[Dict]:
+        """Return the stored profile of ``user_id``."""
+
+    @abstractmethod
+    def save_profile(self, profile: Dict) -> None:
+        """Insert or replace the profile with the same ``user_id``."""
+
+    @abstractmethod
+    def save_profiles(self, profiles: List[Dict]) -> None:
+        """Upsert several profiles as one durable batch."""
+
+    @abstractmethod
+    def iter_profiles(self) -> Iterator[Dict]:
+        """Yield every stored profile."""
+
+    @abstractmethod
+    def migrate_legacy(self, json_path: str) -> int:
+        """Import visits from a legacy ``patients.json`` array."""
+
+    def compact(self) -> int:
+        """Move closed data to cold storage; backends without one have nothing to do."""
+        return 0
+
+
+class JsonStorage(Storage):
+    """File layout: monthly visit log segments plus the ``patient_info.json`` array."""
+
+    def __init__(self, folder: str, profile_path: str, compression: str = 'gz'):
+        self.visit_log = PartitionedVisitLog(folder, compression=compression)
+        self.profiles = ProfileStore(profile_path)
+
+    def add_visit(self, visit: Dict) -> Tuple[str, int]:
+        return self.visit_log.append(visit)
+
+    def add_visits(self, visits: List[Dict]) -> List[Tuple[str, int]]:
+        return self.visit_log.append_many(visits)
+
+    def read_visit(self, location: Tuple[str, int]) -> Dict:
+        return self.visit_log.read_at(location)
+
+    def iter_index(self) -> Iterator[Tuple]:
+        for entry in self.visit_log.entries():
+            yield (entry['partition'], entry['offset']), entry.get('user_id'), \
+                entry.get('visit_timestamp'), entry.get('visit_code')
+
+    def data_version(self):
+        return self.visit_log.data_version()
+
+    def find_visit(self, user_id: int, timestamp: str) -> Optional[Dict]:
+        prefix = link_timestamp_prefix(timestamp)
+        # A prefix that names the month only needs that month's index
+        partition = partition_key(prefix) if len(prefix) >= 7 else None
+        if partition == UNDATED_PARTITION:
+            partition = None
+        for entry in self.visit_log.entries(partition):
+            if entry.get('user_id') == user_id and (entry.get('visit_timestamp') or '').startswith(prefix):
+                return self.visit_log.read_at((entry['partition'], entry['offset']))
+        return None
+
+    def get_visit_by_code(self, visit_code: str) -> Optional[Dict]:
+        for entry in self.visit_log.entries():
+            if entry.get('visit_code') == visit_code:
+                return self.visit_log.read_at((entry['partition'], entry['offset']))
+        return None
+
+    def list_user_visits(self, user_id: int) -> List[Dict]:
+        return [self.read_visit(entry['location']) for entry in self.list_user_visit_entries(user_id)]
+
+    def list_user_visit_entries(self, user_id: int) -> List[Dict]:
+        return [{'location': (entry['partition'], entry['offset']),
+                 'user_id': user_id,
+                 'visit_timestamp': entry.get('visit_timestamp'),
+                 'visit_code': entry.get('visit_code')}
+                for entry in self.visit_log.entries() if entry.get('user_id') == user_id]
+
+    def iter_visits(self) -> Iterator[Dict]:
+        return self.visit_log.iter_visits()
+
+    def get_profile(self, user_id: int) -> Optional[Dict]:
+        return self.profiles.get(user_id)
+
+    def save_profile(self, profile: Dict) -> None:
+        self.profiles.upsert(profile)
+
+    def save_profiles(self, profiles: List[Dict]) -> None:
+        self.profiles.upsert_many(profiles)
+
+    def iter_profiles(self) -> Iterator[Dict]:
+        return iter(self.profiles.values())
+
+    def migrate_legacy(self, json_path: str) -> int:
+        migrated = self.visit_log.migrate_single_log()
+        return migrated + self.visit_log.migrate_from_json(json_path)
+
+    def compact(self) -> int:
+        return self.visit_log.compact()
+
+
+class SqliteStorage(Storage):
+    """SQLite (WAL mode) backend with indexes on ``(user_id, visit_timestamp)`` and ``visit_code``.
+
+    The full visit record is kept as a JSON document; only the looked-up columns are
+    broken out so that every read path is an indexed point or range query.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS visits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            visit_timestamp TEXT NOT NULL,
+            visit_code TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_visits_user_timestamp ON visits (user_id, visit_timestamp);
+        CREATE INDEX IF NOT EXISTS idx_visits_code ON visits (visit_code);
+        CREATE TABLE IF NOT EXISTS profiles (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # WAL lets readers run while a write transaction commits, so reads and writes
+        # use separate connections and locks.
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._write_conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._write_conn.execute("PRAGMA journal_mode=WAL")
+        self._write_conn.execute("PRAGMA synchronous=FULL")
+        self._write_conn.executescript(self.SCHEMA)
+        self._write_conn.commit()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+
+    def add_visit(self, visit: Dict) -> int:
+        return self.add_visits([visit])[0]
+
+    def add_visits(self, visits: Iterable[Dict]) -> List[int]:
+        """Insert visits in one transaction and return their row ids."""
+        with self._write_lock, self._write_conn:
+            return [self._insert_visit(v) for v in visits]
+
+    def import_visits(self, visits: Iterable[Dict]) -> int:
+        """Insert visits that are not stored yet (matched on user, timestamp and code) in one transaction."""
+        imported, seen = 0, set()
+        with self._write_lock, self._write_conn:
+            for v in visits:
+                if not isinstance(v, dict):
+                    continue
+                key = (v.get('user_id'), v.get('visit_timestamp') or '', v.get('visit_code'))
+                if key in seen:
+                    continue
+                seen.add(key)
+                # Served by the (user_id, visit_timestamp) index
+                if self._write_conn.execute(
+                        "SELECT 1 FROM visits WHERE user_id = ? AND visit_timestamp = ? AND visit_code IS ? LIMIT 1",
+                        key).fetchone():
+                    continue
+                self._insert_visit(v)
+                imported += 1
+        return imported
+
+    def read_visit(self, location: int) -> Dict:
+        return self._fetch_one("SELECT data FROM visits WHERE id = ?", (location,))
+
+    def iter_index(self) -> Iterator[Tuple]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, user_id, visit_timestamp, visit_code FROM visits ORDER BY id").fetchall()
+        return iter(rows)
+
+    def data_version(self):
+        # Committed WAL transactions touch the -wal file before they are checkpointed
+        return _file_version(self.db_path), _file_version(self.db_path + '-wal')
+
+    def find_visit(self, user_id: int, timestamp: str) -> Optional[Dict]:
+        prefix = link_timestamp_prefix(timestamp)
+        # Prefix match expressed as a range so the (user_id, visit_timestamp) index is used
+        return self._fetch_one(
+            "SELECT data FROM visits WHERE user_id = ? AND visit_timestamp >= ? AND visit_timestamp < ? "
+            "ORDER BY visit_timestamp LIMIT 1",
+            (user_id, prefix, prefix + '\uffff'))
+
+    def get_visit_by_code(self, visit_code: str) -> Optional[Dict]:
+        return self._fetch_one("SELECT data FROM visits WHERE visit_code = ? LIMIT 1", (visit_code,))
+
+    def list_user_visits(self, user_id: int) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM visits WHERE user_id = ? ORDER BY visit_timestamp", (user_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def list_user_visit_entries(self, user_id: int) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, visit_timestamp, visit_code FROM visits WHERE user_id = ? ORDER BY visit_timestamp",
+                (user_id,)).fetchall()
+        return [{'location': row_id, 'user_id': user_id, 'visit_timestamp': visit_timestamp, 'visit_code': visit_code}
+                for row_id, visit_timestamp, visit_code in rows]
+
+    def iter_visits(self) -> Iterator[Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM visits ORDER BY id").fetchall()
+        return (json.loads(row[0]) for row in rows)
+
+    def get_profile(self, user_id: int) -> Optional[Dict]:
+        return self._fetch_one("SELECT data FROM profiles WHERE user_id = ?", (user_id,))
+
+    def save_profile(self, profile: Dict) -> None:
+        self.save_profiles([profile])
+
+    def save_profiles(self, profiles: Iterable[Dict]) -> None:
+        rows = [(p['user_id'], json.dumps(p, ensure_ascii=False)) for p in profiles]
+        with self._write_lock, self._write_conn:
+            self._write_conn.executemany(
+                "INSERT INTO profiles (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data", rows)
+
+    def iter_profiles(self) -> Iterator[Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM profiles").fetchall()
+        return (json.loads(row[0]) for row in rows)
+
+    def migrate_legacy(self, json_path: str) -> int:
+        if not os.path.exists(json_path):
+            return 0
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                visits = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Error: cannot migrate invalid JSON file {json_path}")
+            return 0
+        # Deduplicated, so a run interrupted before the rename can simply be repeated
+        migrated = self.import_visits(visits)
+        os.replace(json_path, json_path + ".migrated")
+        print(f"Migrated {migrated} visits from {json_path} to {self.db_path}")
+        return migrated
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            visit_row = self._conn.execute("SELECT 1 FROM visits LIMIT 1").fetchone()
+            profile_row = self._conn.execute("SELECT 1 FROM profiles LIMIT 1").fetchone()
+        return visit_row is None and profile_row is None
+
+    def _insert_visit(self, v: Dict) -> int:
+        # Caller holds _write_lock inside a transaction on _write_conn
+        cursor = self._write_conn.execute(
+            "INSERT INTO visits (user_id, visit_timestamp, visit_code, data) VALUES (?, ?, ?, ?)",
+            (v.get('user_id'), v.get('visit_timestamp') or '', v.get('visit_code'),
+             json.dumps(v, ensure_ascii=False)))
+        return cursor.lastrowid
+
+    def _fetch_one(self, query: str, params: tuple) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def _file_version(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def create_storage(backend: str, folder: str, profile_path: str) -> Storage:
+    """Build the configured storage backend (``json`` or ``sqlite``).
+
+    A fresh SQLite database is seeded from the JSON files so switching backends keeps history.
+    """
+    backend = (backend or 'json').lower()
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend '{backend}', expected one of {STORAGE_BACKENDS}")
+
+    json_storage = JsonStorage(folder, profile_path)
+    if backend == 'json':
+        return json_storage
+
+    sqlite_storage = SqliteStorage(os.path.join(folder, SQLITE_DB_FILE))
+    if sqlite_storage.is_empty():
+        json_storage.visit_log.migrate_single_log()
+        sqlite_storage.add_visits(json_storage.iter_visits())
+        sqlite_storage.save_profiles(json_storage.iter_profiles())
+    return sqlite_storage
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+# The bot's modules are flat scripts next to this folder rather than an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+    """Stands in for a module's ``time``; both clocks only move when a test advances ``now``."""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock_module():
+    """The module whose ``time`` the ``clock`` fixture replaces; test files override this fixture."""
+    raise pytest.UsageError("override the clock_module fixture to use the clock")
+
+
+@pytest.fixture
+def clock(monkeypatch, clock_module):
+    clock = FakeClock()
+    monkeypatch.setattr(clock_module, 'time', clock)
+    return clock
@@ -0,0 +1,149 @@
+import asyncio
+
+import httpx
+import pytest
+
+import LLMs
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from latency import AdaptiveTimeouts
+from rate_limiter import RateLimiter
+
+
+@pytest.fixture
+def clock_module():
+    return circuit_breaker
+
+
+def breaker(window=10, min_calls=4, slow_call_seconds=5, open_seconds=30):
+    return CircuitBreaker('test', window=window, min_calls=min_calls, failure_rate=0.5,
+                          slow_call_seconds=slow_call_seconds, open_seconds=open_seconds)
+
+
+def trip(b):
+    for _ in range(b.min_calls):
+        assert b.allow()
+        b.record(False)
+
+
+def test_stays_closed_below_min_calls_or_failure_rate(clock):
+    b = breaker()
+    for succeeded in (False, False, False):
+        b.record(succeeded)
+    assert b.state == CLOSED
+
+    b = breaker()
+    for succeeded in (True, True, True, False, True):
+        b.record(succeeded)
+    assert b.state == CLOSED
+
+
+def test_opens_on_failures_and_rejects_calls(clock):
+    b = breaker()
+    trip(b)
+
+    assert b.state == OPEN
+    assert not b.allow()
+    assert b.snapshot()['rejected'] == 1
+
+
+def test_slow_calls_count_as_failures(clock):
+    b = breaker()
+    for _ in range(4):
+        b.record(True, duration=6)
+
+    assert b.state == OPEN
+
+
+def test_half_open_after_the_cool_down_lets_one_probe_through(clock):
+    b = breaker()
+    trip(b)
+    clock.now += 30
+
+    assert b.state == HALF_OPEN
+    assert b.allow()
+    assert not b.allow()
+
+
+def test_a_successful_probe_closes_the_circuit(clock):
+    b = breaker()
+    trip(b)
+    clock.now += 30
+    b.allow()
+
+    b.record(True, duration=1)
+
+    assert b.state == CLOSED
+    assert b.snapshot()['recent_calls'] == 0
+
+
+def test_a_failed_probe_reopens_the_circuit(clock):
+    b = breaker()
+    trip(b)
+    clock.now += 30
+    b.allow()
+
+    b.record(False)
+
+    assert b.state == OPEN
+    clock.now += 29
+    assert b.state == OPEN
+    clock.now += 1
+    assert b.state == HALF_OPEN
+
+
+def test_a_cancelled_probe_frees_its_slot(clock):
+    b = breaker()
+    trip(b)
+    clock.now += 30
+    assert b.allow()
+
+    b.cancel(duration=1)
+
+    assert b.state == HALF_OPEN
+    assert b.allow()
+
+
+def test_a_slow_cancelled_call_counts_as_a_failure(clock):
+    b = breaker()
+    trip(b)
+    clock.now += 30
+    b.allow()
+
+    b.cancel(duration=6)
+
+    assert b.state == OPEN
+
+
+def test_cancelled_calls_are_not_recorded_while_closed(clock):
+    b = breaker()
+    for _ in range(4):
+        b.allow()
+        b.cancel(duration=1)
+
+    assert b.state == CLOSED
+    assert b.snapshot()['recent_calls'] == 0
+
+
+def test_long_successful_completions_do_not_open_the_breaker(clock, monkeypatch):
+    def answer_slowly(request):
+        # A 2000-token completion legitimately takes longer than the slow-call threshold
+        clock.now += 60
+        return httpx.Response(200, json={'choices': [{'message': {'content': "پاسخ"}}]})
+
+    b = breaker(min_calls=2, slow_call_seconds=30)
+    monkeypatch.setattr(LLMs, 'time', clock)
+    monkeypatch.setattr(LLMs, 'mistral_breaker', b)
+    monkeypatch.setattr(LLMs, 'adaptive_timeouts', AdaptiveTimeouts())
+    monkeypatch.setattr(LLMs, 'mistral_rate_limiter', RateLimiter(requests_per_second=1000, tokens_per_minute=10 ** 9))
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(answer_slowly)) as client:
+            monkeypatch.setattr(LLMs, 'get_async_client', lambda: client)
+            data = LLMs._chat_payload("سوال", max_tokens=2000)
+            for _ in range(4):
+                await LLMs.make_api_request({}, data, timeout=90)
+
+    asyncio.run(main())
+    assert b.state == CLOSED
+    assert b.snapshot()['recent_failures'] == 0
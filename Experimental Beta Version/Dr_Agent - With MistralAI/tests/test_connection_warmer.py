@@ -0,0 +1,82 @@
+import asyncio
+
+import httpx
+
+from connection_warmer import ConnectionWarmer
+
+URL = "http://localhost:8080/v1"
+
+
+class Server:
+    """Mock transport that counts HEAD requests and can refuse connections."""
+
+    def __init__(self, status=405, refuse=False):
+        self.status = status
+        self.refuse = refuse
+        self.requests = []
+
+    def __call__(self, request):
+        if self.refuse:
+            raise httpx.ConnectError("connection refused", request=request)
+        self.requests.append(request)
+        return httpx.Response(self.status)
+
+    def client(self):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self))
+
+
+def make_warmer(server, **settings):
+    client = server.client()
+    return ConnectionWarmer(lambda: client, [URL], **settings)
+
+
+def test_warm_up_opens_the_configured_number_of_connections():
+    server = Server()
+    warmer = make_warmer(server, connections=3)
+
+    warmed = asyncio.run(warmer.warm_up())
+
+    assert warmed[URL] is not None and warmed[URL] >= 0
+    assert [request.method for request in server.requests] == ['HEAD'] * 3
+
+
+def test_any_http_status_counts_as_warmed():
+    warmed = asyncio.run(make_warmer(Server(status=503)).warm_up())
+
+    assert warmed[URL] is not None
+
+
+def test_refused_connections_are_reported_as_failed():
+    warmed = asyncio.run(make_warmer(Server(refuse=True)).warm_up())
+
+    assert warmed == {URL: None}
+
+
+def test_keepalive_pings_run_until_stopped():
+    server = Server()
+    warmer = make_warmer(server, connections=1, interval=0.01)
+
+    async def scenario():
+        warmer.start()
+        warmer.start()
+        await asyncio.sleep(0.05)
+        await warmer.stop()
+        pinged = len(server.requests)
+        await asyncio.sleep(0.03)
+        return pinged
+
+    pinged = asyncio.run(scenario())
+
+    assert pinged >= 2
+    assert len(server.requests) == pinged
+    assert warmer._task is None
+
+
+def test_no_pings_without_an_interval():
+    warmer = make_warmer(Server(), interval=0)
+
+    async def scenario():
+        warmer.start()
+        return warmer._task
+
+    assert asyncio.run(scenario()) is None
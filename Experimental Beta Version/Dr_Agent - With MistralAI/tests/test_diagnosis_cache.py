@@ -0,0 +1,115 @@
+import pytest
+
+import diagnosis_cache
+from diagnosis_cache import (CHECKED, FREE_TEXT_IGNORE, DiagnosisCache, canonical_profile, checked_symptoms,
+                             profile_key)
+
+
+@pytest.fixture
+def clock_module():
+    return diagnosis_cache
+
+
+def intake(answers, **fields):
+    return {'name': "علی", 'age': 30, 'gender': "مرد", 'answers': answers, 'extra_info': '', **fields}
+
+
+ANSWERS = {
+    'تب': {'answer': CHECKED, 'description': "تب بالای ۳۸ درجه"},
+    'تنفسی': [
+        {'answer': CHECKED, 'description': "سرفه  خشک"},
+        {'answer': '❌', 'description': "تنگی نفس"},
+        {'answer': CHECKED, 'description': "گلودرد"}
+    ],
+    'گوارشی': {'answer': '❌', 'description': "تهوع"}
+}
+
+
+def key(patient_data, patient_info=None, **options):
+    return profile_key(canonical_profile(patient_data, patient_info or {}, **options))
+
+
+def test_checked_symptoms_keep_intake_order():
+    assert checked_symptoms(ANSWERS) == [('تب', ["تب بالای ۳۸ درجه"]), ('تنفسی', ["سرفه  خشک", "گلودرد"])]
+
+
+def test_key_ignores_name_answer_order_and_whitespace():
+    reordered = {
+        'تنفسی': [{'answer': CHECKED, 'description': "گلودرد"}, {'answer': CHECKED, 'description': "سرفه خشک"}],
+        'تب': {'answer': CHECKED, 'description': "تب بالای ۳۸ درجه"}
+    }
+
+    assert key(intake(ANSWERS)) == key(intake(reordered, name="مریم"))
+
+
+def test_key_changes_with_age_gender_symptoms_mode_and_model():
+    base = key(intake(ANSWERS))
+    fewer = dict(ANSWERS, تب={'answer': '❌', 'description': "تب"})
+
+    assert key(intake(ANSWERS, age=31)) != base
+    assert key(intake(ANSWERS), {'gender': "زن"}) != base
+    assert key(intake(fewer)) != base
+    assert key(intake(ANSWERS), mode='json') != base
+    assert key(intake(ANSWERS), model='mistral/mistral-medium') != base
+
+
+def test_stored_profile_takes_precedence_over_the_intake():
+    assert key(intake(ANSWERS, age=40), {'age': "30"}) == key(intake(ANSWERS, age=30))
+
+
+def test_free_text_bypasses_the_cache_unless_ignored():
+    with_history = intake(ANSWERS, extra_info="حساسیت به پنی‌سیلین")
+
+    assert canonical_profile(with_history, {}) is None
+    assert canonical_profile(intake(ANSWERS, extra_info="ندارم"), {}) is not None
+    assert key(with_history, free_text=FREE_TEXT_IGNORE) == key(intake(ANSWERS), free_text=FREE_TEXT_IGNORE)
+    with pytest.raises(ValueError):
+        canonical_profile(with_history, {}, free_text='sometimes')
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = DiagnosisCache(ttl=60)
+    cache.put("k", "diagnosis")
+
+    clock.now += 60
+    assert cache.get("k") == "diagnosis"
+    clock.now += 1
+    assert cache.get("k") is None
+    assert cache.stats() == {'entries': 0, 'hits': 1, 'misses': 1, 'stores': 1}
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    cache = DiagnosisCache(max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.get("a")
+    cache.put("c", "C")
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("A", "C")
+
+
+def test_disk_tier_survives_restarts_and_keeps_hit_counts(clock, tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = DiagnosisCache(path=path)
+    cache.put("k", "diagnosis")
+    cache.get("k")
+    cache.close()
+
+    reopened = DiagnosisCache(path=path)
+    assert reopened.get("k") == "diagnosis"
+    assert reopened.entry_stats()[0]['hits'] == 2
+    reopened.close()
+
+
+def test_expired_disk_entries_are_deleted(clock, tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = DiagnosisCache(ttl=60, path=path)
+    cache.put("k", "diagnosis")
+    cache.close()
+
+    clock.now += 61
+    reopened = DiagnosisCache(ttl=60, path=path)
+    assert reopened.get("k") is None
+    assert reopened._db().execute("SELECT COUNT(*) FROM diagnoses").fetchone()[0] == 0
+    reopened.close()
@@ -0,0 +1,117 @@
+import json
+
+import pytest
+
+from diagnosis_parser import (DEFAULT_RECOMMENDATION, DISCLAIMER, SOURCE_JSON, SOURCE_TEXT, parse_diagnosis,
+                              parse_structured, visit_diagnosis_fields)
+
+STRUCTURED = {
+    "differential": [{"condition": "سرماخوردگی", "reason": "آبریزش بینی"}, "آنفلوانزا"],
+    "urgency": "متوسط",
+    "urgency_reason": "تب طولانی",
+    "explanation": "علائم ویروسی است.",
+    "recommendations": ["استراحت", "  ", "مایعات فراوان"],
+    "warnings": "در صورت تنگی نفس به اورژانس بروید"
+}
+
+FREE_TEXT = """📋 ۱. تشخیص‌های احتمالی:
+• سرماخوردگی: آبریزش بینی و عطسه
+• آنفلوانزا
+
+⚕️ ۲. سطح فوریت:
+متوسط - تب بیش از سه روز
+
+💊 ۳. توصیه‌های ایمن:
+داروها:
+- استامینوفن
+- استراحت کافی
+
+⚠️ ۴. اقدامات اضطراری:
+1) تنگی نفس
+"""
+
+
+def test_json_response_is_validated_and_rendered():
+    response = "```json\n" + json.dumps(STRUCTURED, ensure_ascii=False) + "\n```"
+
+    text, fields = parse_diagnosis(response)
+
+    assert fields['source'] == SOURCE_JSON
+    assert fields['differential'] == [{'condition': "سرماخوردگی", 'reason': "آبریزش بینی"},
+                                      {'condition': "آنفلوانزا", 'reason': ""}]
+    assert fields['urgency'] == 'medium'
+    assert fields['recommendations'] == ["استراحت", "مایعات فراوان"]
+    assert fields['warnings'] == ["در صورت تنگی نفس به اورژانس بروید"]
+    assert "• سرماخوردگی: آبریزش بینی" in text
+    assert "متوسط - تب طولانی" in text
+    assert text.endswith(DISCLAIMER)
+
+
+def test_rendered_json_parses_back_to_the_same_fields():
+    text, fields = parse_diagnosis(json.dumps(STRUCTURED, ensure_ascii=False))
+
+    reparsed = parse_diagnosis(text)[1]
+
+    assert reparsed['source'] == SOURCE_TEXT
+    assert reparsed['differential'] == fields['differential']
+    assert reparsed['urgency'] == fields['urgency']
+    assert reparsed['recommendations'] == fields['recommendations']
+    assert reparsed['warnings'] == fields['warnings']
+
+
+@pytest.mark.parametrize("response", [
+    '{"differential": []}',
+    '{"differential": [{"reason": "no condition"}]}',
+    '{"differential": ["a"], "urgency": "someday"}',
+    '{"differential": ["a"], "recommendations": [1, 2]}',
+    '["a"]',
+    '{"differential": ["a"],',
+])
+def test_invalid_json_is_rejected(response):
+    with pytest.raises(ValueError):
+        parse_structured(response)
+
+
+def test_invalid_json_falls_back_to_the_text_as_written():
+    text, fields = parse_diagnosis('{"differential": []}')
+
+    assert text == '{"differential": []}'
+    assert fields['source'] == SOURCE_TEXT
+
+
+def test_free_text_is_split_by_section_headings():
+    text, fields = parse_diagnosis(FREE_TEXT)
+
+    assert text == FREE_TEXT.strip()
+    assert fields['differential'] == [{'condition': "سرماخوردگی", 'reason': "آبریزش بینی و عطسه"},
+                                      {'condition': "آنفلوانزا", 'reason': ""}]
+    assert fields['urgency'] == 'medium'
+    assert fields['urgency_reason'] == "متوسط - تب بیش از سه روز"
+    assert fields['recommendations'] == ["استامینوفن", "استراحت کافی"]
+    assert fields['warnings'] == ["تنگی نفس"]
+
+
+def test_free_text_without_recommendations_uses_treatment_lines():
+    fields = parse_diagnosis("سرماخوردگی محتمل است.\nدرمان: استراحت و مایعات.\nدرمان: استراحت و مایعات.")[1]
+    assert fields['recommendations'] == ["درمان: استراحت و مایعات."]
+    assert fields['differential'] == []
+    assert fields['urgency'] is None
+
+    assert parse_diagnosis("")[1]['recommendations'] == [DEFAULT_RECOMMENDATION]
+
+
+def test_sentences_starting_with_a_section_word_stay_content():
+    fields = parse_diagnosis("توصیه‌ها:\nتوصیه می‌شود روزانه هشت لیوان آب بنوشید و استراحت کنید تا بهبود یابید")[1]
+
+    assert fields['recommendations'] == ["توصیه می‌شود روزانه هشت لیوان آب بنوشید و استراحت کنید تا بهبود یابید"]
+
+
+def test_visit_fields_are_parsed_once_and_kept():
+    visit = {'diagnosis': FREE_TEXT}
+
+    fields = visit_diagnosis_fields(visit)
+
+    assert visit['diagnosis_fields'] is fields
+    assert visit_diagnosis_fields(visit) is fields
+    stored = {'diagnosis': FREE_TEXT, 'diagnosis_fields': {'source': SOURCE_JSON}}
+    assert visit_diagnosis_fields(stored) == {'source': SOURCE_JSON}
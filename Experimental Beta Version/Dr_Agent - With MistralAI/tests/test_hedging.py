@@ -0,0 +1,160 @@
+import asyncio
+
+import pytest
+
+from hedging import HedgePolicy, hedged_call, hedged_stream
+from latency import LatencyTracker
+
+
+def make_policy(**settings):
+    settings.setdefault('enabled', True)
+    settings.setdefault('delay', 0.01)
+    return HedgePolicy(**settings)
+
+
+class Calls:
+    """Hands out scripted coroutines in call order and remembers which got cancelled."""
+
+    def __init__(self, *scripts):
+        self.scripts = list(scripts)
+        self.started = 0
+        self.cancelled = []
+
+    def __call__(self):
+        index = self.started
+        self.started += 1
+        return self._run(index, self.scripts[index])
+
+    async def _run(self, index, script):
+        delay, outcome = script
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(index)
+            raise
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def test_hedge_delay_follows_the_latency_percentile():
+    tracker = LatencyTracker()
+    policy = HedgePolicy(tracker=tracker, initial_delay=10, min_samples=4, percentile=75)
+    assert policy.hedge_delay() == 10
+
+    for seconds in (1, 2, 3, 4):
+        tracker.record(seconds)
+    assert policy.hedge_delay() == 3
+
+    assert HedgePolicy(delay=0.5, tracker=tracker).hedge_delay() == 0.5
+
+
+def test_disabled_policy_makes_a_single_call():
+    policy = make_policy(enabled=False)
+    calls = Calls((0.05, 'primary'), (0, 'hedge'))
+
+    assert asyncio.run(hedged_call(policy, calls)) == 'primary'
+    assert calls.started == 1
+    assert policy.requests == 0
+
+
+def test_fast_primary_is_not_hedged():
+    policy = make_policy(delay=1)
+    calls = Calls((0, 'primary'), (0, 'hedge'))
+
+    assert asyncio.run(hedged_call(policy, calls)) == 'primary'
+    assert calls.started == 1
+    assert policy.snapshot()['hedged'] == 0
+
+
+def test_slow_primary_loses_to_the_hedge_and_is_cancelled():
+    policy = make_policy()
+    calls = Calls((5, 'primary'), (0, 'hedge'))
+
+    assert asyncio.run(hedged_call(policy, calls)) == 'hedge'
+    assert calls.cancelled == [0]
+    assert (policy.hedged, policy.hedge_wins, policy.primary_wins) == (1, 1, 0)
+
+
+def test_losing_hedge_is_cancelled_when_the_primary_wins():
+    policy = make_policy()
+    calls = Calls((0.05, 'primary'), (5, 'hedge'))
+
+    assert asyncio.run(hedged_call(policy, calls)) == 'primary'
+    assert calls.cancelled == [1]
+    assert policy.primary_wins == 1
+
+
+def test_failed_call_does_not_end_the_race():
+    policy = make_policy()
+    calls = Calls((0.05, 'primary'), (0, ValueError("boom")))
+
+    assert asyncio.run(hedged_call(policy, calls)) == 'primary'
+
+
+def test_race_fails_only_when_both_calls_fail():
+    policy = make_policy()
+    calls = Calls((0.02, ValueError("first")), (0.05, ValueError("second")))
+
+    with pytest.raises(ValueError, match="first"):
+        asyncio.run(hedged_call(policy, calls))
+
+
+def test_cancelling_the_caller_cancels_the_primary():
+    policy = make_policy(delay=5)
+    calls = Calls((5, 'primary'))
+
+    async def scenario():
+        task = asyncio.ensure_future(hedged_call(policy, calls))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert calls.cancelled == [0]
+
+
+class Streams:
+    """Opens scripted streams: each yields its items after a first-item delay."""
+
+    def __init__(self, *scripts):
+        self.scripts = list(scripts)
+        self.opened = 0
+        self.closed = []
+
+    def __call__(self):
+        index = self.opened
+        self.opened += 1
+        return self._stream(index, *self.scripts[index])
+
+    async def _stream(self, index, delay, items):
+        try:
+            await asyncio.sleep(delay)
+            for item in items:
+                yield item
+        finally:
+            self.closed.append(index)
+
+
+def collect(policy, streams):
+    async def scenario():
+        return [item async for item in hedged_stream(policy, streams)]
+    return asyncio.run(scenario())
+
+
+def test_stream_that_yields_first_wins_and_the_other_is_closed():
+    policy = make_policy()
+    streams = Streams((5, ['slow']), (0, ['fast', 'er']))
+
+    assert collect(policy, streams) == ['fast', 'er']
+    assert sorted(streams.closed) == [0, 1]
+    assert policy.hedge_wins == 1
+
+
+def test_fast_stream_is_not_hedged():
+    policy = make_policy(delay=1)
+    streams = Streams((0, ['a', 'b']))
+
+    assert collect(policy, streams) == ['a', 'b']
+    assert policy.hedged == 0
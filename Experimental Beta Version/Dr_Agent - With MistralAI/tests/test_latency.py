@@ -0,0 +1,92 @@
+import httpx
+import pytest
+
+import LLMs
+from latency import AdaptiveTimeouts, LatencyTracker, prompt_size_bucket
+from retry_policy import RetryMetrics, RetryPolicy
+
+
+def learned(samples):
+    timeouts = AdaptiveTimeouts(percentile=100, margin=1.5, min_samples=5)
+    for seconds in samples:
+        timeouts.record_read('m', 300, 500, seconds)
+    return timeouts
+
+
+def test_percentile_of_recent_samples():
+    tracker = LatencyTracker(window=4)
+    for seconds in (9, 1, 2, 3, 4):
+        tracker.record(seconds)
+
+    assert tracker.percentile(50) == 2
+    assert tracker.percentile(100) == 4
+    assert LatencyTracker().percentile(50) is None
+
+
+def test_prompt_sizes_share_buckets():
+    assert prompt_size_bucket(250) == prompt_size_bucket(1) == 250
+    assert prompt_size_bucket(251) == 500
+    assert prompt_size_bucket(10 ** 6) == prompt_size_bucket(9000)
+
+
+def test_defaults_apply_until_enough_samples():
+    assert learned([20] * 4).timeouts('m', 300, 500, 15, 90) == (15, 90)
+
+
+def test_fast_models_get_shorter_timeouts_but_not_below_the_floor():
+    assert learned([20] * 5).timeouts('m', 300, 500, 15, 90) == (15, 30)
+    assert learned([1] * 5).timeouts('m', 300, 500, 15, 90) == (15, 10)
+
+
+def test_learned_timeouts_never_exceed_the_callers_timeout():
+    assert learned([80] * 5).timeouts('m', 300, 500, 15, 90) == (15, 90)
+
+
+def test_a_nearly_spent_budget_bounds_learned_timeouts_and_floors():
+    budget = RetryPolicy(total_budget=120, attempt_timeout=90, metrics=RetryMetrics()).begin('op')
+    budget.deadline -= 100
+    timeout = budget.start_attempt()
+    assert timeout == pytest.approx(20, abs=0.1)
+
+    # A slow model would learn 120s and a fast one the 10s floor; neither may outlast the budget
+    assert learned([80] * 5).timeouts('m', 300, 500, 15, timeout)[1] == timeout
+    assert learned([1] * 5).timeouts('m', 300, 500, 15, timeout)[1] == 10
+    assert learned([1] * 5).timeouts('m', 300, 500, 2, 5) == (2, 5)
+
+
+def test_timed_out_calls_raise_the_learned_timeout():
+    timeouts = learned([20] * 5)
+    assert timeouts.timeouts('m', 300, 500, 15, 90)[1] == 30
+
+    # Each timeout is recorded as a sample at the timeout that fired
+    timeouts.record_read('m', 300, 500, 30)
+
+    assert timeouts.timeouts('m', 300, 500, 15, 90)[1] == 45
+
+
+def test_sparse_buckets_fall_back_to_the_model_history():
+    timeouts = learned([20] * 5)
+
+    assert timeouts.timeouts('m', 5000, 500, 15, 90) == (15, 30)
+    assert timeouts.timeouts('m', 300, 1000, 15, 90) == (15, 90)
+
+
+def test_connect_timeouts_are_learned_per_model():
+    timeouts = AdaptiveTimeouts(percentile=100, margin=2, min_samples=3)
+    for seconds in (1, 2, 4):
+        timeouts.record_connect('m', seconds)
+
+    assert timeouts.timeouts('m', 300, 500, 15, 90) == (8, 90)
+    assert timeouts.timeouts('other', 300, 500, 15, 90) == (15, 90)
+
+
+def test_request_timeouts_are_recorded_as_censored_samples(monkeypatch):
+    timeouts = AdaptiveTimeouts(percentile=100, margin=1, min_samples=1)
+    monkeypatch.setattr(LLMs, 'adaptive_timeouts', timeouts)
+
+    LLMs._record_timeout(httpx.ReadTimeout("read"), 'm', 'm:stream', 300, 500, 15, 40)
+    LLMs._record_timeout(httpx.ConnectTimeout("connect"), 'm', 'm:stream', 300, 500, 12, 40)
+    LLMs._record_timeout(httpx.ConnectError("refused"), 'm', 'm:stream', 300, 500, 99, 99)
+
+    assert timeouts.timeouts('m:stream', 300, 500, 15, 90) == (15, 40)
+    assert timeouts.timeouts('m', 300, 500, 15, 90) == (12, 90)
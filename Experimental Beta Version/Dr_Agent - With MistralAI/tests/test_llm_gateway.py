@@ -0,0 +1,183 @@
+import asyncio
+
+import pytest
+
+import LLMs
+from LLMs import RetryableAPIError
+from llm_gateway import LLMGateway, LLMProvider, MockProvider, NoProviderAvailable, create_gateway
+from retry_policy import RetryMetrics, RetryPolicy
+
+
+def test_sync_wrapper_runs_a_gateway_completion(monkeypatch):
+    monkeypatch.setattr(LLMs, '_script_gateway', LLMGateway([MockProvider(latency=0, response="پاسخ")]))
+
+    assert LLMs.call_language_model("سوال") == "پاسخ"
+
+
+def test_sync_wrapper_falls_back_when_no_provider_answers(monkeypatch):
+    provider = MockProvider(latency=0)
+    provider.available = lambda: False
+    monkeypatch.setattr(LLMs, '_script_gateway', LLMGateway([provider]))
+
+    assert LLMs.call_language_model("سوال") == LLMs.FALLBACK_RESPONSE
+
+
+def named(name, latency=0.0, response=None):
+    provider = MockProvider(latency=latency, response=response)
+    provider.name = name
+    return provider
+
+
+def test_streams_do_not_feed_time_to_first_token_into_completion_ranking():
+    slow_first_token = named('a', response="x" * 200)
+    fast = named('b')
+    gateway = LLMGateway([slow_first_token, fast])
+    gateway._latency['a'].record(1.0)
+    gateway._latency['b'].record(2.0)
+
+    async def stream():
+        return [delta async for delta in gateway.stream("q")]
+
+    # 'a' streams first; its near-zero first token time must not count as a completion latency
+    asyncio.run(stream())
+
+    assert gateway._latency['a'].percentile(50) == 1.0
+    assert [p.name for p in gateway.ranked()] == ['a', 'b']
+    assert gateway.snapshot()['a']['p50_first_token'] is not None
+    assert gateway.snapshot()['b']['p50_first_token'] is None
+
+
+def test_streams_are_ranked_on_time_to_first_token():
+    gateway = LLMGateway([named('a', response="from a"), named('b', response="from b")])
+    gateway._latency['a'].record(1.0)
+    gateway._latency['b'].record(2.0)
+    gateway._first_token['a'].record(0.9)
+    gateway._first_token['b'].record(0.2)
+
+    async def stream():
+        return "".join([delta async for delta in gateway.stream("q")])
+
+    assert [p.name for p in gateway.ranked(streaming=True)] == ['b', 'a']
+    assert asyncio.run(stream()) == "from b"
+    assert asyncio.run(gateway.complete("q")) == "from a"
+
+
+class Scripted(LLMProvider):
+    """Provider that plays back ``outcomes`` (answers or exceptions) one call at a time."""
+
+    def __init__(self, name, *outcomes):
+        self.name = name
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def complete(self, prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def make_gateway(*providers, **settings):
+    settings.setdefault('base_delay', 0)
+    settings.setdefault('max_delay', 0)
+    return LLMGateway(list(providers), RetryPolicy(metrics=RetryMetrics(), **settings))
+
+
+def test_retryable_failure_fails_over_to_the_next_provider():
+    first = Scripted('a', RetryableAPIError("HTTP 503"))
+    second = Scripted('b', "from b")
+    gateway = make_gateway(first, second)
+
+    assert asyncio.run(gateway.complete("q")) == "from b"
+    assert gateway.snapshot()['a']['error_rate'] == 1.0
+    assert gateway.snapshot()['b']['calls'] == 1
+
+
+def test_retryable_failure_is_retried_on_the_next_round():
+    flaky = Scripted('a', RetryableAPIError("HTTP 503"), "from a")
+    gateway = make_gateway(flaky, max_attempts=3)
+
+    assert asyncio.run(gateway.complete("q")) == "from a"
+    assert flaky.calls == 2
+
+
+def test_permanent_failure_is_not_retried_on_the_same_provider():
+    broken = Scripted('a', Exception("HTTP 401"), "never")
+    gateway = make_gateway(broken, max_attempts=3)
+
+    with pytest.raises(Exception, match="HTTP 401"):
+        asyncio.run(gateway.complete("q"))
+    assert broken.calls == 1
+
+
+def test_unavailable_providers_are_skipped():
+    down = Scripted('a', "from a")
+    down.available = lambda: False
+    gateway = make_gateway(down, Scripted('b', "from b"))
+
+    assert [provider.name for provider in gateway.ranked()] == ['b']
+    assert asyncio.run(gateway.complete("q")) == "from b"
+    assert down.calls == 0
+
+
+def test_recent_errors_push_a_fast_provider_down_the_ranking():
+    gateway = make_gateway(Scripted('a', "from a"), Scripted('b', "from b"))
+    gateway._latency['a'].record(1.0)
+    gateway._latency['b'].record(2.5)
+    assert [provider.name for provider in gateway.ranked()] == ['a', 'b']
+
+    gateway._outcomes['a'].extend([True, False])
+
+    # 1.0s inflated by a 50% error rate (3.0s) is worse than 2.5s without errors
+    assert [provider.name for provider in gateway.ranked()] == ['b', 'a']
+
+
+def test_no_available_provider_raises():
+    down = Scripted('a', "from a")
+    down.available = lambda: False
+
+    with pytest.raises(NoProviderAvailable):
+        asyncio.run(make_gateway(down).complete("q"))
+
+
+class FailingStream(Scripted):
+    def __init__(self, name, *deltas):
+        super().__init__(name)
+        self.deltas = deltas
+
+    async def stream(self, prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature):
+        for delta in self.deltas:
+            yield delta
+        raise RetryableAPIError("connection reset")
+
+
+def test_stream_fails_over_only_before_its_first_token():
+    gateway = make_gateway(FailingStream('a'), named('b', response="from b"))
+
+    async def stream():
+        return "".join([delta async for delta in gateway.stream("q")])
+
+    assert asyncio.run(stream()) == "from b"
+
+    gateway = make_gateway(FailingStream('a', "partial"), named('b', response="from b"))
+    received = []
+
+    async def partial_stream():
+        async for delta in gateway.stream("q"):
+            received.append(delta)
+
+    with pytest.raises(RetryableAPIError):
+        asyncio.run(partial_stream())
+    assert received == ["partial"]
+
+
+def test_create_gateway_leaves_out_providers_without_keys(monkeypatch):
+    monkeypatch.setattr(LLMs, 'MISTRAL_API_KEY', None)
+    monkeypatch.delenv('GEMINI_API_KEY', raising=False)
+
+    assert create_gateway('mistral, mock').signature() == "mock/mock"
+    # Without any configured provider the list is kept as given
+    assert create_gateway('mistral').signature() == f"mistral/{LLMs.MISTRAL_MODEL}"
+    with pytest.raises(ValueError):
+        create_gateway('openai')
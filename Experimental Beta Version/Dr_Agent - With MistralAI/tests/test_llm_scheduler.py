@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from llm_scheduler import PRIORITY_BULK, PRIORITY_DIAGNOSIS, PRIORITY_PROBE, LLMScheduler
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def job(order, name, gate=None):
+    async def run():
+        order.append(name)
+        if gate is not None:
+            await gate.wait()
+        return name
+    return run
+
+
+def test_waiting_jobs_run_by_priority_then_arrival():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1)
+        order, gate = [], asyncio.Event()
+        blocker = asyncio.create_task(scheduler.run(job(order, 'running', gate)))
+        await settle()
+        tasks = [asyncio.create_task(scheduler.run(job(order, name), priority))
+                 for name, priority in (('bulk', PRIORITY_BULK), ('d0', PRIORITY_DIAGNOSIS),
+                                        ('probe', PRIORITY_PROBE), ('d1', PRIORITY_DIAGNOSIS))]
+        await settle()
+        assert scheduler.snapshot()['waiting_by_priority'] == {PRIORITY_BULK: 1, PRIORITY_DIAGNOSIS: 2,
+                                                               PRIORITY_PROBE: 1}
+        gate.set()
+        await asyncio.gather(blocker, *tasks)
+        return order, scheduler.snapshot()
+
+    order, stats = asyncio.run(main())
+    assert order == ['running', 'd0', 'd1', 'probe', 'bulk']
+    assert (stats['active'], stats['waiting'], stats['completed']) == (0, 0, 5)
+
+
+def test_concurrency_is_bounded_and_adjustable():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=2)
+        order, gate = [], asyncio.Event()
+        tasks = [asyncio.create_task(scheduler.run(job(order, i, gate))) for i in range(5)]
+        await settle()
+        running_at_two = len(order)
+        scheduler.set_concurrency(4)
+        await settle()
+        running_at_four = len(order)
+        gate.set()
+        await asyncio.gather(*tasks)
+        return running_at_two, running_at_four
+
+    assert asyncio.run(main()) == (2, 4)
+
+
+def test_waiting_jobs_are_told_their_queue_position():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1)
+        gate = asyncio.Event()
+        positions = {'late': [], 'urgent': []}
+
+        def reporter(name):
+            async def report(position):
+                positions[name].append(position)
+            return report
+
+        blocker = asyncio.create_task(scheduler.run(job([], 'running', gate)))
+        await settle()
+        late = asyncio.create_task(scheduler.run(job([], 'late'), PRIORITY_BULK, reporter('late')))
+        await settle()
+        urgent = asyncio.create_task(scheduler.run(job([], 'urgent'), PRIORITY_DIAGNOSIS, reporter('urgent')))
+        await settle()
+        gate.set()
+        await asyncio.gather(blocker, late, urgent)
+        return positions
+
+    assert asyncio.run(main()) == {'late': [1, 2, 1], 'urgent': [1]}
+
+
+def test_a_cancelled_waiter_leaves_the_queue_and_a_failed_job_frees_its_slot():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1)
+        gate = asyncio.Event()
+        blocker = asyncio.create_task(scheduler.run(job([], 'running', gate)))
+        await settle()
+        waiter = asyncio.create_task(scheduler.run(job([], 'cancelled')))
+        await settle()
+        waiter.cancel()
+        await settle()
+        assert scheduler.snapshot()['waiting'] == 0
+        gate.set()
+        await blocker
+
+        async def fail():
+            raise RuntimeError("model error")
+
+        with pytest.raises(RuntimeError):
+            await scheduler.run(fail)
+        return await scheduler.run(job([], 'next'))
+
+    assert asyncio.run(main()) == 'next'
+
+
+def test_a_waiter_cancelled_before_its_turn_is_skipped_by_dispatch():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1)
+        gate = asyncio.Event()
+        running = asyncio.create_task(scheduler.run(job([], 'running', gate)))
+        await settle()
+        cancelled = asyncio.create_task(scheduler.run(job([], 'cancelled')))
+        last = asyncio.create_task(scheduler.run(job([], 'last')))
+        await settle()
+        # The slot frees up in the same step the queued waiter is cancelled
+        gate.set()
+        cancelled.cancel()
+        results = await asyncio.wait_for(asyncio.gather(running, cancelled, last, return_exceptions=True), 1)
+        return results, scheduler.snapshot()
+
+    results, stats = asyncio.run(main())
+    assert results[0] == 'running' and isinstance(results[1], asyncio.CancelledError) and results[2] == 'last'
+    assert (stats['active'], stats['waiting']) == (0, 0)
+
+
+def test_a_waiter_cancelled_after_its_slot_was_granted_passes_it_on():
+    async def main():
+        scheduler = LLMScheduler(max_concurrency=1)
+        gate = asyncio.Event()
+        running = asyncio.create_task(scheduler.run(job([], 'running', gate)))
+        await settle()
+        granted = asyncio.create_task(scheduler.run(job([], 'granted')))
+        last = asyncio.create_task(scheduler.run(job([], 'last')))
+        await settle()
+        # A second slot goes to the first waiter, which is cancelled before it gets to run
+        scheduler.set_concurrency(2)
+        granted.cancel()
+        await settle()
+        gate.set()
+        results = await asyncio.wait_for(asyncio.gather(running, granted, last, return_exceptions=True), 1)
+        return results, scheduler.snapshot()
+
+    results, stats = asyncio.run(main())
+    assert isinstance(results[1], asyncio.CancelledError) and results[2] == 'last'
+    assert (stats['active'], stats['waiting']) == (0, 0)
@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from persistence_writer import PersistenceWriter
+from storage import SqliteStorage
+from visit_repository import VisitRepository
+
+
+class CountingStorage(SqliteStorage):
+    """SQLite storage that records each batch it is asked to write."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.visit_batches = []
+        self.profile_batches = []
+        self.fail_profiles = False
+
+    def add_visits(self, visits):
+        self.visit_batches.append(list(visits))
+        return super().add_visits(visits)
+
+    def save_profiles(self, profiles):
+        self.profile_batches.append(list(profiles))
+        if self.fail_profiles:
+            raise OSError("disk full")
+        super().save_profiles(profiles)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return CountingStorage(str(tmp_path / "db.sqlite3"))
+
+
+def make_writer(storage, **settings):
+    settings.setdefault('linger', 0)
+    settings.setdefault('compact_interval', 0)
+    return PersistenceWriter(VisitRepository(storage), **settings)
+
+
+def visit(user_id, hour, code):
+    return {'user_id': user_id, 'visit_timestamp': f"2024-01-01T{hour:02d}:00:00", 'visit_code': code}
+
+
+def test_queued_writes_share_one_batch(storage):
+    writer = make_writer(storage)
+
+    async def scenario():
+        futures = [writer.submit_visit(visit(1, hour, f"V{hour}")) for hour in range(5)]
+        await asyncio.gather(*futures)
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    assert [len(batch) for batch in storage.visit_batches] == [5]
+    assert [entry['visit_code'] for entry in storage.list_user_visits(1)] == [f"V{hour}" for hour in range(5)]
+
+
+def test_batches_are_capped_at_max_batch(storage):
+    writer = make_writer(storage, max_batch=2)
+
+    async def scenario():
+        await asyncio.gather(*[writer.submit_visit(visit(1, hour, f"V{hour}")) for hour in range(5)])
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    assert [len(batch) for batch in storage.visit_batches] == [2, 2, 1]
+
+
+def test_profile_upserts_for_one_user_are_coalesced(storage):
+    writer = make_writer(storage)
+
+    async def scenario():
+        first = writer.submit_profile({'user_id': 1, 'name': 'Ann'})
+        second = writer.submit_profile({'user_id': 1, 'name': 'Anna'})
+        await asyncio.gather(first, second)
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    assert storage.profile_batches == [[{'user_id': 1, 'name': 'Anna'}]]
+    assert storage.get_profile(1)['name'] == 'Anna'
+
+
+def test_queued_writes_are_readable_before_they_reach_disk(storage):
+    writer = make_writer(storage)
+
+    async def scenario():
+        writer.submit_visit(visit(1, 9, "V9"))
+        writer.submit_profile({'user_id': 1, 'name': 'Ann'})
+        seen = (writer.get_profile(1), writer.repository.get_by_code("V9"))
+        await writer.stop()
+        return seen
+
+    profile, queued_visit = asyncio.run(scenario())
+
+    assert profile['name'] == 'Ann'
+    assert queued_visit['visit_code'] == "V9"
+    assert writer._pending_profiles == {}
+
+
+def test_stop_flushes_everything_queued(storage):
+    writer = make_writer(storage, linger=1)
+
+    async def scenario():
+        writer.submit_visit(visit(1, 9, "V9"))
+        writer.submit_profile({'user_id': 1, 'name': 'Ann'})
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    assert storage.get_visit_by_code("V9") is not None
+    assert storage.get_profile(1)['name'] == 'Ann'
+
+
+def test_failed_profile_save_keeps_the_visits_of_its_batch(storage):
+    storage.fail_profiles = True
+    writer = make_writer(storage)
+
+    async def scenario():
+        visit_future = writer.submit_visit(visit(1, 9, "V9"))
+        profile_future = writer.submit_profile({'user_id': 1, 'name': 'Ann'})
+        results = await asyncio.gather(visit_future, profile_future, return_exceptions=True)
+        await writer.stop()
+        return results
+
+    visit_result, profile_result = asyncio.run(scenario())
+
+    assert visit_result is None
+    assert isinstance(profile_result, OSError)
+    assert writer.repository.get_by_code("V9")['visit_code'] == "V9"
+    assert storage.get_visit_by_code("V9") is not None
+    assert writer.get_profile(1) is None
+
+
+def test_failed_visit_write_is_reported_and_unindexed(storage, monkeypatch):
+    writer = make_writer(storage)
+
+    def broken(visits):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(storage, 'add_visits', broken)
+
+    async def scenario():
+        visit_future = writer.submit_visit(visit(1, 9, "V9"))
+        profile_future = writer.submit_profile({'user_id': 1, 'name': 'Ann'})
+        results = await asyncio.gather(visit_future, profile_future, return_exceptions=True)
+        await writer.stop()
+        return results
+
+    visit_result, profile_result = asyncio.run(scenario())
+
+    assert isinstance(visit_result, OSError)
+    assert profile_result is None
+    assert writer.repository.get_by_code("V9") is None
+    assert storage.get_profile(1)['name'] == 'Ann'
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter, TokenBucket
+
+
+@pytest.fixture
+def clock_module():
+    return rate_limiter
+
+
+@pytest.fixture
+def sleeps(monkeypatch, clock):
+    """Make the limiter's sleeps advance the fake clock instead of waiting."""
+    slept = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        slept.append(seconds)
+        clock.now += seconds
+        await real_sleep(0)
+
+    monkeypatch.setattr(rate_limiter.asyncio, 'sleep', sleep)
+    return slept
+
+
+def test_bucket_refills_at_its_rate_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=10)
+    bucket.take(10)
+
+    clock.now += 3
+    bucket.refill(clock.now)
+    assert bucket.level == 6
+
+    clock.now += 60
+    bucket.refill(clock.now)
+    assert bucket.level == 10
+
+
+def test_bucket_wait_time_covers_the_missing_units(clock):
+    bucket = TokenBucket(rate=2, capacity=10)
+    bucket.take(9)
+
+    assert bucket.wait_time(1) == 0
+    assert bucket.wait_time(5) == 2
+    # Requests above capacity only wait for a full bucket instead of forever
+    assert bucket.wait_time(50) == 4.5
+
+
+def test_acquire_waits_for_the_request_budget(clock, sleeps):
+    limiter = RateLimiter(requests_per_second=1, tokens_per_minute=60_000)
+
+    async def scenario():
+        for _ in range(3):
+            await limiter.acquire(10)
+
+    asyncio.run(scenario())
+
+    assert sleeps == [1, 1]
+    assert limiter.snapshot()['waits'] == 2
+
+
+def test_acquire_waits_for_the_token_budget(clock, sleeps):
+    limiter = RateLimiter(requests_per_second=100, tokens_per_minute=600)
+
+    async def scenario():
+        await limiter.acquire(600)
+        await limiter.acquire(100)
+
+    asyncio.run(scenario())
+
+    # 100 tokens at 10 tokens per second
+    assert sleeps == [10]
+
+
+def test_waiters_are_served_in_arrival_order(clock, sleeps):
+    limiter = RateLimiter(requests_per_second=100, tokens_per_minute=600)
+    order = []
+
+    async def request(name, tokens):
+        await limiter.acquire(tokens)
+        order.append(name)
+
+    async def scenario():
+        await limiter.acquire(600)
+        await asyncio.gather(request('large', 500), request('small', 10))
+
+    asyncio.run(scenario())
+
+    assert order == ['large', 'small']
+
+
+def test_refund_returns_unused_tokens(clock, sleeps):
+    limiter = RateLimiter(requests_per_second=100, tokens_per_minute=600)
+
+    async def scenario():
+        await limiter.acquire(600)
+        limiter.refund(400)
+        await limiter.acquire(300)
+
+    asyncio.run(scenario())
+
+    assert sleeps == []
+    assert limiter.snapshot()['tokens_available'] == 100
+
+
+def test_server_headers_replace_the_configured_limits(clock):
+    limiter = RateLimiter(requests_per_second=1, tokens_per_minute=500_000)
+
+    limiter.update_from_headers({
+        'x-ratelimitbysize-limit-minute': '120000',
+        'x-ratelimitbysize-remaining-minute': '5000',
+        'x-ratelimit-limit-requests': '300',
+    })
+
+    snapshot = limiter.snapshot()
+    assert snapshot['tokens_per_minute'] == 120_000
+    assert snapshot['tokens_available'] == 5000
+    assert snapshot['requests_per_second'] == 5
+
+
+def test_retry_after_pauses_every_caller(clock, sleeps):
+    limiter = RateLimiter(requests_per_second=100, tokens_per_minute=60_000)
+    limiter.update_from_headers({'retry-after': '7', 'x-ratelimit-limit-tokens': 'not a number'})
+
+    asyncio.run(limiter.acquire(1))
+
+    assert sleeps == [7]
+    assert limiter.snapshot()['tokens_per_minute'] == 60_000
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+import retry_policy
+from LLMs import RetryableAPIError
+from llm_gateway import LLMGateway, LLMProvider, NoProviderAvailable
+from retry_policy import RetryMetrics, RetryPolicy
+
+
+@pytest.fixture
+def clock_module():
+    return retry_policy
+
+
+def policy(base_delay=0, max_delay=0, **settings):
+    return RetryPolicy(base_delay=base_delay, max_delay=max_delay, metrics=RetryMetrics(), **settings)
+
+
+def test_attempts_stop_at_max_attempts(clock):
+    budget = policy(max_attempts=2).begin('op')
+
+    assert budget.start_attempt() == 90.0
+    assert budget.next_delay() is not None
+    budget.start_attempt()
+    assert budget.next_delay() is None
+    with pytest.raises(TimeoutError):
+        budget.start_attempt()
+
+
+def test_attempt_timeouts_shrink_to_the_remaining_budget(clock):
+    budget = policy(total_budget=120, attempt_timeout=90, connect_timeout=15).begin('op')
+    assert budget.start_attempt() == 90
+
+    clock.now += 110
+    timeout = budget.start_attempt()
+
+    assert timeout == pytest.approx(10)
+    assert budget.connect_timeout(timeout) == pytest.approx(10)
+    clock.now += 10
+    with pytest.raises(TimeoutError):
+        budget.start_attempt()
+
+
+def test_no_retry_is_scheduled_without_time_for_an_attempt(clock):
+    budget = policy(total_budget=10, base_delay=1, max_delay=1, min_attempt_time=2).begin('op')
+    budget.start_attempt()
+
+    clock.now += 7.5
+    assert budget.next_delay() is None
+
+
+def test_delays_back_off_exponentially_up_to_the_cap(clock):
+    budget = policy(base_delay=1, max_delay=3, max_attempts=5).begin('op')
+    delays = []
+    for _ in range(4):
+        budget.start_attempt()
+        delays.append(budget.next_delay())
+
+    assert 0.5 <= delays[0] <= 1
+    assert 1 <= delays[1] <= 2
+    assert 1.5 <= delays[2] <= 3 and 1.5 <= delays[3] <= 3
+
+
+def test_outcome_is_recorded_once_per_call(clock):
+    retries = policy()
+    budget = retries.begin('op')
+    budget.start_attempt()
+    budget.start_attempt()
+    budget.finish(True)
+    budget.finish(False)
+
+    counters = retries.metrics.snapshot()['op']
+    assert (counters['calls'], counters['succeeded'], counters['failed']) == (1, 1, 0)
+    assert (counters['attempts'], counters['retries']) == (2, 1)
+    assert counters['attempts_per_call'] == {2: 1}
+    assert retries.metrics.summary().startswith("op: 1 calls, 1 ok")
+
+
+class ScriptedProvider(LLMProvider):
+    def __init__(self, name, outcomes):
+        self.name = name
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def complete(self, prompt, system_prompt, timeout, connect_timeout, max_tokens, temperature):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def test_gateway_retries_retryable_errors_within_one_budget():
+    provider = ScriptedProvider('a', [RetryableAPIError("busy"), RetryableAPIError("busy"), "answer"])
+    gateway = LLMGateway([provider], policy(max_attempts=3))
+
+    assert asyncio.run(gateway.complete("q")) == "answer"
+    assert provider.calls == 3
+    assert gateway.retry_policy.metrics.snapshot()['gateway_complete']['retries'] == 2
+
+
+def test_gateway_fails_over_and_drops_providers_that_cannot_recover():
+    broken = ScriptedProvider('a', [ValueError("bad key")])
+    backup = ScriptedProvider('b', [RetryableAPIError("busy"), "answer"])
+    gateway = LLMGateway([broken, backup], policy(max_attempts=4))
+
+    assert asyncio.run(gateway.complete("q")) == "answer"
+    assert (broken.calls, backup.calls) == (1, 2)
+
+
+def test_gateway_gives_up_when_the_budget_is_spent():
+    provider = ScriptedProvider('a', [RetryableAPIError("busy")] * 2)
+    gateway = LLMGateway([provider], policy(max_attempts=2))
+
+    with pytest.raises(RetryableAPIError):
+        asyncio.run(gateway.complete("q"))
+    assert gateway.retry_policy.metrics.snapshot()['gateway_complete']['failed'] == 1
+
+
+def test_gateway_without_available_providers_raises():
+    provider = ScriptedProvider('a', [])
+    provider.available = lambda: False
+
+    with pytest.raises(NoProviderAvailable):
+        asyncio.run(LLMGateway([provider], policy()).complete("q"))
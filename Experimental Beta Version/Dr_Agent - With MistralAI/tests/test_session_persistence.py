@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from session_persistence import SessionPersistence
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "sessions" / "sessions.sqlite3")
+
+
+def test_user_data_survives_a_restart(db_path):
+    async def first_run():
+        persistence = SessionPersistence(db_path)
+        await persistence.update_user_data(7, {'patient_info': {'name': 'Ann'}, 'step': 3})
+        await persistence.flush()
+
+    async def second_run():
+        persistence = SessionPersistence(db_path)
+        assert await persistence.get_user_data() == {}
+        user_data = {}
+        await persistence.refresh_user_data(7, user_data)
+        await persistence.flush()
+        return user_data
+
+    asyncio.run(first_run())
+
+    assert asyncio.run(second_run()) == {'patient_info': {'name': 'Ann'}, 'step': 3}
+
+
+def test_refresh_keeps_values_set_since_startup_and_reads_once(db_path):
+    async def scenario():
+        persistence = SessionPersistence(db_path)
+        await persistence.update_user_data(7, {'step': 3, 'lang': 'fa'})
+        await persistence.flush()
+
+        persistence = SessionPersistence(db_path)
+        user_data = {'step': 1}
+        await persistence.refresh_user_data(7, user_data)
+        user_data.pop('lang')
+        await persistence.refresh_user_data(7, user_data)
+        await persistence.flush()
+        return user_data
+
+    assert asyncio.run(scenario()) == {'step': 1}
+
+
+def test_dropped_user_data_is_deleted(db_path):
+    async def scenario():
+        persistence = SessionPersistence(db_path)
+        await persistence.update_user_data(7, {'step': 3})
+        await persistence.flush()
+
+        persistence = SessionPersistence(db_path)
+        await persistence.drop_user_data(7)
+        await persistence.flush()
+        return SessionPersistence(db_path)._read_user(7)
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_conversation_states_round_trip(db_path):
+    async def scenario():
+        persistence = SessionPersistence(db_path)
+        await persistence.update_conversation('intake', (7, 7), 2)
+        await persistence.update_conversation('intake', (8, 8), 5)
+        await persistence.update_conversation('intake', (8, 8), None)
+        await persistence.flush()
+
+        persistence = SessionPersistence(db_path)
+        states = await persistence.get_conversations('intake')
+        other = await persistence.get_conversations('feedback')
+        await persistence.flush()
+        return states, other
+
+    states, other = asyncio.run(scenario())
+
+    assert states == {(7, 7): 2}
+    assert other == {}
+
+
+def test_updates_in_one_run_share_one_write(db_path, monkeypatch):
+    persistence = SessionPersistence(db_path)
+    writes = []
+    write = persistence._write
+
+    def recording(users, conversations):
+        writes.append((dict(users), dict(conversations)))
+        write(users, conversations)
+
+    monkeypatch.setattr(persistence, '_write', recording)
+
+    async def scenario():
+        await persistence.update_user_data(7, {'step': 1})
+        await persistence.update_user_data(7, {'step': 2})
+        await persistence.update_user_data(8, {'step': 1})
+        await persistence.update_conversation('intake', (7, 7), 1)
+        await persistence.flush()
+
+    asyncio.run(scenario())
+
+    assert len(writes) == 1
+    assert sorted(writes[0][0]) == [7, 8]
+
+
+def test_failed_write_is_retried_without_overwriting_newer_data(db_path, monkeypatch):
+    persistence = SessionPersistence(db_path)
+    write = persistence._write
+    failures = [OSError("database is locked")]
+
+    def flaky(users, conversations):
+        if failures:
+            raise failures.pop()
+        write(users, conversations)
+
+    monkeypatch.setattr(persistence, '_write', flaky)
+
+    async def scenario():
+        await persistence.update_user_data(7, {'step': 1})
+        await persistence.update_user_data(8, {'step': 1})
+        await persistence._write_task
+        await persistence.update_user_data(7, {'step': 2})
+        await persistence.flush()
+
+    asyncio.run(scenario())
+
+    reader = SessionPersistence(db_path)
+    assert reader._read_user(7) == {'step': 2}
+    assert reader._read_user(8) == {'step': 1}
@@ -0,0 +1,277 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from storage import (UNDATED_PARTITION, ColdSegment, PartitionedVisitLog, ProfileStore, SqliteStorage, VisitLog,
+                     create_storage, partition_key)
+
+
+def visit(user_id, timestamp, code=None, **fields):
+    return dict(fields, user_id=user_id, visit_timestamp=timestamp, visit_code=code or f"V-{user_id}-{timestamp}")
+
+
+def read_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_visit_log_append_returns_readable_offsets(tmp_path):
+    log = VisitLog(str(tmp_path))
+    first = log.append(visit(1, "2024-01-05T10:00:00", note="سرفه"))
+    second, third = log.append_many([visit(2, "2024-01-06T10:00:00"), visit(1, "2024-01-07T10:00:00")])
+
+    assert first == 0 < second < third
+    assert log.read_at(first)['note'] == "سرفه"
+    assert log.read_at(third)['visit_timestamp'] == "2024-01-07T10:00:00"
+    assert [v['user_id'] for v in log.iter_visits()] == [1, 2, 1]
+    assert len(read_lines(log.index_path)) == 3
+
+
+def test_visit_log_index_is_rebuilt_when_missing(tmp_path):
+    log = VisitLog(str(tmp_path))
+    offsets = log.append_many([visit(1, "2024-01-05T10:00:00"), visit(2, "2024-01-06T10:00:00")])
+    os.remove(log.index_path)
+
+    entries = VisitLog(str(tmp_path)).entries()
+
+    assert [e['offset'] for e in entries] == offsets
+    assert [e['user_id'] for e in entries] == [1, 2]
+    assert os.path.exists(log.index_path)
+
+
+def test_visit_log_indexes_a_log_tail_the_index_missed(tmp_path):
+    log = VisitLog(str(tmp_path))
+    log.append(visit(1, "2024-01-05T10:00:00"))
+    # A record that reached the log but not the index before a crash
+    with open(log.log_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(visit(2, "2024-01-06T10:00:00")) + "\n")
+
+    entries = VisitLog(str(tmp_path)).entries()
+
+    assert [e['user_id'] for e in entries] == [1, 2]
+    assert len(read_lines(log.index_path)) == 2
+
+
+def test_visit_log_ignores_a_torn_last_record(tmp_path):
+    log = VisitLog(str(tmp_path))
+    log.append(visit(1, "2024-01-05T10:00:00"))
+    os.remove(log.index_path)
+    with open(log.log_path, 'a', encoding='utf-8') as f:
+        f.write('{"user_id": 2, "visit_time')
+
+    assert [e['user_id'] for e in VisitLog(str(tmp_path)).entries()] == [1]
+
+
+def test_visit_log_rebuilds_an_index_that_points_past_the_log(tmp_path):
+    log = VisitLog(str(tmp_path))
+    log.append_many([visit(1, "2024-01-05T10:00:00"), visit(2, "2024-01-06T10:00:00")])
+    # The log was restored from an older copy than the index
+    with open(log.log_path, 'r', encoding='utf-8') as f:
+        first_line = f.readline()
+    with open(log.log_path, 'w', encoding='utf-8') as f:
+        f.write(first_line)
+
+    assert [e['user_id'] for e in VisitLog(str(tmp_path)).entries()] == [1]
+
+
+def test_visit_log_picks_up_appends_from_another_instance(tmp_path):
+    reader = VisitLog(str(tmp_path))
+    reader.append(visit(1, "2024-01-05T10:00:00"))
+    assert len(reader) == 1
+
+    VisitLog(str(tmp_path)).append(visit(2, "2024-01-06T10:00:00"))
+
+    assert [e['user_id'] for e in reader.entries()] == [1, 2]
+
+
+def write_legacy(path, visits):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(visits, f, ensure_ascii=False)
+
+
+def test_sqlite_finds_visits_by_prefix_code_and_user(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "db.sqlite3"))
+    storage.add_visits([visit(1, "2024-02-01T09:00:00", "A"), visit(1, "2024-01-01T09:00:00", "B"),
+                        visit(2, "2024-01-15T09:00:00", "C")])
+
+    assert storage.find_visit(1, "2024-01")['visit_code'] == "B"
+    assert storage.find_visit(1, "20240201-090000")['visit_code'] == "A"
+    assert storage.find_visit(2, "2024-02") is None
+    assert storage.get_visit_by_code("C")['user_id'] == 2
+    assert [v['visit_code'] for v in storage.list_user_visits(1)] == ["B", "A"]
+
+
+def test_sqlite_profiles_are_upserted(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "db.sqlite3"))
+    storage.save_profile({'user_id': 1, 'age': 30})
+    storage.save_profiles([{'user_id': 1, 'age': 31}, {'user_id': 2, 'age': 40}])
+
+    assert storage.get_profile(1) == {'user_id': 1, 'age': 31}
+    assert sorted(p['user_id'] for p in storage.iter_profiles()) == [1, 2]
+
+
+def test_sqlite_migration_is_idempotent(tmp_path):
+    legacy = str(tmp_path / "patients.json")
+    visits = [visit(1, "2024-01-01T09:00:00", "A"), visit(2, "2024-01-02T09:00:00", "B"),
+              visit(1, "2024-01-01T09:00:00", "A")]
+    write_legacy(legacy, visits)
+    storage = SqliteStorage(str(tmp_path / "db.sqlite3"))
+
+    assert storage.migrate_legacy(legacy) == 2
+    assert os.path.exists(legacy + ".migrated") and not os.path.exists(legacy)
+    # A run interrupted before the rename is repeated without duplicating anything
+    write_legacy(legacy, visits + [visit(3, "2024-01-03T09:00:00", "C")])
+    assert storage.migrate_legacy(legacy) == 1
+    assert storage.migrate_legacy(legacy) == 0
+    assert sorted(v['visit_code'] for v in storage.iter_visits()) == ["A", "B", "C"]
+
+
+def test_create_storage_seeds_a_new_sqlite_database_from_json(tmp_path):
+    profile_path = str(tmp_path / "patient_info.json")
+    json_storage = create_storage('json', str(tmp_path), profile_path)
+    json_storage.add_visits([visit(1, "2024-01-01T09:00:00", "A"), visit(2, "2024-03-01T09:00:00", "B")])
+    json_storage.save_profile({'user_id': 1, 'age': 30})
+
+    sqlite_storage = create_storage('sqlite', str(tmp_path), profile_path)
+
+    assert sorted(v['visit_code'] for v in sqlite_storage.iter_visits()) == ["A", "B"]
+    assert sqlite_storage.get_profile(1) == {'user_id': 1, 'age': 30}
+    # Only an empty database is seeded
+    json_storage.add_visit(visit(3, "2024-03-02T09:00:00", "C"))
+    reopened = create_storage('sqlite', str(tmp_path), profile_path)
+    assert sorted(v['visit_code'] for v in reopened.iter_visits()) == ["A", "B"]
+
+
+def test_profile_store_replays_the_journal_over_the_snapshot(tmp_path):
+    path = str(tmp_path / "patient_info.json")
+    write_legacy(path, [{'user_id': 1, 'age': 30}, {'user_id': 2, 'age': 40}])
+    store = ProfileStore(path)
+    store.upsert({'user_id': 1, 'age': 31})
+    store.upsert({'user_id': 3, 'age': 50})
+
+    # The snapshot is untouched; a fresh store gets the upserts from the journal
+    assert read_lines(path + ".journal") == [{'user_id': 1, 'age': 31}, {'user_id': 3, 'age': 50}]
+    reopened = ProfileStore(path)
+    assert reopened.get(1) == {'user_id': 1, 'age': 31}
+    assert sorted(p['user_id'] for p in reopened.values()) == [1, 2, 3]
+
+
+def test_profile_store_skips_a_torn_journal_line(tmp_path):
+    path = str(tmp_path / "patient_info.json")
+    ProfileStore(path).upsert({'user_id': 1, 'age': 30})
+    with open(path + ".journal", 'a', encoding='utf-8') as f:
+        f.write('{"user_id": 1, "ag')
+
+    assert ProfileStore(path).get(1) == {'user_id': 1, 'age': 30}
+
+
+def test_profile_store_folds_the_journal_into_the_snapshot(tmp_path):
+    path = str(tmp_path / "patient_info.json")
+    store = ProfileStore(path, min_compact_entries=3)
+    store.upsert_many([{'user_id': 1, 'age': 30}, {'user_id': 2, 'age': 40}])
+    assert not os.path.exists(path)
+
+    store.upsert({'user_id': 1, 'age': 31})
+
+    with open(path, 'r', encoding='utf-8') as f:
+        assert sorted(json.load(f), key=lambda p: p['user_id']) == [{'user_id': 1, 'age': 31}, {'user_id': 2, 'age': 40}]
+    assert os.path.getsize(path + ".journal") == 0
+    assert ProfileStore(path).get(1) == {'user_id': 1, 'age': 31}
+
+
+def test_profile_store_sees_writes_from_another_instance(tmp_path):
+    path = str(tmp_path / "patient_info.json")
+    reader = ProfileStore(path)
+    assert reader.get(1) is None
+
+    ProfileStore(path).upsert({'user_id': 1, 'age': 30})
+
+    assert reader.get(1) == {'user_id': 1, 'age': 30}
+
+
+def partition_files(log):
+    return sorted(os.listdir(log.partition_folder))
+
+
+def test_partition_key_is_the_visit_month():
+    assert partition_key("2024-03-31T23:59:59") == "2024-03"
+    assert partition_key("") == UNDATED_PARTITION
+    assert partition_key(None) == UNDATED_PARTITION
+
+
+def test_visits_roll_over_into_monthly_segments(tmp_path):
+    log = PartitionedVisitLog(str(tmp_path))
+    locations = log.append_many([visit(1, "2024-01-31T23:59:59"), visit(1, "2024-02-01T00:00:00"),
+                                 visit(2, "2024-01-15T12:00:00"), visit(3, None)])
+
+    assert [key for key, _ in locations] == ["2024-01", "2024-02", "2024-01", UNDATED_PARTITION]
+    assert partition_files(log) == ["visits-2024-01.idx", "visits-2024-01.jsonl", "visits-2024-02.idx",
+                                    "visits-2024-02.jsonl", "visits-undated.idx", "visits-undated.jsonl"]
+    assert log.read_at(locations[2])['user_id'] == 2
+    assert [e['user_id'] for e in log.entries("2024-01")] == [1, 2]
+    assert len(log) == 4
+
+
+@pytest.mark.parametrize("compression", ["gz", "xz"])
+def test_compact_compresses_closed_months_and_keeps_locations(tmp_path, compression):
+    log = PartitionedVisitLog(str(tmp_path), compression=compression, min_idle=0)
+    current = datetime.now().isoformat()
+    locations = log.append_many([visit(1, "2024-01-05T10:00:00", note="تب"), visit(2, "2024-01-06T10:00:00"),
+                                 visit(3, current), visit(4, None)])
+
+    assert log.compact() == 1
+    # The open month and undated visits stay plain; the closed month becomes read-only
+    assert f"visits-2024-01.jsonl.{compression}" in partition_files(log)
+    assert "visits-2024-01.jsonl" not in partition_files(log)
+    assert log.compact() == 0
+
+    reopened = PartitionedVisitLog(str(tmp_path), compression=compression)
+    assert isinstance(reopened._segment("2024-01"), ColdSegment)
+    assert reopened.read_at(locations[0])['note'] == "تب"
+    assert reopened.read_at(locations[1])['user_id'] == 2
+    assert [v['user_id'] for v in reopened.iter_visits()] == [1, 2, 3, 4]
+
+
+def test_compact_leaves_recently_written_months_alone(tmp_path):
+    log = PartitionedVisitLog(str(tmp_path), min_idle=3600)
+    log.append(visit(1, "2024-01-05T10:00:00"))
+
+    assert log.compact() == 0
+
+
+def test_a_late_write_reopens_a_compressed_month(tmp_path):
+    log = PartitionedVisitLog(str(tmp_path), min_idle=0)
+    first = log.append(visit(1, "2024-01-05T10:00:00"))
+    log.compact()
+
+    late = log.append(visit(2, "2024-01-20T10:00:00"))
+
+    assert "visits-2024-01.jsonl" in partition_files(log)
+    assert not any(name.endswith(".gz") for name in partition_files(log))
+    assert log.read_at(first)['user_id'] == 1
+    assert log.read_at(late)['user_id'] == 2
+
+
+def test_cold_segment_index_is_rebuilt_from_compressed_data(tmp_path):
+    log = PartitionedVisitLog(str(tmp_path), min_idle=0)
+    location = log.append_many([visit(1, "2024-01-05T10:00:00"), visit(2, "2024-01-06T10:00:00")])[1]
+    log.compact()
+    os.remove(os.path.join(log.partition_folder, "visits-2024-01.idx"))
+
+    reopened = PartitionedVisitLog(str(tmp_path))
+
+    assert [e['offset'] for e in reopened.entries("2024-01")][1] == location[1]
+
+
+def test_single_log_and_legacy_json_migrate_into_partitions(tmp_path):
+    VisitLog(str(tmp_path)).append_many([visit(1, "2024-01-05T10:00:00", "A"), visit(2, "2024-02-05T10:00:00", "B")])
+    legacy = str(tmp_path / "patients.json")
+    write_legacy(legacy, [visit(1, "2024-01-05T10:00:00", "A"), visit(3, "2024-03-05T10:00:00", "C")])
+    storage = create_storage('json', str(tmp_path), str(tmp_path / "patient_info.json"))
+
+    assert storage.migrate_legacy(legacy) == 3
+    assert storage.migrate_legacy(legacy) == 0
+    assert sorted(v['visit_code'] for v in storage.iter_visits()) == ["A", "B", "C"]
+    assert os.path.exists(str(tmp_path / "visits.jsonl.migrated"))
@@ -0,0 +1,98 @@
+import pytest
+
+from storage import JsonStorage, SqliteStorage
+from visit_repository import VisitRepository
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def storage(request, tmp_path):
+    if request.param == 'sqlite':
+        return SqliteStorage(str(tmp_path / "db.sqlite3"))
+    return JsonStorage(str(tmp_path), str(tmp_path / "patient_info.json"))
+
+
+def add_history(repository, user_id, count, day=1):
+    codes = []
+    for i in range(count):
+        code = f"VISIT-{user_id}-{i:02d}"
+        repository.add({'user_id': user_id, 'visit_timestamp': f"2024-01-{day + i // 24:02d}T{i % 24:02d}:00:00",
+                        'visit_code': code})
+        codes.append(code)
+    return codes
+
+
+def codes_of(page):
+    return [entry['visit_code'] for entry in page['entries']]
+
+
+def test_first_page_is_the_newest_visits(storage):
+    repository = VisitRepository(storage)
+    codes = add_history(repository, 1, 25)
+    add_history(repository, 2, 3)
+
+    page = repository.page(1, size=10)
+
+    assert codes_of(page) == codes[::-1][:10]
+    assert page['total'] == 25
+    assert page['newer'] is None
+    assert page['older'] == (page['entries'][-1]['visit_timestamp'], page['entries'][-1]['visit_code'])
+
+
+def test_older_and_newer_cursors_walk_the_whole_history(storage):
+    repository = VisitRepository(storage)
+    codes = add_history(repository, 1, 25)
+
+    pages = [repository.page(1, size=10)]
+    while pages[-1]['older']:
+        pages.append(repository.page(1, before=pages[-1]['older'], size=10))
+
+    assert [len(page['entries']) for page in pages] == [10, 10, 5]
+    assert sum((codes_of(page) for page in pages), []) == codes[::-1]
+    # Walking back with the newer cursor returns the same pages
+    assert codes_of(repository.page(1, after=pages[2]['newer'], size=10)) == codes_of(pages[1])
+    assert codes_of(repository.page(1, after=pages[1]['newer'], size=10)) == codes_of(pages[0])
+
+
+def test_cursors_split_visits_with_equal_timestamps(storage):
+    repository = VisitRepository(storage)
+    for code in ("VISIT-a", "VISIT-b", "VISIT-c"):
+        repository.add({'user_id': 1, 'visit_timestamp': "2024-01-01T10:00:00", 'visit_code': code})
+
+    first = repository.page(1, size=2)
+    second = repository.page(1, before=first['older'], size=2)
+
+    assert codes_of(first) == ["VISIT-c", "VISIT-b"]
+    assert codes_of(second) == ["VISIT-a"]
+    assert second['older'] is None
+
+
+def test_a_cursor_stays_valid_when_newer_visits_arrive(storage):
+    repository = VisitRepository(storage)
+    codes = add_history(repository, 1, 15)
+    cursor = repository.page(1, size=10)['older']
+
+    add_history(repository, 1, 3, day=20)
+
+    assert codes_of(repository.page(1, before=cursor, size=10)) == codes[:5][::-1]
+
+
+def test_get_entry_reads_the_visit_behind_a_cursor(storage):
+    repository = VisitRepository(storage)
+    add_history(repository, 1, 5)
+    entry = repository.page(1, size=2)['entries'][1]
+
+    visit = repository.get_entry(1, entry['visit_timestamp'], entry['visit_code'])
+
+    assert visit['visit_code'] == entry['visit_code']
+    assert repository.get_entry(1, entry['visit_timestamp'], "VISIT-unknown") is None
+    assert repository.get_entry(2, entry['visit_timestamp'], entry['visit_code']) is None
+
+
+def test_history_is_rebuilt_from_storage(storage):
+    codes = add_history(VisitRepository(storage), 1, 12)
+
+    repository = VisitRepository(storage)
+
+    assert repository.count(1) == 12
+    assert [e['visit_code'] for e in repository.latest(1, 3)] == codes[::-1][:3]
+    assert codes_of(repository.page(1, before=repository.page(1, size=10)['older'], size=10)) == codes[:2][::-1]
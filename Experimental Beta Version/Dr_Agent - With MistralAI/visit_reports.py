@@ -0,0 +1,234 @@
+import os
+import html
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+from diagnosis_parser import visit_diagnosis_fields
+
+REPORT_FORMATS = ('md', 'html')
+
+MARKDOWN_HEADER = (
+    "# Visit Reports Repository\n\n"
+    "This file stores visit details including diagnosis and prescription data.\n\n"
+    "---\n"
+)
+
+def visit_day(visit: Dict) -> str:
+    """Return the visit's date as ``YYYY-MM-DD`` ('unknown' when the timestamp is invalid)."""
+    try:
+        return datetime.fromisoformat(visit.get('visit_timestamp', '')).strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return 'unknown'
+
+
+def _report_fields(visit: Dict) -> Dict:
+    """Collect everything a report shows, so both formats share one pass over the record"""
+    # Extract age and gender ensuring complete patient data
+    age = visit.get('age') or visit.get('patient_info', {}).get('age', 'نامشخص')
+    gender = visit.get('gender') or visit.get('patient_info', {}).get('gender', 'نامشخص')
+    try:
+        visit_date = datetime.fromisoformat(visit.get('visit_timestamp', '')).strftime("%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        visit_date = 'نامشخص'
+
+    symptoms = []
+    for question, data in (visit.get('answers') or {}).items():
+        if isinstance(data, dict):
+            symptoms.append((data.get('section', 'General'), data.get('description', question), data.get('answer', '')))
+        else:
+            symptoms.append((None, question, data))
+
+    medical_history = {}
+    for category, data in (visit.get('medical_history') or {}).items():
+        if isinstance(data, dict) and data:
+            medical_history[category] = [value for value in data.values() if value and value not in ['-', 'ندارم']]
+
+    diagnosis = visit.get('diagnosis', '')
+    recommendations = visit_diagnosis_fields(visit)['recommendations']
+    return {
+        'visit_code': visit.get('visit_code', 'N/A'),
+        'visit_date': visit_date,
+        'name': visit.get('name', 'نامشخص'),
+        'gender': gender,
+        'age': age,
+        'symptoms': symptoms,
+        'extra_info': visit.get('extra_info'),
+        'medical_history': medical_history,
+        'diagnosis': diagnosis,
+        'prescription': "\n".join(f"• {item}" for item in recommendations)
+    }
+
+
+def render_markdown(visit: Dict) -> str:
+    """Render the markdown report for a single visit"""
+    fields = _report_fields(visit)
+    report = (
+        f"\n\n## Visit Report - {fields['visit_code']}\n"
+        f"**Date:** {fields['visit_date']}\n"
+        f"**Patient:** {fields['name']}\n"
+        f"**Gender:** {fields['gender']}\n"
+        f"**Age:** {fields['age']}\n\n"
+    )
+
+    if fields['symptoms']:
+        lines = []
+        for section, description, response in fields['symptoms']:
+            if section is None:
+                lines.append(f"- {description}: {response}")
+            else:
+                lines.append(f"- **{section}:** {description} → **{response}**")
+        report += "### Symptoms\n" + "\n".join(lines) + "\n\n"
+    else:
+        report += "### Symptoms\nNo symptoms recorded.\n\n"
+
+    if fields['extra_info']:
+        report += f"### Additional Information\n{fields['extra_info']}\n\n"
+
+    if fields['medical_history']:
+        report += "### Medical History\n"
+        for category, values in fields['medical_history'].items():
+            report += f"\n#### {category}\n"
+            for value in values:
+                report += f"- {value}\n"
+        report += "\n"
+
+    report += (
+        f"### Diagnosis\n{fields['diagnosis']}\n\n"
+        f"### Prescription\n{fields['prescription']}\n\n"
+        "---\n"
+    )
+    return report
+
+
+def render_html(visit: Dict) -> str:
+    """Render a standalone HTML page for a single visit"""
+    fields = _report_fields(visit)
+    e = html.escape
+    parts = [
+        '<!DOCTYPE html>\n<html lang="fa" dir="rtl">\n<head>\n<meta charset="utf-8">\n'
+        f"<title>Visit Report - {e(str(fields['visit_code']))}</title>\n</head>\n<body>\n",
+        f"<h1>Visit Report - {e(str(fields['visit_code']))}</h1>\n<ul>\n"
+        f"<li><b>Date:</b> {e(fields['visit_date'])}</li>\n"
+        f"<li><b>Patient:</b> {e(str(fields['name']))}</li>\n"
+        f"<li><b>Gender:</b> {e(str(fields['gender']))}</li>\n"
+        f"<li><b>Age:</b> {e(str(fields['age']))}</li>\n</ul>\n",
+        "<h2>Symptoms</h2>\n"
+    ]
+    if fields['symptoms']:
+        parts.append("<ul>\n")
+        for section, description, response in fields['symptoms']:
+            label = f"<b>{e(str(section))}:</b> " if section is not None else ""
+            parts.append(f"<li>{label}{e(str(description))} → <b>{e(str(response))}</b></li>\n")
+        parts.append("</ul>\n")
+    else:
+        parts.append("<p>No symptoms recorded.</p>\n")
+
+    if fields['extra_info']:
+        parts.append(f"<h2>Additional Information</h2>\n<p>{e(str(fields['extra_info']))}</p>\n")
+
+    if fields['medical_history']:
+        parts.append("<h2>Medical History</h2>\n")
+        for category, values in fields['medical_history'].items():
+            parts.append(f"<h3>{e(str(category))}</h3>\n<ul>\n")
+            parts.extend(f"<li>{e(str(value))}</li>\n" for value in values)
+            parts.append("</ul>\n")
+
+    parts.append(
+        f"<h2>Diagnosis</h2>\n<pre>{e(fields['diagnosis'])}</pre>\n"
+        f"<h2>Prescription</h2>\n<pre>{e(fields['prescription'])}</pre>\n"
+        "</body>\n</html>\n"
+    )
+    return "".join(parts)
+
+
+class ReportCache:
+    """LRU cache of rendered reports keyed by :func:`report_key` and bounded by size."""
+
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[str]:
+        with self._lock:
+            report = self._entries.get(key)
+            if report is not None:
+                self._entries.move_to_end(key)
+            return report
+
+    def put(self, key, report: str) -> None:
+        size = len(report.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old.encode('utf-8'))
+            self._entries[key] = report
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.encode('utf-8'))
+
+
+_RENDERERS = {'md': render_markdown, 'html': render_html}
+
+
+def report_key(visit: Dict, fmt: str) -> Optional[tuple]:
+    """Cache key of a visit's report, or None when the visit cannot be identified.
+
+    Legacy visit codes are not unique, so the key is the same user/timestamp/code triple
+    that storage imports deduplicate on.
+    """
+    identity = (visit.get('user_id'), visit.get('visit_timestamp'), visit.get('visit_code'))
+    if not (identity[1] or identity[2]):
+        return None
+    return identity + (fmt,)
+
+
+def render_report(visit: Dict, fmt: str = 'md', cache: Optional[ReportCache] = None) -> str:
+    """Render a visit report on demand, reusing the cached copy when there is one"""
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f"Unknown report format '{fmt}', expected one of {REPORT_FORMATS}")
+    key = report_key(visit, fmt) if cache is not None else None
+    if key is not None:
+        report = cache.get(key)
+        if report is not None:
+            return report
+    report = _RENDERERS[fmt](visit)
+    if key is not None:
+        cache.put(key, report)
+    return report
+
+
+def export_reports(visits: Iterable[Dict], out_dir: str) -> Dict[str, int]:
+    """Stream every visit's markdown report into one archive file per day.
+
+    Visits are consumed one at a time and only the current day's file is kept open, so
+    memory use does not depend on the number of visits. Files written by this run are
+    replaced rather than appended to. Returns the number of reports written per day.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    counts: Dict[str, int] = {}
+    current_day, current_file = None, None
+    try:
+        for visit in visits:
+            day = visit_day(visit)
+            if day != current_day:
+                if current_file:
+                    current_file.close()
+                path = os.path.join(out_dir, f"visit_reports-{day}.md")
+                first_time = day not in counts
+                current_file = open(path, 'w' if first_time else 'a', encoding='utf-8')
+                if first_time:
+                    current_file.write(MARKDOWN_HEADER)
+                current_day = day
+            current_file.write(render_markdown(visit))
+            counts[day] = counts.get(day, 0) + 1
+    finally:
+        if current_file:
+            current_file.close()
+    return counts
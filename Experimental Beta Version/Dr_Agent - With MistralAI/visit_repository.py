@@ -0,0 +1,355 @@
+import time
+import base64
+import bisect
+import string
+import itertools
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from storage import Storage, link_timestamp_prefix
+
+# Legacy deep links carry the visit timestamp with second precision in this format.
+LINK_TIMESTAMP_FORMAT = '%Y%m%d-%H%M%S'
+
+# Visit IDs are 63-bit, time-ordered integers (milliseconds since VISIT_ID_EPOCH_MS, a node
+# number and a per-millisecond sequence). In base62 they are always VISIT_ID_LENGTH characters
+# and appear as ``VISIT-<id>`` in visit codes and ``visit_<id>`` in deep links.
+VISIT_ID_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+VISIT_ID_NODE_BITS = 10
+VISIT_ID_SEQUENCE_BITS = 12
+VISIT_ID_LENGTH = 11
+VISIT_CODE_PREFIX = 'VISIT-'
+VISIT_LINK_PREFIX = 'visit_'
+# Locations of visits still queued for the writer are ``(PENDING, n)`` tokens
+PENDING = 'pending'
+BASE62_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+_BASE62_VALUES = {char: value for value, char in enumerate(BASE62_ALPHABET)}
+
+
+def encode_visit_id(visit_id: int) -> str:
+    """Encode a visit ID as fixed-width base62."""
+    chars = []
+    for _ in range(VISIT_ID_LENGTH):
+        visit_id, remainder = divmod(visit_id, 62)
+        chars.append(BASE62_ALPHABET[remainder])
+    if visit_id:
+        raise ValueError("Visit ID does not fit in the fixed-width encoding")
+    return ''.join(reversed(chars))
+
+
+def decode_visit_id(token: str) -> int:
+    if not is_visit_id(token):
+        raise ValueError(f"Invalid visit ID '{token}'")
+    visit_id = 0
+    for char in token:
+        visit_id = visit_id * 62 + _BASE62_VALUES[char]
+    return visit_id
+
+
+def is_visit_id(token: str) -> bool:
+    """True for a base62 visit ID; legacy base64 link payloads are always longer."""
+    return len(token) == VISIT_ID_LENGTH and all(char in _BASE62_VALUES for char in token)
+
+
+def format_visit_code(visit_id: int) -> str:
+    return VISIT_CODE_PREFIX + encode_visit_id(visit_id)
+
+
+def format_visit_link_param(visit_id: int) -> str:
+    return VISIT_LINK_PREFIX + encode_visit_id(visit_id)
+
+
+class VisitIdGenerator:
+    """Thread-safe generator of unique, monotonically increasing visit IDs."""
+
+    def __init__(self, node: int = 0):
+        if not 0 <= node < (1 << VISIT_ID_NODE_BITS):
+            raise ValueError(f"Visit ID node must be between 0 and {(1 << VISIT_ID_NODE_BITS) - 1}")
+        self.node = node
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        with self._lock:
+            # Never step back in time, even if the wall clock does
+            now = max(int(time.time() * 1000) - VISIT_ID_EPOCH_MS, self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << VISIT_ID_SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    # Sequence exhausted within one millisecond: borrow the next one
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << (VISIT_ID_NODE_BITS + VISIT_ID_SEQUENCE_BITS)) \
+                | (self.node << VISIT_ID_SEQUENCE_BITS) | self._sequence
+
+
+def decode_visit_param(visit_param: str) -> Tuple[int, str]:
+    """Decode a legacy ``visit_<base64>`` deep-link parameter into ``(user_id, timestamp)``."""
+    encoded_data = visit_param.strip()
+    if encoded_data.startswith('visit_'):
+        encoded_data = encoded_data[len('visit_'):]
+    padded_data = encoded_data + '=' * (-len(encoded_data) % 4)
+    decoded_data = base64.urlsafe_b64decode(padded_data).decode()
+    user_id, timestamp = decoded_data.split('-', 1)
+    return int(user_id), timestamp
+
+
+def timestamp_key(visit_timestamp: str) -> Optional[str]:
+    """Return the deep-link form (``YYYYmmdd-HHMMSS``) of a stored ISO visit timestamp."""
+    try:
+        return datetime.fromisoformat(visit_timestamp).strftime(LINK_TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+class VisitRepository:
+    """Single entry point for visit lookups, backed by an in-memory hash index.
+
+    The index maps ``(user_id, timestamp-key)`` and ``visit_code`` to the record's
+    location in the storage backend, keeps every user's visits ordered by timestamp
+    (for counts, latest visits and history pages), and recently read records are kept
+    in a small LRU cache. Writes through the repository update the index incrementally; writes
+    by anyone else are noticed through the backend's file mtimes and trigger a rebuild.
+    Visits queued for the background writer are indexed as *pending* so they can be
+    looked up before they reach disk.
+    """
+
+    def __init__(self, storage: Storage, cache_size: int = 1024, revalidate_interval: float = 1.0):
+        self.storage = storage
+        self.cache_size = cache_size
+        # Minimum seconds between mtime checks, so hot lookups do not stat the files every time
+        self.revalidate_interval = revalidate_interval
+        self._lock = threading.RLock()
+        self._by_key: Dict[Tuple[int, str], object] = {}
+        self._by_code: Dict[str, object] = {}
+        # user_id -> [[visit_timestamp, visit_code, seq, location], ...] sorted by time;
+        # seq keeps the ordering total without ever comparing locations
+        self._by_user: Dict[int, List[list]] = {}
+        self._user_entries: Dict[object, list] = {}
+        self._entry_seq = itertools.count()
+        self._records: "OrderedDict[object, Dict]" = OrderedDict()
+        self._pending: Dict[object, Dict] = {}
+        self._pending_ids = itertools.count()
+        self._version = None
+        self._checked_at = 0.0
+        self._loaded = False
+
+    def add(self, visit: Dict) -> None:
+        """Persist a visit and index it without rebuilding."""
+        with self._lock:
+            self._ensure_index()
+            location = self.storage.add_visit(visit)
+            self._index_visit(location, visit.get('user_id'), visit.get('visit_timestamp'), visit.get('visit_code'))
+            self._remember(location, visit)
+            # Our own write changed the files; do not treat it as an external modification
+            self._version = self.storage.data_version()
+
+    def add_pending(self, visit: Dict) -> object:
+        """Make a visit that is queued for writing visible to lookups; returns its token."""
+        with self._lock:
+            self._ensure_index()
+            token = (PENDING, next(self._pending_ids))
+            self._pending[token] = visit
+            self._index_visit(token, visit.get('user_id'), visit.get('visit_timestamp'), visit.get('visit_code'))
+            return token
+
+    def commit_pending(self, tokens: List[object], locations: List[object]) -> None:
+        """Point pending visits at the storage locations they were written to."""
+        with self._lock:
+            for token, location in zip(tokens, locations):
+                visit = self._pending.pop(token, None)
+                if visit is None:
+                    continue
+                key = (visit.get('user_id'), timestamp_key(visit.get('visit_timestamp')))
+                if self._by_key.get(key) == token:
+                    self._by_key[key] = location
+                if self._by_code.get(visit.get('visit_code')) == token:
+                    self._by_code[visit['visit_code']] = location
+                entry = self._user_entries.pop(token, None)
+                if entry is not None:
+                    entry[3] = location
+                    self._user_entries[location] = entry
+                self._remember(location, visit)
+            self._version = self.storage.data_version()
+
+    def discard_pending(self, tokens: List[object]) -> None:
+        """Forget pending visits whose write failed."""
+        with self._lock:
+            for token in tokens:
+                self._pending.pop(token, None)
+            self._loaded = False
+
+    def find(self, user_id: int, timestamp: str) -> Optional[Dict]:
+        """Find a user's visit by deep-link timestamp (``YYYYmmdd-HHMMSS``) or ISO prefix."""
+        with self._lock:
+            self._ensure_index()
+            location = self._by_key.get((user_id, timestamp))
+            if location is None:
+                location = self._by_key.get((user_id, timestamp_key(timestamp) or ''))
+            if location is None:
+                location = self._find_prefix(user_id, link_timestamp_prefix(timestamp))
+            return self._load(location)
+
+    def get_by_code(self, visit_code: str) -> Optional[Dict]:
+        with self._lock:
+            self._ensure_index()
+            return self._load(self._by_code.get(visit_code))
+
+    def resolve_link(self, visit_param: str) -> Optional[Dict]:
+        """Resolve a ``visit_...`` deep-link parameter (or a visit code) to its visit record.
+
+        Current links carry the visit ID and resolve with one code lookup; links issued
+        before visit IDs existed are decoded and matched on user and timestamp.
+        """
+        token = visit_param.strip()
+        if token.startswith(VISIT_CODE_PREFIX):
+            return self.get_by_code(token)
+        if token.startswith(VISIT_LINK_PREFIX):
+            token = token[len(VISIT_LINK_PREFIX):]
+        if is_visit_id(token):
+            return self.get_by_code(VISIT_CODE_PREFIX + token)
+        user_id, timestamp = decode_visit_param(visit_param)
+        return self.find(user_id, timestamp)
+
+    def get(self, location) -> Optional[Dict]:
+        """Read the visit at a location returned by :meth:`latest` or :meth:`page`."""
+        with self._lock:
+            return self._load(location)
+
+    def get_entry(self, user_id: int, visit_timestamp: str, visit_code: Optional[str]) -> Optional[Dict]:
+        """Read the user's visit identified by a history cursor ``(visit_timestamp, visit_code)``."""
+        with self._lock:
+            self._ensure_index()
+            visits = self._by_user.get(user_id, [])
+            i = bisect.bisect_left(visits, [visit_timestamp, visit_code or ''])
+            if i < len(visits) and visits[i][0] == visit_timestamp and visits[i][1] == (visit_code or ''):
+                return self._load(visits[i][3])
+            return None
+
+    def count(self, user_id: int) -> int:
+        with self._lock:
+            self._ensure_index()
+            return len(self._by_user.get(user_id, ()))
+
+    def latest(self, user_id: int, n: int) -> List[Dict]:
+        """Return the user's ``n`` most recent visit entries, newest first."""
+        with self._lock:
+            self._ensure_index()
+            visits = self._by_user.get(user_id, [])
+            return [self._entry_dict(entry) for entry in reversed(visits[-n:])] if n > 0 else []
+
+    def page(self, user_id: int, before: Optional[Tuple[str, str]] = None,
+             after: Optional[Tuple[str, str]] = None, size: int = 10) -> Dict:
+        """Return one page of the user's history, newest first.
+
+        ``before``/``after`` are cursors (``(visit_timestamp, visit_code)`` of an entry,
+        as returned in ``older``/``newer``) selecting the page of older or newer visits;
+        without either the newest page is returned. Each page is a bisect plus a slice.
+        """
+        with self._lock:
+            self._ensure_index()
+            visits = self._by_user.get(user_id, [])
+            if before is not None:
+                end = bisect.bisect_left(visits, [before[0], before[1]])
+                start = max(0, end - size)
+            elif after is not None:
+                start = bisect.bisect_right(visits, [after[0], after[1], float('inf')])
+                end = min(len(visits), start + size)
+            else:
+                end = len(visits)
+                start = max(0, end - size)
+            window = visits[start:end]
+            return {
+                'entries': [self._entry_dict(entry) for entry in reversed(window)],
+                'total': len(visits),
+                'older': (window[0][0], window[0][1]) if start > 0 else None,
+                'newer': (window[-1][0], window[-1][1]) if end < len(visits) else None
+            }
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded = False
+
+    def _ensure_index(self) -> None:
+        now = time.monotonic()
+        if self._loaded and now - self._checked_at < self.revalidate_interval:
+            return
+        self._checked_at = now
+        version = self.storage.data_version()
+        if self._loaded and version == self._version:
+            return
+
+        self._by_key.clear()
+        self._by_code.clear()
+        self._by_user.clear()
+        self._user_entries.clear()
+        self._records.clear()
+        for location, user_id, visit_timestamp, visit_code in self.storage.iter_index():
+            self._index_visit(location, user_id, visit_timestamp, visit_code)
+        for token, visit in self._pending.items():
+            self._index_visit(token, visit.get('user_id'), visit.get('visit_timestamp'), visit.get('visit_code'))
+        self._version = version
+        self._loaded = True
+
+    def _index_visit(self, location, user_id, visit_timestamp, visit_code) -> None:
+        key = timestamp_key(visit_timestamp)
+        if user_id is not None and key:
+            self._by_key.setdefault((user_id, key), location)
+        if visit_code:
+            # Legacy (pre visit ID) codes can collide; the first (oldest) visit keeps the code
+            self._by_code.setdefault(visit_code, location)
+        if user_id is not None and key and location not in self._user_entries:
+            entry = [visit_timestamp, visit_code or '', next(self._entry_seq), location]
+            visits = self._by_user.setdefault(user_id, [])
+            if visits and visits[-1] > entry:
+                bisect.insort(visits, entry)
+            else:
+                visits.append(entry)
+            self._user_entries[location] = entry
+
+    def _find_prefix(self, user_id: int, prefix: str) -> Optional[object]:
+        """Location of the user's oldest visit whose timestamp starts with ``prefix``."""
+        visits = self._by_user.get(user_id, [])
+        # The user's entries are sorted by timestamp, so matches are one contiguous run;
+        # stored timestamps may use a space instead of 'T' as the date/time separator
+        matches = []
+        for candidate in dict.fromkeys((prefix, prefix[:10] + prefix[10:].replace('T', ' ', 1))):
+            i = bisect.bisect_left(visits, [candidate])
+            while i < len(visits) and visits[i][0].startswith(candidate):
+                matches.append(visits[i])
+                i += 1
+        if not matches:
+            return None
+        return min(matches, key=lambda entry: (timestamp_key(entry[0]) or '', entry[2]))[3]
+
+    @staticmethod
+    def _entry_dict(entry: list) -> Dict:
+        return {'visit_timestamp': entry[0], 'visit_code': entry[1] or None, 'location': entry[3]}
+
+    def _load(self, location) -> Optional[Dict]:
+        if location is None:
+            return None
+        if location in self._pending:
+            return self._pending[location]
+        if isinstance(location, tuple) and location[0] == PENDING:
+            # A token handed out before its visit was committed or discarded
+            return None
+        record = self._records.get(location)
+        if record is not None:
+            self._records.move_to_end(location)
+            return record
+        record = self.storage.read_visit(location)
+        if record is not None:
+            self._remember(location, record)
+        return record
+
+    def _remember(self, location, record: Dict) -> None:
+        self._records[location] = record
+        self._records.move_to_end(location)
+        while len(self._records) > self.cache_size:
+            self._records.popitem(last=False)